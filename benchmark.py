@@ -0,0 +1,469 @@
+"""
+Benchmarks the processing stages against synthetic inputs.
+
+Generates WTV files with metadata headers, comskip XML and SRT files of configurable size, serves the TVDB endpoints
+used by tvdb_api.TVDB from a local stand-in and times each stage in isolation. If ffmpeg is available, a recording
+generated from ffmpeg's lavfi test sources is run through the whole stage graph for each encode mode and the time of
+every stage is reported from the metrics records.
+
+Results are written as JSON so they can be compared between runs.
+
+Usage: python3 benchmark.py [--output results.json] [--help for options]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from metrics import read_records
+from wtv import HEADER_BYTES, METADATA_OFFSET
+
+SERIES_ID = 80001
+SERIES_NAME = 'Benchmark Series'
+TVDB_PAGE_SIZE = 100
+
+
+# Synthetic inputs
+
+def _wtv_entry(name, type, data):
+    return HEADER_BYTES + struct.pack('<II', type, len(data)) + name.encode('utf-16LE') + b'\x00\x00' + data
+
+
+def _wtv_string(value):
+    return value.encode('utf-16LE') + b'\x00\x00'
+
+
+def _metadata_entries(episode_name, air_date, duration, thumbnail_kb, extra_entries):
+    entries = [_wtv_entry('Title', 1, _wtv_string(SERIES_NAME))]
+    if thumbnail_kb:
+        entries.append(_wtv_entry('WM/Picture', 2, os.urandom(thumbnail_kb * 1024)))
+    for i in range(extra_entries):
+        entries.append(_wtv_entry('WM/Extra{}'.format(i), 0, struct.pack('<i', i)))
+    entries.extend([_wtv_entry('WM/SubTitle', 1, _wtv_string(episode_name)),
+                    _wtv_entry('WM/SubTitleDescription', 1, _wtv_string('A synthetic episode')),
+                    _wtv_entry('Duration', 4, struct.pack('<q', int(duration * 10 ** 7))),
+                    _wtv_entry('WM/MediaOriginalBroadcastDateTime', 1, _wtv_string(air_date + 'T04:00:00Z'))])
+    return entries
+
+
+def generate_wtv(path, size_mb, episode_name, air_date, duration, thumbnail_kb=64, extra_entries=50):
+    """
+    Write a sparse file with a WTV metadata region, padded to size_mb
+    """
+    with open(path, 'wb') as f:
+        f.seek(METADATA_OFFSET)
+        for entry in _metadata_entries(episode_name, air_date, duration, thumbnail_kb, extra_entries):
+            f.write(entry)
+        f.truncate(max(f.tell() + 16, size_mb * 1024 * 1024))
+
+
+def generate_recording(source, path, episode_name, air_date, duration):
+    """
+    Copy an MPEG-TS source and write a WTV metadata region over it, so the same file can be probed, encoded and have
+    its metadata read. ffmpeg skips the few TS packets which are overwritten.
+    """
+    shutil.copyfile(source, path)
+    with open(path, 'r+b') as f:
+        f.seek(METADATA_OFFSET)
+        for entry in _metadata_entries(episode_name, air_date, duration, 0, 0):
+            f.write(entry)
+
+
+def generate_breaks(count, duration):
+    """
+    :return: sorted, non-overlapping commercial breaks spread over duration
+    """
+    if count == 0:
+        return []
+    slot = duration / count
+    breaks = []
+    for i in range(count):
+        start = i * slot + slot * random.uniform(0.3, 0.6)
+        breaks.append((round(start, 2), round(start + slot * random.uniform(0.1, 0.3), 2)))
+    return breaks
+
+
+def generate_comskip_xml(path, breaks):
+    with open(path, 'w') as f:
+        f.write('<root>\n')
+        for start, end in breaks:
+            f.write('  <commercial start="{}" end="{}" />\n'.format(start, end))
+        f.write('</root>\n')
+
+
+def _srt_time(seconds):
+    millis = int(seconds * 1000)
+    return '{:02d}:{:02d}:{:02d},{:03d}'.format(millis // 3600000, millis // 60000 % 60, millis // 1000 % 60,
+                                                millis % 1000)
+
+
+def generate_srt(path, cues, duration):
+    step = duration / max(1, cues)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(cues):
+            start = i * step
+            f.write('{}\n{} --> {}\nCaption line number {}\nsecond line\n\n'.format(i + 1, _srt_time(start),
+                                                                                      _srt_time(start + step * 0.9),
+                                                                                      i))
+
+
+def generate_episodes(count):
+    first = date(2000, 1, 1)
+    return [{'id': 1000000 + i,
+             'episodeName': 'Episode Title {}'.format(i),
+             'overview': 'Overview of episode {}'.format(i),
+             'firstAired': (first + timedelta(days=i)).isoformat(),
+             'airedSeason': i // 100 + 1,
+             'airedEpisodeNumber': i % 100 + 1} for i in range(count)]
+
+
+def generate_source_video(ffmpeg, path, duration):
+    args = [ffmpeg, '-v', 'error', '-y',
+            '-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=30000/1001',
+            '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+            '-t', str(duration), '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '60',
+            '-c:a', 'ac3', '-f', 'mpegts', path]
+    subprocess.check_call(args)
+
+
+# TVDB stand-in
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TvdbStandIn():
+    """
+    Local HTTP server implementing the TVDB endpoints used by tvdb_api.TVDB
+    """
+
+    def __init__(self, episodes, latency=0.0):
+        self.episodes = episodes
+        self.latency = latency
+        self.requests = 0
+        self.last_modified = formatdate(usegmt=True)
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=None, headers=None):
+                data = json.dumps(body).encode('utf-8') if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                stand_in._count()
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path == '/login':
+                    self._send(200, {'token': 'benchmark.token.signature'})
+                else:
+                    self._send(404, {'Error': 'Not found'})
+
+            def do_GET(self):
+                stand_in._count()
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                parts = url.path.strip('/').split('/')
+                if url.path == '/refresh_token':
+                    self._send(200, {'token': 'benchmark.token.signature'})
+                elif url.path == '/search/series':
+                    self._send(200, {'data': [{'id': SERIES_ID, 'seriesName': params.get('name', [''])[0]}]})
+                elif parts[:1] == ['series'] and parts[2:] == ['episodes']:
+                    if self.headers.get('If-Modified-Since') == stand_in.last_modified:
+                        self._send(304)
+                        return
+                    page = int(params.get('page', ['1'])[0])
+                    last = max(1, (len(stand_in.episodes) + TVDB_PAGE_SIZE - 1) // TVDB_PAGE_SIZE)
+                    data = stand_in.episodes[(page - 1) * TVDB_PAGE_SIZE:page * TVDB_PAGE_SIZE]
+                    links = {'first': 1, 'last': last, 'next': page + 1 if page < last else None,
+                             'prev': page - 1 if page > 1 else None}
+                    self._send(200, {'data': data, 'links': links}, {'Last-Modified': stand_in.last_modified})
+                elif parts[:1] == ['series'] and parts[2:] == ['episodes', 'query']:
+                    aired = params.get('firstAired', [None])[0]
+                    data = [e for e in stand_in.episodes if e['firstAired'] == aired]
+                    if data:
+                        self._send(200, {'data': data})
+                    else:
+                        self._send(404, {'Error': 'No results for your query'})
+                else:
+                    self._send(404, {'Error': 'Not found'})
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def _count(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# Measurement
+
+def _child_rusage():
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def measure(stage, func, repeat, units, unit, setup=None, **extra):
+    """
+    Time func repeat times, then run it once more under tracemalloc for the Python peak memory
+    :param units: amount of work done by one call of func, used for the throughput
+    """
+    times = []
+    children_before = _child_rusage()
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    children_after = _child_rusage()
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    best = min(times)
+    result = {'stage': stage,
+              'repeat': repeat,
+              'wall_seconds': {'min': best, 'mean': sum(times) / len(times), 'max': max(times)},
+              'units': units,
+              'unit': unit,
+              'throughput_per_second': units / best if best > 0 else None,
+              'python_peak_bytes': peak,
+              'child_cpu_seconds': (children_after.ru_utime - children_before.ru_utime) +
+                                   (children_after.ru_stime - children_before.ru_stime),
+              # Linux reports kilobytes
+              'child_max_rss_kb': children_after.ru_maxrss}
+    result.update(extra)
+    return result
+
+
+def stage_seconds(metrics_file, recordings):
+    """
+    :return: dict of stage => mean wall seconds per recording from the stage records of the recordings
+    """
+    totals = {}
+    for record in read_records(metrics_file):
+        if record.get('type') == 'stage' and record.get('recording') in recordings:
+            totals[record['stage']] = totals.get(record['stage'], 0) + record['wall_seconds']
+    return {stage: seconds / len(recordings) for stage, seconds in totals.items()}
+
+
+def _write_config(work_dir, args):
+    path = os.path.join(work_dir, 'config.ini')
+    dirs = {}
+    for name in ('tv', 'xml', 'srt', 'temp', 'out'):
+        dirs[name] = os.path.join(work_dir, name)
+        os.makedirs(dirs[name], exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('[main]\ndatabase.file = {}\n'.format(os.path.join(work_dir, 'db.sqlite')))
+        f.write('[directories]\ntv.in = {tv}\ntv.pattern = *.wtv\ncommercial.in = {xml}\nsrt.in = {srt}\n'
+                'temp.dir = {temp}\nout.dir = {out}\ndelete.source.files = False\n'.format(**dirs))
+        f.write('[ffmpeg]\nexecutable = {}\nh264.preset = ultrafast\nh264.crf = 23\n'.format(args.ffmpeg))
+        f.write('[ffprobe]\nexecutable = {}\n'.format(args.ffprobe))
+        f.write('[nice]\nexecutable = nice\nenabled = False\n')
+        f.write('[comskip]\nexecutable = {}\nrun.if.missing = {}\n'.format(args.comskip, bool(args.comskip)))
+        f.write('[ccextractor]\nexecutable = {}\nrun.if.missing = {}\n'.format(args.ccextractor,
+                                                                              bool(args.ccextractor)))
+        f.write('[spool]\nenabled = {}\n'.format(args.spool))
+        f.write('[tvdb]\nusername = benchmark\nuserkey = benchmark\napikey = benchmark\n')
+    return path, dirs
+
+
+def run(args):
+    random.seed(args.seed)
+    work_dir = tempfile.mkdtemp(prefix='silver-tube-bench.')
+    results = []
+    cwd = os.getcwd()
+    try:
+        config, dirs = _write_config(work_dir, args)
+        # processing reads its configuration & opens its log when imported
+        os.chdir(work_dir)
+        sys.argv = [sys.argv[0], config]
+        import processing
+        import subtitles
+        import tvdb_api
+        import wtv
+        import wtv_db
+
+        # WTV metadata
+        wtv_file = os.path.join(dirs['tv'], 'Benchmark_Series_2000_01_01_00_00_00.wtv')
+        episodes = generate_episodes(args.episodes)
+        target = episodes[-1]
+        generate_wtv(wtv_file, args.wtv_size_mb, target['episodeName'], target['firstAired'], args.duration,
+                     thumbnail_kb=args.thumbnail_kb)
+        results.append(measure('wtv_metadata_full', lambda: wtv.extract_metadata(wtv_file), args.repeat, 1, 'files',
+                               file_bytes=os.path.getsize(wtv_file)))
+        results.append(measure('wtv_metadata_keys',
+                               lambda: wtv.extract_metadata(wtv_file, keys=processing.METADATA_KEYS),
+                               args.repeat, 1, 'files', file_bytes=os.path.getsize(wtv_file)))
+
+        # Commercials
+        com_file = os.path.join(dirs['xml'], 'benchmark.xml')
+        breaks = generate_breaks(args.breaks, args.duration)
+        generate_comskip_xml(com_file, breaks)
+        results.append(measure('parse_commercial_file', lambda: processing.parse_commercial_file(com_file),
+                               args.repeat, len(breaks), 'breaks'))
+        invert = processing.invert_commercial(processing.parse_commercial_file(com_file))
+
+        # Subtitles
+        srt_file = os.path.join(dirs['srt'], 'benchmark.srt')
+        out_srt = os.path.join(dirs['out'], 'benchmark.srt')
+        generate_srt(srt_file, args.cues, args.duration)
+        results.append(measure('split_subtitles', lambda: subtitles.split_subtitles(srt_file, invert, out_srt),
+                               args.repeat, args.cues, 'cues', segments=len(invert),
+                               file_bytes=os.path.getsize(srt_file)))
+
+        # TVDB
+        stand_in = TvdbStandIn(episodes, latency=args.tvdb_latency).start()
+        db = wtv_db.WtvDb(os.path.join(work_dir, 'tvdb.sqlite'))
+        db.begin()
+        client = tvdb_api.TVDB(api_key='benchmark', username='benchmark', user_key='benchmark', wtvdb=db,
+                               base_url=stand_in.url)
+
+        def clear_cache():
+            # Expire the cache & drop the Last-Modified so every page is downloaded again
+            cache = db.get_episode_cache(SERIES_ID)
+            if cache is not None:
+                cache.updated = datetime(2000, 1, 1)
+                cache.last_modified = None
+                db.save(cache)
+            # And the in-memory episode index
+            client._indexes.clear()
+
+        def lookup():
+            found, candidates = client.find_episode(SERIES_NAME, episode=target['episodeName'],
+                                                    air_date=target['firstAired'])
+            if found is None:
+                raise Exception('Expected one episode, found {} candidates'.format(len(candidates)))
+
+        client.search_series(SERIES_NAME)
+        for stage, setup in (('tvdb_lookup_cold', clear_cache), ('tvdb_lookup_cached', None)):
+            requests_before = stand_in.requests
+            result = measure(stage, lookup, args.repeat, 1, 'lookups', setup=setup, episodes=len(episodes),
+                             latency_seconds=args.tvdb_latency)
+            # Includes the run under tracemalloc
+            result['http_requests_per_lookup'] = (stand_in.requests - requests_before) / (args.repeat + 1)
+            results.append(result)
+        db.end()
+        client.close()
+
+        # Full pipeline
+        if args.pipeline and shutil.which(args.ffmpeg) and shutil.which(args.ffprobe):
+            source = os.path.join(work_dir, 'source.ts')
+            generate_source_video(args.ffmpeg, source, args.pipeline_duration)
+            pipeline_breaks = generate_breaks(args.pipeline_breaks, args.pipeline_duration)
+            kept = sum((e if e is not None else args.pipeline_duration) - s
+                       for s, e in processing.invert_commercial(pipeline_breaks))
+            processing.tvdb = tvdb_api.TVDB(api_key='benchmark', username='benchmark', user_key='benchmark',
+                                            wtvdb=processing.wtvdb, base_url=stand_in.url)
+            for mode in args.modes:
+                processing.ENCODE_MODE = mode
+                recordings = []
+                ok = []
+
+                def setup():
+                    # A finalized recording is skipped, so every run gets a new one
+                    name = 'Benchmark_Series_2000_01_01_{}_{}.wtv'.format(mode, len(recordings))
+                    recordings.append(name)
+                    wtv_file = os.path.join(dirs['tv'], name)
+                    generate_recording(source, wtv_file, target['episodeName'], target['firstAired'],
+                                       args.pipeline_duration)
+                    com_file, srt_file = processing.related_files(wtv_file, dirs['xml'], dirs['srt'])
+                    if not args.comskip:
+                        generate_comskip_xml(com_file, pipeline_breaks)
+                    if not args.ccextractor:
+                        generate_srt(srt_file, int(args.pipeline_duration), args.pipeline_duration)
+
+                def pipeline():
+                    ok.append(processing.process_file(os.path.join(dirs['tv'], recordings[-1]), dirs['xml'],
+                                                      dirs['srt'], complete=True))
+
+                result = measure('pipeline_' + mode, pipeline, 1, kept, 'media_seconds', setup=setup,
+                                 media_seconds=args.pipeline_duration)
+                result['success'] = all(ok)
+                # The last run is under tracemalloc, so only the timed runs are included
+                result['stage_seconds'] = stage_seconds(processing.METRICS_FILE, recordings[:-1])
+                results.append(result)
+        elif args.pipeline:
+            print('ffmpeg/ffprobe not found, skipping the full pipeline', file=sys.stderr)
+        stand_in.stop()
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {'benchmark': 'silver-tube',
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {k: v for k, v in vars(args).items() if k not in ('output',)},
+            'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the silver tube processing stages')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--duration', type=float, default=3 * 60 * 60, help='Synthetic recording length in seconds')
+    parser.add_argument('--wtv-size-mb', type=int, default=1024, help='Size of the sparse synthetic WTV file')
+    parser.add_argument('--thumbnail-kb', type=int, default=256)
+    parser.add_argument('--breaks', type=int, default=40, help='Commercial breaks in the comskip XML')
+    parser.add_argument('--cues', type=int, default=50000, help='Cues in the SRT file')
+    parser.add_argument('--episodes', type=int, default=5000, help='Episodes served by the TVDB stand-in')
+    parser.add_argument('--tvdb-latency', type=float, default=0.0, help='Seconds added to each TVDB request')
+    parser.add_argument('--no-pipeline', dest='pipeline', action='store_false', help='Skip the full pipeline')
+    parser.add_argument('--pipeline-duration', type=float, default=120, help='Length of the lavfi source in seconds')
+    parser.add_argument('--pipeline-breaks', type=int, default=4)
+    parser.add_argument('--modes', nargs='+', default=['filter', 'segments', 'smartcut', 'parallel'])
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    parser.add_argument('--ffprobe', default='ffprobe')
+    parser.add_argument('--comskip', help='Run comskip in the pipeline instead of using a generated comskip XML')
+    parser.add_argument('--ccextractor', help='Run ccextractor in the pipeline instead of using a generated SRT')
+    parser.add_argument('--spool', action='store_true', help='Enable spool mode in the pipeline')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory')
+    args = parser.parse_args()
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import bisect
+import difflib
+import re
+import unicodedata
+from datetime import datetime, timedelta
+
+# Titles at least this similar (0-1) are fuzzy matches
+FUZZY_CUTOFF = 0.8
+# The best fuzzy match is only used on its own if it is this much more similar than the next
+FUZZY_MARGIN = 0.1
+# Maximum number of fuzzy candidates returned for manual resolution
+FUZZY_LIMIT = 5
+# Days either side of the air date searched if nothing aired on it, since the recorded date is in UTC
+AIR_DATE_TOLERANCE = 1
+
+_NUMBER_WORDS = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9,
+                 'ten': 10}
+_ROMAN = {'i': 1, 'ii': 2, 'iii': 3, 'iv': 4, 'v': 5, 'vi': 6, 'vii': 7, 'viii': 8, 'ix': 9, 'x': 10}
+
+# "Title (1)", "Title (Part 1)", "Title, Part 1", "Title - Pt. 1", "Title Part One", "Title Part II"
+_PART = re.compile(r'[\s,:;-]*(?:\(\s*(?:(?:part|pt)\.?\s*)?(\w+)\s*\)|\b(?:part|pt)\.?\s*(\w+))\s*$')
+_APOSTROPHES = re.compile('[\'‘’`]')
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def _part_number(token):
+    if token.isdigit():
+        return int(token)
+    return _NUMBER_WORDS.get(token, _ROMAN.get(token))
+
+
+def normalize_title(title):
+    """
+    Normalize an episode title so differences in case, accents, punctuation and the style of a part suffix do not
+    matter, eg "The Storm (1)" and "the storm, part one" are both "the storm part 1"
+    """
+    title = unicodedata.normalize('NFKD', title)
+    title = ''.join(c for c in title if not unicodedata.combining(c)).lower().replace('&', ' and ')
+    part = None
+    match = _PART.search(title)
+    if match:
+        part = _part_number(match.group(1) or match.group(2))
+        if part is not None:
+            title = title[:match.start()]
+    title = _NON_WORD.sub(' ', _APOSTROPHES.sub('', title)).strip()
+    if part is not None:
+        title = '{} part {}'.format(title, part).strip()
+    return title
+
+
+class EpisodeIndex():
+    """
+    Index of the episodes of one series by normalized title and by air date.
+
+    Title and air date lookups are dictionary lookups, the neighbouring air dates are found with a binary search and
+    only the fuzzy fallback compares against every title.
+    """
+
+    def __init__(self, episodes):
+        """
+        :param episodes: episodes as returned by the TVDB API
+        """
+        self._by_title = {}
+        self._by_date = {}
+        for e in episodes:
+            if e.get('episodeName'):
+                self._by_title.setdefault(normalize_title(e['episodeName']), []).append(e)
+            if e.get('firstAired'):
+                self._by_date.setdefault(e['firstAired'], []).append(e)
+        self._titles = list(self._by_title)
+        self._dates = sorted(self._by_date)
+
+    def __len__(self):
+        return sum(len(v) for v in self._by_title.values())
+
+    def by_title(self, title):
+        return list(self._by_title.get(normalize_title(title), []))
+
+    def by_air_date(self, air_date, tolerance=0):
+        """
+        :param air_date: YYYY-MM-DD
+        :param tolerance: also include episodes which aired this many days before or after
+        """
+        if not tolerance:
+            return list(self._by_date.get(air_date, []))
+        try:
+            day = datetime.strptime(air_date, '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            # A date parsed from a malformed filename or header matches nothing
+            return []
+        low = (day - timedelta(days=tolerance)).isoformat()
+        high = (day + timedelta(days=tolerance)).isoformat()
+        found = []
+        for d in self._dates[bisect.bisect_left(self._dates, low):bisect.bisect_right(self._dates, high)]:
+            found.extend(self._by_date[d])
+        return found
+
+    def fuzzy(self, title, candidates=None, limit=FUZZY_LIMIT, cutoff=FUZZY_CUTOFF):
+        """
+        :param candidates: optional episodes to rank instead of all of them
+        :return: list of (similarity, episode), most similar first
+        """
+        normalized = normalize_title(title)
+        if candidates is None:
+            titles = difflib.get_close_matches(normalized, self._titles, n=limit, cutoff=cutoff)
+            candidates = [e for t in titles for e in self._by_title[t]]
+        matcher = difflib.SequenceMatcher(b=normalized)
+        ranked = []
+        for e in candidates:
+            matcher.set_seq1(normalize_title(e.get('episodeName') or ''))
+            score = matcher.ratio()
+            if score >= cutoff:
+                ranked.append((score, e))
+        ranked.sort(key=lambda r: -r[0])
+        return ranked[:limit]
+
+    @staticmethod
+    def _best(ranked):
+        # Near misses count as rivals, so a title only just above the cutoff is not chosen over one just below it
+        if ranked and ranked[0][0] >= FUZZY_CUTOFF and \
+                (len(ranked) == 1 or ranked[0][0] - ranked[1][0] >= FUZZY_MARGIN):
+            return ranked[0][1]
+        return None
+
+    def match(self, title=None, air_date=None):
+        """
+        Find the episode by title, then by air date and then by the most similar title.
+        :return: (the matching episode or None, candidates ranked by likelihood if there is no single match)
+        """
+        candidates = []
+        if title:
+            found = self.by_title(title)
+            if len(found) > 1 and air_date:
+                # Titles repeat in some series, so use the air date to choose
+                dated = [e for e in found if e in self.by_air_date(air_date, AIR_DATE_TOLERANCE)]
+                found = dated if dated else found
+            if len(found) == 1:
+                return found[0], []
+            if found:
+                return None, found
+        if air_date:
+            dated = self.by_air_date(air_date)
+            if len(dated) == 1:
+                return dated[0], []
+            if not dated:
+                dated = self.by_air_date(air_date, AIR_DATE_TOLERANCE)
+            if title and dated:
+                # An episode from a neighbouring day is only chosen if its title agrees with the recording
+                best = self._best(self.fuzzy(title, candidates=dated, cutoff=FUZZY_CUTOFF - FUZZY_MARGIN))
+                if best is not None:
+                    return best, []
+            elif len(dated) == 1:
+                return dated[0], []
+            candidates.extend(dated)
+        if title:
+            ranked = self.fuzzy(title, cutoff=FUZZY_CUTOFF - FUZZY_MARGIN)
+            best = self._best(ranked)
+            if best is not None:
+                return best, []
+            candidates = [e for score, e in ranked] + [e for e in candidates if e not in (r[1] for r in ranked)]
+        return None, candidates
@@ -0,0 +1,251 @@
+"""
+Reads commercial breaks and turns them into the list of segments to keep.
+
+Breaks are read as a stream from comskip XML, EDL or comskip .txt frame lists. They are then sorted and merged, and
+slivers are removed: kept segments shorter than a minimum are absorbed into the breaks around them and breaks shorter
+than a minimum are dropped. Each kept segment is another encode and another concat entry, so this both reduces the work
+and makes the edit list the same however the detector happened to split a break.
+
+A break is (start, end) in seconds, where end is None for a break which runs to the end of the recording.
+"""
+import bisect
+import os
+import re
+import xml.etree.ElementTree as ET
+
+# Frame rate of .txt frame lists without a header, NTSC
+DEFAULT_FPS = 29.97
+
+# EDL actions which are removed: 0 is a cut and 3 a commercial break, 1 (mute) and 2 (scene marker) are ignored
+EDL_CUT_ACTIONS = ('0', '3')
+
+# "FILE PROCESSING COMPLETE  53999 FRAMES AT  2997", the frame rate times 100
+_TXT_HEADER = re.compile(r'FRAMES AT\s+(\d+)')
+
+
+def read_comskip_xml(path):
+    """
+    :return: iterator of (start, end) from <commercial start="" end="" /> elements
+    """
+    for event, elem in ET.iterparse(path):
+        start, end = elem.get('start'), elem.get('end')
+        if start is not None and end is not None:
+            yield float(start), float(end)
+        # Only the attributes are needed, so never build the whole tree
+        elem.clear()
+
+
+def read_edl(path):
+    """
+    :return: iterator of (start, end) from "start end [action]" lines
+    """
+    with open(path) as f:
+        for line in f:
+            split = line.split()
+            if len(split) < 2 or line.lstrip().startswith('#'):
+                continue
+            if len(split) > 2 and split[2] not in EDL_CUT_ACTIONS:
+                continue
+            yield float(split[0]), float(split[1])
+
+
+def read_frame_list(path, fps=None):
+    """
+    :param fps: frame rate if the file has no header
+    :return: iterator of (start, end) from comskip's "start end" frame number lines
+    """
+    with open(path) as f:
+        for line in f:
+            match = _TXT_HEADER.search(line)
+            if match:
+                fps = int(match.group(1)) / 100
+                continue
+            split = line.split()
+            if len(split) < 2 or not split[0].isdigit() or not split[1].isdigit():
+                continue
+            rate = fps or DEFAULT_FPS
+            yield int(split[0]) / rate, int(split[1]) / rate
+
+
+READERS = {
+    '.xml': read_comskip_xml,
+    '.edl': read_edl,
+    '.txt': read_frame_list,
+}
+
+
+def read_breaks(path, fps=None):
+    """
+    Read the breaks of any supported format, chosen by extension
+    :raises ValueError: for an unsupported format
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in READERS:
+        raise ValueError('Unsupported commercial file: {}'.format(path))
+    if ext == '.txt':
+        return read_frame_list(path, fps)
+    return READERS[ext](path)
+
+
+def _merge(breaks):
+    merged = []
+    for start, end in sorted(breaks, key=lambda b: b[0]):
+        if merged and (merged[-1][1] is None or start <= merged[-1][1]):
+            previous = merged[-1]
+            merged[-1] = (previous[0], None if previous[1] is None or end is None else max(previous[1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def normalize(breaks, total=None, min_keep=0, min_break=0):
+    """
+    :param breaks: iterable of (start, end) in any order
+    :param total: duration of the recording if known
+    :param min_keep: kept segments shorter than this many seconds are cut along with the breaks around them
+    :param min_break: breaks shorter than this many seconds are kept
+    :return: sorted list of disjoint breaks
+    """
+    clamped = []
+    for start, end in breaks:
+        start = max(0, start)
+        if total is not None:
+            if start >= total:
+                continue
+            if end is not None and end >= total:
+                end = None
+        if end is None or end > start:
+            clamped.append((start, end))
+    merged = _merge(clamped)
+    if not merged:
+        return merged
+
+    # Absorb short kept segments, including the ones before the first break and after the last
+    absorbed = []
+    for start, end in merged:
+        if not absorbed and start < min_keep:
+            start = 0
+        if absorbed and start - absorbed[-1][1] < min_keep:
+            absorbed[-1] = (absorbed[-1][0], end)
+        else:
+            absorbed.append((start, end))
+    last_start, last_end = absorbed[-1]
+    if total is not None and last_end is not None and total - last_end < min_keep:
+        absorbed[-1] = (last_start, None)
+
+    # Breaks only get longer above, so dropping the short ones now cannot leave a short kept segment
+    return [(start, end) for start, end in absorbed if end is None or end - start >= min_break]
+
+
+def _nearest(keyframes, t, tolerance):
+    i = bisect.bisect_left(keyframes, t)
+    near = [k for k in keyframes[max(0, i - 1):i + 1] if abs(k - t) <= tolerance]
+    return min(near, key=lambda k: abs(k - t)) if near else t
+
+
+def snap(breaks, keyframes, tolerance=1.0):
+    """
+    Move each cut point to the nearest keyframe within tolerance seconds, so kept segments start on a keyframe and can
+    be stream copied
+    :param keyframes: sorted keyframe times
+    """
+    if not keyframes:
+        return list(breaks)
+    snapped = []
+    for start, end in breaks:
+        start = _nearest(keyframes, start, tolerance) if start > 0 else start
+        if end is not None:
+            end = _nearest(keyframes, end, tolerance)
+        if end is None or end > start:
+            snapped.append((start, end))
+    return _merge(snapped)
+
+
+def on_keyframes(invert, keyframes, tolerance=0.001):
+    """
+    :param invert: the kept segments
+    :param keyframes: sorted keyframe times
+    :return: whether every kept segment starts on a keyframe, so it can be stream copied without what was cut before it
+    """
+    for start, end in invert:
+        if start <= 0:
+            continue
+        i = bisect.bisect_left(keyframes, start)
+        if not any(abs(k - start) <= tolerance for k in keyframes[max(0, i - 1):i + 1]):
+            return False
+    return True
+
+
+def smart_cut_plan(invert, keyframes, min_piece=0.1):
+    """
+    Split each kept segment into the pieces that can be stream copied (whole GOPs between keyframes) and the short
+    head & tail pieces around the cut points that must be re-encoded
+    :param invert: the kept segments
+    :param keyframes: sorted keyframe times
+    :param min_piece: head & tail pieces up to this many seconds are not re-encoded
+    :return: list of (start, end, copy) where end may be None for the end of the file
+    """
+    pieces = []
+    for start, end in invert:
+        first = bisect.bisect_left(keyframes, start)
+        last = (bisect.bisect_right(keyframes, end) if end is not None else len(keyframes)) - 1
+        if first >= len(keyframes) or last < first or (end is not None and keyframes[first] >= keyframes[last]):
+            # No complete GOP inside of this segment
+            pieces.append((start, end, False))
+            continue
+        copy_start = keyframes[first]
+        copy_end = keyframes[last] if end is not None else None
+        # A copy can only start on a keyframe, so a shorter head is dropped rather than copied from the one before
+        if copy_start - start > min_piece:
+            pieces.append((start, copy_start, False))
+        pieces.append((copy_start, copy_end, True))
+        if end is not None and end - copy_end > min_piece:
+            pieces.append((copy_end, end, False))
+        elif end is not None:
+            # The frames after the last keyframe depend on it, so a short tail is copied along with the GOP
+            pieces[-1] = (copy_start, end, True)
+    return pieces
+
+
+def chunk_plan(invert, keyframes, chunk_seconds, total_duration=None):
+    """
+    Split kept segments longer than chunk_seconds into chunks which start on keyframes
+    :param keyframes: sorted keyframe times, may be empty
+    :param total_duration: used for the end of a segment which runs to the end of the file
+    :return: list of (start, end) where end may be None for the end of the file
+    """
+    chunks = []
+    for start, end in invert:
+        stop = end if end is not None else total_duration
+        if not stop:
+            chunks.append((start, end))
+            continue
+        boundary = start
+        target = start + chunk_seconds
+        while target < stop - chunk_seconds / 2:
+            # The keyframe closest to the target, if there is one inside of the segment
+            i = bisect.bisect_left(keyframes, target)
+            near = [k for k in keyframes[max(0, i - 1):i + 1] if boundary < k < stop]
+            cut = min(near, key=lambda k: abs(k - target)) if near else target
+            chunks.append((boundary, cut))
+            boundary = cut
+            target = cut + chunk_seconds
+        chunks.append((boundary, end))
+    return chunks
+
+
+def invert(breaks):
+    """
+    :param breaks: normalized breaks
+    :return: the kept segments as (start, end) where end is None for the end of the recording
+    """
+    kept = []
+    position = 0
+    for start, end in breaks:
+        if start > position:
+            kept.append((position, start))
+        if end is None:
+            return kept
+        position = max(position, end)
+    kept.append((position, None))
+    return kept
@@ -0,0 +1,459 @@
+"""
+Structured timing & resource records for stages and subprocesses.
+
+Every record is appended as a JSON line to the metrics file and, optionally, aggregated into a Prometheus textfile
+collector file. Subprocesses are reaped with wait4 so each record has the resource usage of exactly that process
+rather than of all children.
+
+Usage: python3 metrics.py metrics.jsonl [--by stage|series]
+
+Without --by, both reports are printed.
+"""
+import asyncio
+import contextvars
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# name => (type, help) of the Prometheus metrics
+PROMETHEUS_METRICS = OrderedDict([
+    ('silvertube_stage_runs_total', ('counter', 'Number of times a stage ran')),
+    ('silvertube_stage_seconds_total', ('counter', 'Wall time spent in a stage')),
+    ('silvertube_stage_cpu_seconds_total', ('counter', 'CPU time of the subprocesses run by a stage')),
+    ('silvertube_encode_media_seconds_total', ('counter', 'Seconds of video encoded')),
+    ('silvertube_encode_speed_ratio', ('gauge', 'Media duration divided by encode wall time of the last encode')),
+    ('silvertube_process_runs_total', ('counter', 'Number of times a subprocess ran')),
+    ('silvertube_process_seconds_total', ('counter', 'Wall time of subprocesses')),
+    ('silvertube_process_cpu_seconds_total', ('counter', 'CPU time of subprocesses')),
+    ('silvertube_process_read_bytes_total', ('counter', 'Bytes read by subprocesses')),
+    ('silvertube_process_write_bytes_total', ('counter', 'Bytes written by subprocesses')),
+    ('silvertube_process_max_rss_bytes', ('gauge', 'Peak resident memory of the last run of a subprocess')),
+    ('silvertube_last_record_timestamp_seconds', ('gauge', 'Time of the last record')),
+])
+
+# Fields summed into a stage record from the subprocesses run by the stage
+_USAGE_FIELDS = ('user_cpu_seconds', 'system_cpu_seconds', 'read_bytes', 'write_bytes')
+
+# Executables which only run another, each of their options takes a value
+_WRAPPERS = ('nice', 'ionice', 'taskset')
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _executable(args):
+    # The name of the executable run, skipping nice, ionice & taskset
+    names = [os.path.basename(str(a)) for a in args]
+    i = 0
+    while i < len(names) - 1 and names[i] in _WRAPPERS:
+        i += 1
+        while i < len(names) - 1 and names[i].startswith('-'):
+            i += 2
+    return names[min(i, len(names) - 1)] if names else None
+
+
+def _proc_io(pid):
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            return {key.strip(): int(value) for key, value in (line.split(':') for line in f if ':' in line)}
+    except (OSError, IOError, ValueError):
+        return {}
+
+
+def _proc_age(pid):
+    # Seconds since the process started or None if unknown
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # The command name may contain spaces, so split after it. starttime is the 22nd field.
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, IOError, ValueError, IndexError):
+        return None
+
+
+def reap(p, timeout=None):
+    """
+    Wait for a Popen process to exit and reap it
+    :return: (return code, resource usage or None, dict of wall_seconds & /proc/<pid>/io values)
+    :raises subprocess.TimeoutExpired: if timeout seconds pass first, the process is still running
+    """
+    if p.returncode is not None or not hasattr(os, 'wait4') or not hasattr(os, 'waitid'):
+        return p.wait(timeout), None, {}
+    flags = os.WEXITED | os.WNOWAIT
+    if timeout is None:
+        os.waitid(os.P_PID, p.pid, flags)
+    else:
+        deadline = time.monotonic() + timeout
+        while os.waitid(os.P_PID, p.pid, flags | os.WNOHANG) is None:
+            if time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(p.args, timeout)
+            time.sleep(0.1)
+    # The exited process has not been reaped yet, so its /proc entry is still there
+    info = _proc_io(p.pid)
+    info['wall_seconds'] = _proc_age(p.pid)
+    pid, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = _exit_code(status)
+    return p.returncode, rusage, info
+
+
+class _Stage():
+    def __init__(self, name):
+        self.name = name
+        self.fields = {}
+        self.usage = dict((field, 0) for field in _USAGE_FIELDS)
+        self.usage['max_rss_bytes'] = 0
+        self.usage['processes'] = 0
+
+
+class _Recording():
+    # The labels & running stages of the recording handled in a context
+    def __init__(self, labels):
+        self.labels = labels
+        self.stages = {}
+
+
+class Metrics():
+    """
+    Writes stage & subprocess records. Safe to use from several threads and several processes sharing the files.
+    Labels & stages belong to the context begin() was called in, so several recordings may be handled at once.
+    """
+
+    def __init__(self, jsonl_file=None, prometheus_file=None):
+        """
+        :param jsonl_file: file the records are appended to, None to disable
+        :param prometheus_file: Prometheus textfile collector file (*.prom), None to disable
+        """
+        self._jsonl_file = jsonl_file
+        self._prometheus_file = prometheus_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._default = _Recording({})
+        self._recording = contextvars.ContextVar('recording')
+
+    @property
+    def enabled(self):
+        return bool(self._jsonl_file or self._prometheus_file)
+
+    def _current(self):
+        return self._recording.get(self._default)
+
+    def begin(self, **labels):
+        """
+        Set the labels, such as the recording, added to all of the following records of this context
+        """
+        self._recording.set(_Recording(labels))
+
+    def label(self, **labels):
+        with self._lock:
+            self._current().labels.update(labels)
+
+    def current_stage(self):
+        return getattr(self._local, 'stage', None)
+
+    def annotate(self, **fields):
+        """
+        Add fields to the record of the stage running on this thread
+        """
+        stage = self._current().stages.get(self.current_stage())
+        if stage is not None:
+            stage.fields.update(fields)
+
+    def timed(self, name, func):
+        """
+        Wrap a stage function so a record is written when it finishes. Subprocesses run by blocking functions are
+        attributed to the stage automatically, coroutines must pass the stage to wait().
+        """
+        if asyncio.iscoroutinefunction(func):
+            async def run_async(**kwargs):
+                stage = self._start_stage(name)
+                start = time.monotonic()
+                ok = False
+                try:
+                    result = await func(**kwargs)
+                    ok = True
+                    return result
+                finally:
+                    self._finish_stage(stage, time.monotonic() - start, ok)
+
+            return run_async
+
+        def run(**kwargs):
+            stage = self._start_stage(name)
+            previous = self.current_stage()
+            self._local.stage = name
+            start = time.monotonic()
+            ok = False
+            try:
+                result = func(**kwargs)
+                ok = True
+                return result
+            finally:
+                self._local.stage = previous
+                self._finish_stage(stage, time.monotonic() - start, ok)
+
+        return run
+
+    def _start_stage(self, name):
+        stage = _Stage(name)
+        with self._lock:
+            self._current().stages[name] = stage
+        return stage
+
+    def _finish_stage(self, stage, wall_seconds, ok):
+        stages = self._current().stages
+        with self._lock:
+            if stages.get(stage.name) is stage:
+                del stages[stage.name]
+        record = OrderedDict([('type', 'stage'), ('stage', stage.name), ('ok', ok), ('wall_seconds', wall_seconds)])
+        record.update(stage.usage)
+        record.update(stage.fields)
+        media_seconds = stage.fields.get('media_seconds')
+        if media_seconds and wall_seconds > 0:
+            record['speed'] = media_seconds / wall_seconds
+        self.record(record)
+
+    def wait(self, p, name=None, stage=None, timeout=None, **labels):
+        """
+        Wait for a subprocess, reap it and write its record
+        :param name: name of the process, defaults to the executable (after nice, ionice & taskset)
+        :param stage: the stage the process belongs to, defaults to the stage running on this thread
+        :return: the return code
+        """
+        returncode, rusage, info = reap(p, timeout)
+        if not self.enabled:
+            return returncode
+        if name is None:
+            name = _executable(p.args if isinstance(p.args, (list, tuple)) else [p.args])
+        stage = stage if stage is not None else self.current_stage()
+        record = OrderedDict([('type', 'process'), ('process', name), ('stage', stage),
+                              ('returncode', returncode), ('wall_seconds', info.get('wall_seconds'))])
+        if rusage is not None:
+            record['user_cpu_seconds'] = rusage.ru_utime
+            record['system_cpu_seconds'] = rusage.ru_stime
+            # ru_maxrss is in kilobytes on Linux
+            record['max_rss_bytes'] = rusage.ru_maxrss * 1024
+        # rchar/wchar include pipes & the page cache, read_bytes/write_bytes only the storage
+        record['read_bytes'] = info.get('rchar', 0)
+        record['write_bytes'] = info.get('wchar', 0)
+        record['storage_read_bytes'] = info.get('read_bytes', 0)
+        record['storage_write_bytes'] = info.get('write_bytes', 0)
+        record.update(labels)
+        current = self._current().stages.get(stage)
+        if current is not None:
+            with self._lock:
+                for field in _USAGE_FIELDS:
+                    current.usage[field] += record.get(field, 0)
+                current.usage['max_rss_bytes'] = max(current.usage['max_rss_bytes'], record.get('max_rss_bytes', 0))
+                current.usage['processes'] += 1
+        self.record(record)
+        return returncode
+
+    def record(self, record):
+        if not self.enabled:
+            return
+        with self._lock:
+            labels = dict(self._current().labels)
+        full = OrderedDict([('time', datetime.utcnow().isoformat() + 'Z'), ('pid', os.getpid())])
+        for key, value in labels.items():
+            if key not in record:
+                full[key] = value
+        full.update(record)
+        try:
+            if self._jsonl_file:
+                self._append(full)
+            if self._prometheus_file:
+                self._update_prometheus(full)
+        except (OSError, IOError):
+            logger.exception('Unable to write metrics')
+
+    def _append(self, record):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        # A single write to a file opened for appending is not split between processes
+        fd = os.open(self._jsonl_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def _update_prometheus(self, record):
+        # The totals are kept next to the textfile and updated under a lock, so every worker adds to the same series
+        with open(self._prometheus_file + '.state', 'a+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            try:
+                state = json.loads(state_file.read() or '{}')
+            except ValueError:
+                state = {}
+            _accumulate(state, record)
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state))
+            state_file.flush()
+            # The collector may read at any time, so replace the file atomically
+            temp = self._prometheus_file + '.tmp'
+            with open(temp, 'w') as f:
+                f.write(render_prometheus(state))
+            os.replace(temp, self._prometheus_file)
+
+
+def _label_key(**labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+def _add(state, metric, value, **labels):
+    series = state.setdefault(metric, {})
+    key = _label_key(**labels)
+    series[key] = series.get(key, 0) + (value or 0)
+
+
+def _set(state, metric, value, **labels):
+    state.setdefault(metric, {})[_label_key(**labels)] = value
+
+
+def _accumulate(state, record):
+    result = 'ok' if record.get('ok', record.get('returncode') == 0) else 'error'
+    if record['type'] == 'stage':
+        stage = record['stage']
+        _add(state, 'silvertube_stage_runs_total', 1, stage=stage, result=result)
+        _add(state, 'silvertube_stage_seconds_total', record['wall_seconds'], stage=stage)
+        _add(state, 'silvertube_stage_cpu_seconds_total', record.get('user_cpu_seconds'), stage=stage, mode='user')
+        _add(state, 'silvertube_stage_cpu_seconds_total', record.get('system_cpu_seconds'), stage=stage,
+             mode='system')
+        if 'speed' in record:
+            _add(state, 'silvertube_encode_media_seconds_total', record['media_seconds'])
+            _set(state, 'silvertube_encode_speed_ratio', record['speed'])
+    elif record['type'] == 'process':
+        process = record['process']
+        _add(state, 'silvertube_process_runs_total', 1, process=process, result=result)
+        _add(state, 'silvertube_process_seconds_total', record.get('wall_seconds'), process=process)
+        _add(state, 'silvertube_process_cpu_seconds_total', record.get('user_cpu_seconds'), process=process,
+             mode='user')
+        _add(state, 'silvertube_process_cpu_seconds_total', record.get('system_cpu_seconds'), process=process,
+             mode='system')
+        _add(state, 'silvertube_process_read_bytes_total', record.get('read_bytes'), process=process)
+        _add(state, 'silvertube_process_write_bytes_total', record.get('write_bytes'), process=process)
+        if 'max_rss_bytes' in record:
+            _set(state, 'silvertube_process_max_rss_bytes', record['max_rss_bytes'], process=process)
+    _set(state, 'silvertube_last_record_timestamp_seconds', time.time())
+
+
+def render_prometheus(state):
+    lines = []
+    for metric, (type, help) in PROMETHEUS_METRICS.items():
+        if metric not in state:
+            continue
+        lines.append('# HELP {} {}'.format(metric, help))
+        lines.append('# TYPE {} {}'.format(metric, type))
+        for key, value in sorted(state[metric].items()):
+            lines.append('{}{} {}'.format(metric, '{' + key + '}' if key else '', value))
+    return '\n'.join(lines) + '\n'
+
+
+def read_records(jsonl_file):
+    with open(jsonl_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A partial line from a process which was killed while writing
+                    continue
+
+
+class _Summary():
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.max_rss_bytes = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.media_seconds = 0.0
+        self.encode_seconds = 0.0
+        self.recordings = set()
+
+    def add(self, record):
+        self.runs += 1
+        if not record.get('ok', True):
+            self.failures += 1
+        self.wall_seconds += record.get('wall_seconds') or 0
+        self.cpu_seconds += (record.get('user_cpu_seconds') or 0) + (record.get('system_cpu_seconds') or 0)
+        self.max_rss_bytes = max(self.max_rss_bytes, record.get('max_rss_bytes') or 0)
+        self.read_bytes += record.get('read_bytes') or 0
+        self.write_bytes += record.get('write_bytes') or 0
+        if record.get('media_seconds') and record.get('speed'):
+            self.media_seconds += record['media_seconds']
+            self.encode_seconds += record['wall_seconds']
+        if record.get('recording'):
+            self.recordings.add(record['recording'])
+
+
+def summarize(records, by='stage'):
+    """
+    Aggregate the stage records
+    :param by: 'stage' or 'series'
+    :return: OrderedDict of key => _Summary
+    """
+    records = [r for r in records if r.get('type') == 'stage']
+    # Stages which finish before the metadata is known have no series, so take it from the rest of the recording
+    series = {}
+    for r in records:
+        if r.get('series') and r.get('recording'):
+            series[r['recording']] = r['series']
+    summaries = {}
+    for r in records:
+        if by == 'series':
+            key = r.get('series') or series.get(r.get('recording')) or '(unknown)'
+        else:
+            key = r['stage']
+        summaries.setdefault(key, _Summary()).add(r)
+    return OrderedDict(sorted(summaries.items(), key=lambda item: -item[1].wall_seconds))
+
+
+def _format_bytes(count):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if count < 1024:
+            return '{:.1f}{}'.format(count, unit)
+        count /= 1024
+    return '{:.1f}TiB'.format(count)
+
+
+def print_report(jsonl_file, by='stage'):
+    summaries = summarize(read_records(jsonl_file), by)
+    row = '{:<30} {:>6} {:>6} {:>8} {:>12} {:>10} {:>12} {:>10} {:>10} {:>7}'
+    print(row.format(by, 'runs', 'failed', 'files', 'wall (s)', 'mean (s)', 'cpu (s)', 'max rss', 'read',
+                     'speed'))
+    for key, s in summaries.items():
+        speed = '{:.2f}x'.format(s.media_seconds / s.encode_seconds) if s.encode_seconds else ''
+        print(row.format(str(key)[:30], s.runs, s.failures, len(s.recordings), '{:.1f}'.format(s.wall_seconds),
+                         '{:.1f}'.format(s.wall_seconds / s.runs), '{:.1f}'.format(s.cpu_seconds),
+                         _format_bytes(s.max_rss_bytes), _format_bytes(s.read_bytes), speed))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        if '--by' in sys.argv[:-1]:
+            print_report(sys.argv[1], sys.argv[sys.argv.index('--by') + 1])
+        else:
+            print_report(sys.argv[1], 'stage')
+            print()
+            print_report(sys.argv[1], 'series')
+    else:
+        print('Too few args')
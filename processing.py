@@ -1,16 +1,37 @@
-import xml.etree.ElementTree as ET
-from wtv import extract_metadata, extract_original_air_date
+import contextvars
+import functools
+import hashlib
+import json
+from wtv import extract_metadata, extract_original_air_date, extract_duration, ORIGINAL_BROADCAST_DATE_KEY, \
+    DURATION_KEY
 import tvdb_api
 import os
 import sys
 import subprocess
 import logging
-import pysrt
-from copy import copy
 import configparser
 import datetime
 from wtv_db import WtvDb
+from stages import StageGraph, in_executor
+from subtitles import split_subtitles
+import intervals
+import streams
 import glob
+import multiprocessing
+import shutil
+import threading
+import queue
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from watcher import Watcher
+from metrics import Metrics
+from spool import SpoolManager, SpoolFull
+from scheduler import Scheduler, JobEstimate, format_seconds
+from resources import Resources, ResourceClass
+import itertools
+from logging.handlers import QueueHandler, QueueListener
 from string import Template
 
 logging.basicConfig(filename='status.log', level=logging.DEBUG,
@@ -20,8 +41,9 @@ exe_logger = logging.getLogger('executable-logger')
 
 # Configuration
 configparser = configparser.ConfigParser()
-if len(sys.argv) > 1:
-    configparser.read(sys.argv[1])
+_config_args = [a for a in sys.argv[1:] if not a.startswith('--')]
+if len(_config_args) > 0:
+    configparser.read(_config_args[0])
 else:
     configparser.read('config.ini')
 
@@ -42,16 +64,86 @@ FFPROBE_EXE = configparser.get('ffprobe', 'executable')
 FFMPEG_PRESET = configparser.get('ffmpeg', 'h264.preset')
 # H.264 Constant Rate Factor (https://trac.ffmpeg.org/wiki/Encode/H.264#crf)
 FFMPEG_CRF = configparser.get('ffmpeg', 'h264.crf')
+# How commercials are cut: 'smartcut' (copy between keyframes), 'parallel' (concurrent chunk encodes), 'filter'
+# (single pass) or 'segments' (temp file per segment + concat)
+ENCODE_MODE = configparser.get('ffmpeg', 'encode.mode', fallback='filter')
+# Parallel mode: number of concurrent ffmpeg jobs, ffmpeg threads per job (0 is automatic) and the longest chunk
+PARALLEL_JOBS = configparser.getint('ffmpeg', 'parallel.jobs', fallback=max(1, (os.cpu_count() or 2) // 2))
+PARALLEL_THREADS = configparser.getint('ffmpeg', 'parallel.threads', fallback=0)
+PARALLEL_CHUNK_SECONDS = configparser.getfloat('ffmpeg', 'parallel.chunk.seconds', fallback=300)
+# Streams in these codecs are copied instead of transcoded, empty to always transcode
+COPY_VIDEO_CODECS = tuple(c.strip() for c in configparser.get('ffmpeg', 'copy.video.codecs',
+                                                              fallback='h264').split(',') if c.strip())
+COPY_AUDIO_CODECS = tuple(c.strip() for c in configparser.get('ffmpeg', 'copy.audio.codecs',
+                                                              fallback='aac, ac3').split(',') if c.strip())
+# Keep every audio track ('all') or only the first ('first')
+AUDIO_TRACKS = configparser.get('ffmpeg', 'audio.tracks', fallback='all')
+# Also mux the cut subtitles into the mp4 as a mov_text track
+SUBTITLES_MUX = configparser.getboolean('ffmpeg', 'subtitles.mux', fallback=False)
+# Encoded segments are kept here until the output is verified, so an interrupted encode only redoes what is missing
+SEGMENT_DIR = configparser.get('ffmpeg', 'segment.dir', fallback=os.path.join(TEMP_DIR, 'segments'))
+# Seconds a segment's duration may differ from its interval, copied video may start up to a GOP early
+SEGMENT_TOLERANCE = configparser.getfloat('ffmpeg', 'segment.tolerance', fallback=2.0)
+# Kill an ffmpeg encode when its output position has not advanced for this many seconds, 0 to never kill
+FFMPEG_STALL_TIMEOUT = configparser.getfloat('ffmpeg', 'stall.timeout', fallback=300)
+# Seconds between encode progress log lines
+FFMPEG_PROGRESS_INTERVAL = configparser.getfloat('ffmpeg', 'progress.interval', fallback=30)
+# Head/tail pieces shorter than this (in seconds) are stream copied rather than re-encoded
+SMART_CUT_MIN_PIECE = configparser.getfloat('ffmpeg', 'smartcut.min.piece', fallback=0.1)
 
 # TVDB API credentials
 TVDB_USERNAME = configparser.get('tvdb', 'username')
 TVDB_USER_KEY = configparser.get('tvdb', 'userkey')
 TVDB_API_KEY = configparser.get('tvdb', 'apikey')
+# How long the episode list of a series is cached before it is refreshed
+TVDB_CACHE_TTL = datetime.timedelta(hours=configparser.getfloat('tvdb', 'cache.ttl.hours', fallback=24))
+# Connection pool size, which is also the number of concurrent page downloads
+TVDB_POOL_SIZE = configparser.getint('tvdb', 'pool.size', fallback=8)
+# Maximum TVDB requests per second
+TVDB_RATE_LIMIT = configparser.getfloat('tvdb', 'rate.limit', fallback=10)
+# Number of retries with backoff on connection errors and 429/5xx responses
+TVDB_RETRIES = configparser.getint('tvdb', 'retries', fallback=5)
+# Only use the TVDB data already in the database and never log in
+TVDB_OFFLINE = configparser.getboolean('tvdb', 'offline', fallback=False)
 
 NICE_EXE = configparser.get('nice', 'executable')
+# Run the processes of stages without a resource class with nice
 USE_NICE = configparser.getboolean('nice', 'enabled', fallback=False)
 
+# Resource classes, one [resources.<name>] section each: concurrency limit, nice, ionice, CPU affinity & ffmpeg threads
+RESOURCE_CLASSES = [ResourceClass(section[len('resources.'):],
+                                  concurrency=configparser.getint(section, 'concurrency', fallback=0),
+                                  nice=configparser.getint(section, 'nice', fallback=None),
+                                  ionice_class=configparser.get(section, 'ionice.class', fallback=None),
+                                  ionice_level=configparser.getint(section, 'ionice.level', fallback=None),
+                                  affinity=configparser.get(section, 'affinity', fallback=None) or None,
+                                  threads=configparser.getint(section, 'threads', fallback=0))
+                    for section in configparser.sections() if section.startswith('resources.')]
+# The class of each stage, stage.<stage> = <name>
+RESOURCE_STAGES = {key[len('stage.'):]: value for key, value in configparser.items('resources')
+                   if key.startswith('stage.')} if configparser.has_section('resources') else {}
+IONICE_EXE = configparser.get('resources', 'ionice.executable', fallback='ionice')
+TASKSET_EXE = configparser.get('resources', 'taskset.executable', fallback='taskset')
+
 DEBUG = configparser.getboolean('main', 'debug', fallback=False)
+# Number of worker processes
+WORKERS = configparser.getint('main', 'workers', fallback=1)
+# Recordings each worker handles at once, by default one for every slot of the resource classes
+RECORDINGS = configparser.getint('main', 'recordings', fallback=0) or max(1, sum(max(1, c.concurrency)
+                                                                                  for c in RESOURCE_CLASSES))
+
+# Order of the recordings: 'shortest' (least estimated encode time), 'oldest', 'priority' (the series listed in
+# priority first, then shortest) or 'name'
+SCHEDULER_POLICY = configparser.get('scheduler', 'policy', fallback='shortest')
+# One series per line, most important first
+SCHEDULER_PRIORITY = [s.strip() for s in configparser.get('scheduler', 'priority', fallback='').splitlines()
+                      if s.strip()]
+# Seconds of a recording encoded per second before there is any history
+SCHEDULER_SPEED = configparser.getfloat('scheduler', 'default.speed', fallback=1.0)
+# Fraction of a recording assumed to be kept before its commercials are detected
+SCHEDULER_KEPT_FRACTION = configparser.getfloat('scheduler', 'kept.fraction', fallback=0.75)
+# Number of recent encodes of a series used for its speed
+SCHEDULER_HISTORY = configparser.getint('scheduler', 'history', fallback=20)
 
 CCEXTRACTOR_EXE = configparser.get('ccextractor', 'executable', fallback=None)
 CCEXTRACTOR_RUN = configparser.getboolean('ccextractor', 'run.if.missing', fallback=False)
@@ -59,30 +151,265 @@ CCEXTRACTOR_RUN = configparser.getboolean('ccextractor', 'run.if.missing', fallb
 COMSKIP_EXE = configparser.get('comskip', 'executable', fallback=None)
 COMSKIP_RUN = configparser.getboolean('comskip', 'run.if.missing', fallback=False)
 COMSKIP_INI = configparser.get('comskip', 'comskip.ini', fallback=None)
+# Kept segments & breaks shorter than these are cut & kept respectively, which avoids encoding slivers
+COMMERCIAL_MIN_KEEP = configparser.getfloat('comskip', 'min.keep.seconds', fallback=5)
+COMMERCIAL_MIN_BREAK = configparser.getfloat('comskip', 'min.break.seconds', fallback=5)
+# Move the cut points to the nearest keyframe within snap.tolerance seconds
+COMMERCIAL_SNAP = configparser.getboolean('comskip', 'snap.keyframes', fallback=False)
+COMMERCIAL_SNAP_TOLERANCE = configparser.getfloat('comskip', 'snap.tolerance', fallback=1.0)
+# Frame rate of .txt frame lists which have no header
+COMMERCIAL_FPS = configparser.getfloat('comskip', 'fps', fallback=intervals.DEFAULT_FPS)
+# Commercial file formats, in order of preference
+COMMERCIAL_EXTENSIONS = ('.xml', '.edl', '.txt')
 
 DB_FILE = configparser.get('main', 'database.file', fallback='db.sqlite')
 
+# Live mode: run comskip & ccextractor while a recording is still being written (requires --watch)
+LIVE_ENABLED = configparser.getboolean('live', 'enabled', fallback=False)
+# Seconds without new data before the live tools consider the recording finished
+LIVE_IDLE = configparser.getint('live', 'idle.seconds', fallback=10)
+# Maximum seconds to wait for the live tools after the recording is complete
+LIVE_TIMEOUT = configparser.getint('live', 'finish.timeout', fallback=300)
+
+# Spool mode: read each recording once, feeding ccextractor through a pipe while writing a local copy which comskip
+# and the encoder read
+SPOOL_ENABLED = configparser.getboolean('spool', 'enabled', fallback=False)
+SPOOL_DIR = configparser.get('spool', 'dir', fallback=TEMP_DIR)
+SPOOL_CHUNK_SIZE = configparser.getint('spool', 'chunk.size.mb', fallback=4) * 1024 * 1024
+# Temporary space: working directories go on the RAM disk if one is set and they fit, otherwise in temp.dir
+SPOOL_RAM_DIR = configparser.get('spool', 'ram.dir', fallback=None) or None
+SPOOL_RAM_MAX = configparser.getint('spool', 'ram.max.mb', fallback=0) * 1024 * 1024
+# Space which is always left free on the temp & output volumes
+SPOOL_MIN_FREE = configparser.getint('spool', 'min.free.mb', fallback=1024) * 1024 * 1024
+# When there is not enough space: 'wait' for up to wait.timeout seconds or 'refuse' the job, which is retried later
+SPOOL_ADMISSION = configparser.get('spool', 'admission', fallback='wait')
+SPOOL_WAIT_TIMEOUT = configparser.getfloat('spool', 'wait.timeout', fallback=3600)
+# Estimated encoded size as a fraction of the kept part of the source
+SPOOL_ESTIMATE_RATIO = configparser.getfloat('spool', 'estimate.ratio', fallback=1.0)
+# Working directories older than this are removed even if their process is still alive
+SPOOL_SWEEP_MAX_AGE = configparser.getfloat('spool', 'sweep.max.age.hours', fallback=48) * 60 * 60
+
+# Watch daemon: 'inotify', 'poll' or 'auto' (inotify unless a directory is on a network mount)
+WATCH_METHOD = configparser.get('watch', 'method', fallback='auto')
+WATCH_POLL_INTERVAL = configparser.getfloat('watch', 'poll.interval', fallback=30)
+# A file is complete once it has been closed and unchanged for debounce seconds or its size is unchanged for settle
+WATCH_DEBOUNCE = configparser.getfloat('watch', 'debounce.seconds', fallback=5)
+WATCH_SETTLE = configparser.getfloat('watch', 'settle.seconds', fallback=60)
+
+# Stage & subprocess timing records as JSON lines and an optional Prometheus textfile collector file
+METRICS_FILE = configparser.get('metrics', 'jsonl.file', fallback='metrics.jsonl') or None
+METRICS_PROMETHEUS_FILE = configparser.get('metrics', 'prometheus.file', fallback=None) or None
+
+# The only metadata needed to process a recording, so the rest of the metadata is never parsed
+METADATA_KEYS = {'Title', 'WM/SubTitle', 'WM/SubTitleDescription', ORIGINAL_BROADCAST_DATE_KEY}
+
+
+def create_tvdb(wtvdb):
+    return tvdb_api.TVDB(api_key=TVDB_API_KEY, username=TVDB_USERNAME, user_key=TVDB_USER_KEY, wtvdb=wtvdb,
+                         cache_ttl=TVDB_CACHE_TTL, pool_size=TVDB_POOL_SIZE, rate_limit=TVDB_RATE_LIMIT,
+                         retries=TVDB_RETRIES, offline=TVDB_OFFLINE)
+
+
 wtvdb = WtvDb(DB_FILE)
-tvdb = tvdb_api.TVDB(api_key=TVDB_API_KEY, username=TVDB_USERNAME, user_key=TVDB_USER_KEY, wtvdb=wtvdb)
+tvdb = create_tvdb(wtvdb)
+metrics = Metrics(METRICS_FILE, METRICS_PROMETHEUS_FILE)
+spool_manager = SpoolManager(TEMP_DIR, ram_dir=SPOOL_RAM_DIR, ram_max=SPOOL_RAM_MAX, min_free=SPOOL_MIN_FREE,
+                             wait=SPOOL_ADMISSION == 'wait', wait_timeout=SPOOL_WAIT_TIMEOUT, keep=DEBUG)
+# The recordings in flight at once, for the ETA
+scheduler = Scheduler(SCHEDULER_POLICY, SCHEDULER_PRIORITY, WORKERS * RECORDINGS,
+                      history=lambda series: wtvdb.encode_speed(series, SCHEDULER_HISTORY),
+                      default_speed=SCHEDULER_SPEED, default_kept_fraction=SCHEDULER_KEPT_FRACTION)
+resources = Resources(RESOURCE_CLASSES, RESOURCE_STAGES, nice_exe=NICE_EXE, ionice_exe=IONICE_EXE,
+                      taskset_exe=TASKSET_EXE, default_nice=USE_NICE)
 
 
-def execute(args):
-    if USE_NICE:
-        a = [NICE_EXE]
-        a.extend(args)
-        args = a
+def _command(args, stage=None):
+    args = resources.command(args, stage)
     logger.debug('Executing: {}'.format(args))
+    return args
+
+
+# Number of output lines of a process kept for the error report if it fails
+OUTPUT_TAIL_LINES = 50
+# Longest line logged at once, longer lines are split
+MAX_LINE_BYTES = 64 * 1024
+# Progress lines end with carriage returns instead of new lines
+_LINE_BREAK = re.compile(b'[\r\n]')
+
+
+def _pump(stream, handle):
+    """
+    Read a stream until it closes, calling handle with each decoded line
+    """
+    pending = b''
+    for chunk in iter(lambda: stream.read1(MAX_LINE_BYTES), b''):
+        lines = _LINE_BREAK.split(pending + chunk)
+        pending = lines.pop()
+        if len(pending) >= MAX_LINE_BYTES:
+            lines.append(pending)
+            pending = b''
+        for line in lines:
+            if line:
+                handle(line.decode('utf-8', errors='replace'))
+    if pending:
+        handle(pending.decode('utf-8', errors='replace'))
+
+
+class FfmpegProgress():
+    """
+    Parses the output of ffmpeg -progress and logs the fps, speed and ETA of the encode
+    """
+
+    def __init__(self, name, media_seconds=None):
+        """
+        :param media_seconds: duration of the output, used for the percentage & ETA
+        """
+        self.name = name
+        self.media_seconds = media_seconds
+        self.position = 0.0
+        self.fps = None
+        self.speed = None
+        # When the position last moved, to detect a stalled encode
+        self.advanced = time.monotonic()
+        self._block = {}
+        self._logged = time.monotonic()
+
+    def line(self, line):
+        key, sep, value = line.partition('=')
+        if not sep:
+            exe_logger.debug(line)
+            return
+        self._block[key.strip()] = value.strip()
+        if key == 'progress':
+            self._update(self._block)
+            self._block = {}
+
+    def _update(self, block):
+        try:
+            # out_time_ms is in microseconds despite the name
+            position = int(block.get('out_time_us', block.get('out_time_ms', 0))) / 1000000
+            self.fps = float(block['fps']) if 'fps' in block else self.fps
+            speed = block.get('speed', 'N/A').rstrip('x')
+            self.speed = float(speed) if speed not in ('N/A', '') else self.speed
+        except ValueError:
+            return
+        if position > self.position:
+            self.position = position
+            self.advanced = time.monotonic()
+        now = time.monotonic()
+        if block.get('progress') == 'end' or now - self._logged >= FFMPEG_PROGRESS_INTERVAL:
+            self._logged = now
+            logger.info(self.status())
+
+    def eta(self):
+        """
+        :return: estimated seconds until the encode is done or None if unknown
+        """
+        if not self.media_seconds or not self.speed:
+            return None
+        return max(0.0, self.media_seconds - self.position) / self.speed
+
+    def status(self):
+        status = 'Encoding {}: {:.0f}s'.format(os.path.basename(self.name), self.position)
+        if self.media_seconds:
+            status += ' of {:.0f}s ({:.0%})'.format(self.media_seconds, min(1.0, self.position / self.media_seconds))
+        if self.fps is not None:
+            status += ', {:.1f} fps'.format(self.fps)
+        if self.speed is not None:
+            status += ', {:.2f}x'.format(self.speed)
+        eta = self.eta()
+        if eta is not None:
+            status += ', ETA {}'.format(datetime.timedelta(seconds=int(eta)))
+        return status
+
+
+def execute(args, stage=None, progress=None, stall_timeout=None):
+    """
+    Run a process to completion, streaming its output into the log line by line, and record its timing & resource
+    usage. The last lines are logged as an error if the process fails.
+    :param stage: the stage to attribute the process to, defaults to the stage running on this thread
+    :param progress: optional FfmpegProgress which receives the stdout lines
+    :param stall_timeout: kill the process if the progress position, or without progress the output, has not moved
+                          for this many seconds
+    :return: the return code
+    """
+    name = os.path.basename(args[0])
+    stage = stage if stage is not None else metrics.current_stage()
+    args = _command(args, stage)
     p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    if stdout:
-        exe_logger.info(stdout)
-    if stderr:
-        exe_logger.error(stderr)
-    return p.wait()
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    activity = [time.monotonic()]
+
+    def output(line):
+        activity[0] = time.monotonic()
+        tail.append(line)
+        exe_logger.debug(line)
+
+    # Drain the pipes in threads, since the process must be reaped by metrics to get its resource usage
+    readers = [threading.Thread(target=_pump, args=(p.stdout, progress.line if progress else output), daemon=True),
+               threading.Thread(target=_pump, args=(p.stderr, output), daemon=True)]
+    for reader in readers:
+        reader.start()
+    stalled = False
+    while True:
+        try:
+            ret = metrics.wait(p, stage=stage, timeout=5 if stall_timeout else None)
+            break
+        except subprocess.TimeoutExpired:
+            last = progress.advanced if progress else activity[0]
+            if not stalled and time.monotonic() - last > stall_timeout:
+                logger.error('No progress for {} seconds, killing: {}'.format(stall_timeout, args))
+                stalled = True
+                p.kill()
+    for reader in readers:
+        reader.join()
+    p.stdout.close()
+    p.stderr.close()
+    if ret != 0:
+        exe_logger.error('{} exited with {}{}:\n{}'.format(name, ret, ' after stalling' if stalled else '',
+                                                           '\n'.join(tail)))
+    return ret
+
+
+def execute_ffmpeg(args, media_seconds=None, stage=None):
+    """
+    Run ffmpeg with progress reporting, killing it if it stalls
+    :param media_seconds: duration of the output if known, for the ETA
+    """
+    progress = FfmpegProgress(args[-1], media_seconds)
+    threads = resources.threads(stage if stage is not None else metrics.current_stage())
+    if threads:
+        args = _with_threads(args, threads)
+    args = [args[0], '-progress', 'pipe:1', '-nostats'] + args[1:]
+    return execute(args, stage=stage, progress=progress, stall_timeout=FFMPEG_STALL_TIMEOUT or None)
+
+
+def _with_threads(args, threads):
+    # Every option of the commands run here takes a value, so the outputs are neither an option nor its value
+    result = [args[0]]
+    has_threads = False
+    i = 1
+    while i < len(args):
+        if str(args[i]).startswith('-'):
+            has_threads = has_threads or args[i] == '-threads'
+            result.extend(args[i:i + 2])
+            i += 2
+            continue
+        if not has_threads:
+            result.extend(['-threads', str(threads)])
+        result.append(args[i])
+        has_threads = False
+        i += 1
+    return result
+
+
+async def execute_async(args, stage=None):
+    # Coroutines share the event loop thread, so the stage cannot be found from the thread
+    return await in_executor(execute, args, stage)
 
 
 def get_metadata(wtv_file):
-    metadata = extract_metadata(wtv_file)
+    metadata = extract_metadata(wtv_file, keys=METADATA_KEYS)
     series = metadata.get('Title', None)
     episode_name = metadata.get('WM/SubTitle', None)
 
@@ -97,14 +424,14 @@ def get_metadata(wtv_file):
     elif series is not None:
         # Get season & episode number
         air_date = extract_original_air_date(wtv_file, parse_from_filename=True, metadata=metadata)
-        episodes = tvdb.find_episode(series, episode=episode_name, air_date=air_date)
-        if len(episodes) == 1:
-            season, episode_num = tvdb_api.TVDB.season_number(episodes[0])
-            if episode_name is None and episodes[0]['episodeName'] is not None:
-                episode_name = episodes[0]['episodeName']
+        found, candidates = tvdb.find_episode(series, episode=episode_name, air_date=air_date)
+        if found is not None:
+            season, episode_num = tvdb_api.TVDB.season_number(found)
+            if episode_name is None and found['episodeName'] is not None:
+                episode_name = found['episodeName']
         else:
             # Handle multiple options
-            wtvdb.store_candidates(tvdb, filename, metadata, episodes)
+            wtvdb.store_candidates(tvdb, filename, metadata, candidates)
             season = None
             episode_num = None
     else:
@@ -115,196 +442,1176 @@ def get_metadata(wtv_file):
     return series, episode_name, season, episode_num
 
 
-def process(wtv_file, com_file, srt_file):
-    # Ensure TVDB client is authenticated
-    tvdb.refresh()
-
-    series, episode_name, season, episode_num = get_metadata(wtv_file)
-    if series is not None and season is not None and episode_num is not None:
-        filename = os.path.basename(wtv_file)
-        filename_wo_ext = os.path.splitext(filename)[0]
-        out_video = os.path.join(OUT_DIR,
-                                 create_filename(series, season, episode_num, episode_name, filename_wo_ext, 'mp4'))
-        out_srt = os.path.join(OUT_DIR,
-                               create_filename(series, season, episode_num, episode_name, filename_wo_ext, 'eng.srt'))
-
-        if not os.path.exists(os.path.dirname(out_video)):
-            os.makedirs(os.path.dirname(out_video))
-        if not os.path.exists(os.path.dirname(out_srt)):
-            os.makedirs(os.path.dirname(out_srt))
-
-        commercials = parse_commercial_file(com_file)
-        split_subtitles(srt_file, invert_commercial(commercials), out_srt)
-        successful = convert(wtv_file, out_video, commercials)
-        if successful:
-            # If we finished with the WTV, delete it
-            if wtvdb.get_wtv(filename) is not None:
-                wtvdb.delete_wtv(filename)
-            if not DEBUG and DELETE_SOURCE:
-                os.remove(wtv_file)
-                os.remove(com_file)
-                os.remove(srt_file)
-            logger.info('Completed {} => {}'.format(wtv_file, out_video))
+def _has_metadata(metadata):
+    series, episode_name, season, episode_num = metadata
+    return series is not None and season is not None and episode_num is not None
+
+
+def _output_file(wtv_file, metadata, extension):
+    series, episode_name, season, episode_num = metadata
+    filename_wo_ext = os.path.splitext(os.path.basename(wtv_file))[0]
+    out_file = os.path.join(OUT_DIR,
+                            create_filename(series, season, episode_num, episode_name, filename_wo_ext, extension))
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    return out_file
+
+
+def process(wtv_file, com_file, srt_file, job):
+    """
+    Run the stages for a single recording.
+
+    Comskip, ccextractor and the metadata lookup run concurrently. Encoding starts once the commercials and metadata
+    are available and the subtitles are cut once ccextractor has finished too. Stages already completed by the job
+    are skipped.
+    :return: True if the commercial & srt files were available and the recording was processed
+    """
+    filename = os.path.basename(wtv_file)
+    metrics.begin(recording=filename)
+    # Time a stage only once it holds a slot of its resource class
+    graph = StageGraph(wrapper=lambda name, func: resources.limit(name, metrics.timed(name, func)))
+    spools = []
+
+    def spool():
+        run_comskip = COMSKIP_RUN and find_commercial_file(com_file) is None
+        run_ccextractor = CCEXTRACTOR_RUN and not os.path.isfile(srt_file)
+        if not SPOOL_ENABLED or not (run_comskip or run_ccextractor):
+            return None
+        try:
+            s = SourceSpool(wtv_file, com_file, srt_file)
+        except SpoolFull as e:
+            logger.warn('Not spooling {}: {}'.format(wtv_file, e))
+            return None
+        spools.append(s)
+        return s.run(run_comskip, run_ccextractor)
+
+    async def comskip(spool):
+        if spool:
+            await in_executor(SourceSpool.wait, spool.comskip, 'comskip')
+        elif find_commercial_file(com_file) is None and COMSKIP_RUN:
+            logger.debug('No commercial file for {}. Running comskip'.format(wtv_file))
+            await run_comskip(wtv_file, os.path.dirname(com_file))
+        found = find_commercial_file(com_file) is not None
+        if found and not job.detected:
+            wtvdb.update_job(job, detected=True)
+        return found
+
+    async def ccextractor(spool):
+        if spool:
+            await in_executor(SourceSpool.wait, spool.ccextractor, 'ccextractor')
+        elif not os.path.isfile(srt_file) and CCEXTRACTOR_RUN:
+            logger.debug('No srt file for {}. Running ccextractor'.format(wtv_file))
+            await extract_subtitles(wtv_file, srt_file)
+        found = os.path.isfile(srt_file)
+        if found and not job.subtitles_extracted:
+            wtvdb.update_job(job, subtitles_extracted=True)
+        return found
+
+    def metadata():
+        if job.metadata_resolved:
+            metrics.label(series=job.series)
+            return job.episode_info()
+        result = get_metadata(wtv_file)
+        metrics.label(series=result[0])
+        if _has_metadata(result):
+            series, episode_name, season, episode_num = result
+            wtvdb.update_job(job, metadata_resolved=True, series=series, episode_name=episode_name, season=season,
+                             episode_num=episode_num)
+        return result
+
+    def cuts(spool, comskip):
+        if not comskip:
+            return None
+        return parse_commercial_file(find_commercial_file(com_file), spool.path if spool else wtv_file)
+
+    def encode(spool, cuts, metadata, subtitles=None):
+        if cuts is None or not _has_metadata(metadata):
+            return None
+        out_video = _output_file(wtv_file, metadata, 'mp4')
+        source = spool.path if spool else wtv_file
+        if job.encoded and job.out_video == out_video and os.path.isfile(out_video):
+            if verify_output(out_video, source, invert_commercial(cuts)):
+                logger.debug('Already encoded {}'.format(out_video))
+                return out_video
+            logger.warn('{} is incomplete, encoding it again'.format(out_video))
+        started = time.monotonic()
+        if convert(source, out_video, cuts, subtitles):
+            elapsed = time.monotonic() - started
+            # For the scheduler's estimate of the next recording of this series
+            kept = kept_seconds(invert_commercial(cuts), analyze(source)['duration'])
+            with wtvdb.batch():
+                wtvdb.update_job(job, encoded=True, out_video=out_video)
+                if kept:
+                    wtvdb.record_encode(metadata[0], kept, elapsed)
+            if metrics.enabled:
+                metrics.annotate(media_seconds=duration(out_video))
+            return out_video
+        return None
+
+    def subtitles(cuts, ccextractor, metadata):
+        if cuts is None or not ccextractor or not _has_metadata(metadata):
+            return None
+        out_srt = _output_file(wtv_file, metadata, 'eng.srt')
+        if job.subtitles_cut and job.out_srt == out_srt and os.path.isfile(out_srt):
+            return out_srt
+        split_subtitles(srt_file, invert_commercial(cuts), out_srt)
+        wtvdb.update_job(job, subtitles_cut=True, out_srt=out_srt)
+        return out_srt
+
+    def finalize(comskip, ccextractor, metadata, encode, subtitles):
+        if not comskip or not ccextractor:
+            logger.warn('No commercial or srt file for {}...skipping'.format(wtv_file))
+            return False
+        if not _has_metadata(metadata):
+            series, episode_name, season, episode_num = metadata
+            logger.warn(
+                'Missing data for {}: series={}, episode_name={}, season={}, episode_num={}'.format(wtv_file, series,
+                                                                                                    episode_name,
+                                                                                                    season,
+                                                                                                    episode_num))
+        elif encode and subtitles:
+            # The candidates are only dropped if the job is finalized too
+            with wtvdb.batch():
+                # If we finished with the WTV, delete it
+                if wtvdb.get_wtv(filename) is not None:
+                    wtvdb.delete_wtv(filename)
+                if not DEBUG and DELETE_SOURCE:
+                    os.remove(wtv_file)
+                    os.remove(find_commercial_file(com_file))
+                    os.remove(srt_file)
+                wtvdb.update_job(job, finalized=True)
+            logger.info('Completed {} => {}'.format(wtv_file, encode))
         else:
             logger.warn('Failure to convert {}'.format(wtv_file))
-    else:
-        logger.warn(
-            'Missing data for {}: series={}, episode_name={}, season={}, episode_num={}'.format(wtv_file, series,
-                                                                                                episode_name, season,
-                                                                                                episode_num))
+        return True
 
+    graph.add('spool', spool, blocking=True)
+    graph.add('comskip', comskip, depends=('spool',))
+    graph.add('ccextractor', ccextractor, depends=('spool',))
+    graph.add('metadata', metadata, blocking=True)
+    graph.add('cuts', cuts, depends=('spool', 'comskip'), blocking=True)
+    # Muxing the subtitles means they are cut before the encode instead of alongside it
+    graph.add('encode', encode, depends=('spool', 'cuts', 'metadata') + (('subtitles',) if SUBTITLES_MUX else ()),
+              blocking=True)
+    graph.add('subtitles', subtitles, depends=('cuts', 'ccextractor', 'metadata'), blocking=True)
+    graph.add('finalize', finalize, depends=('comskip', 'ccextractor', 'metadata', 'encode', 'subtitles'),
+              blocking=True)
+    try:
+        return graph.run()['finalize']
+    finally:
+        for s in spools:
+            s.cleanup()
 
-def extract_subtitles(wtv_file, out_srt):
-    execute([CCEXTRACTOR_EXE, wtv_file, '-o', out_srt])
 
+async def extract_subtitles(wtv_file, out_srt):
+    await execute_async([CCEXTRACTOR_EXE, wtv_file, '-o', out_srt], stage='ccextractor')
 
-def run_comskip(wtv_file, out_dir):
+
+async def run_comskip(wtv_file, out_dir):
     if COMSKIP_INI:
-        execute([COMSKIP_EXE, '--ini=' + COMSKIP_INI, '--output=' + out_dir, wtv_file])
+        await execute_async([COMSKIP_EXE, '--ini=' + COMSKIP_INI, '--output=' + out_dir, wtv_file], stage='comskip')
     else:
-        execute([COMSKIP_EXE, '--output=' + out_dir, wtv_file])
+        await execute_async([COMSKIP_EXE, '--output=' + out_dir, wtv_file], stage='comskip')
+
+
+def find_commercial_file(com_file):
+    """
+    :param com_file: the comskip XML file of a recording
+    :return: its XML, EDL or .txt commercial file or None if there are none
+    """
+    wo_ext = os.path.splitext(com_file)[0]
+    for ext in COMMERCIAL_EXTENSIONS:
+        if os.path.isfile(wo_ext + ext):
+            return wo_ext + ext
+    return None
 
 
-def parse_commercial_file(com_file):
-    tree = ET.parse(com_file)
-    root = tree.getroot()
-    commercials = []
-    for child in root:
-        commercials.append((float(child.get('start')), float(child.get('end'))))
+def parse_commercial_file(com_file, in_file=None):
+    """
+    Read & normalize the commercial breaks
+    :param in_file: the recording, to clamp the breaks to its duration and snap them to its keyframes
+    :return: sorted list of (start, end) where end is None for a break which runs to the end
+    """
+    total = analyze(in_file)['duration'] if in_file else None
+    commercials = intervals.normalize(intervals.read_breaks(com_file, COMMERCIAL_FPS), total,
+                                      min_keep=COMMERCIAL_MIN_KEEP, min_break=COMMERCIAL_MIN_BREAK)
+    if in_file and COMMERCIAL_SNAP:
+        commercials = intervals.snap(commercials, keyframes(in_file), COMMERCIAL_SNAP_TOLERANCE)
     return commercials
 
 
 def invert_commercial(commercials):
-    inverse = [(0, commercials[0][0])]
-    for i in range(len(commercials) - 1):
-        left = commercials[i]
-        right = commercials[i + 1]
-        inverse.append((left[1], right[0]))
-    if len(commercials) > 1:
-        inverse.append((commercials[len(commercials) - 1][1], None))
-    return inverse
-
-
-def to_time(c):
-    c = float(c)
-    hours = int(c / (60 * 60))
-    minutes = int(c / 60)
-    if c >= 0:
-        seconds = int(c % 60)
-    else:
-        seconds = -int(-c % 60)
-    milliseconds = int((c - int(c)) * 1000)
-    return {'hours': hours, 'minutes': minutes, 'seconds': seconds, 'milliseconds': milliseconds}
-
-
-def split_subtitles(srt_file, invert_commercials, out_file):
-    subs = pysrt.open(srt_file)
-    parts = []
-    prev = 0.0
-    shift = 0
-    for c in invert_commercials:
-        shift = shift - float(c[0]) + prev
-        s = []
-        for i in subs.data:
-            if i.start >= to_time(c[0]) and (c[1] is None or i.start < to_time(c[1])):
-                temp = copy(i)
-                time = to_time(shift)
-                temp.shift(hours=time['hours'], minutes=time['minutes'], seconds=time['seconds'],
-                           milliseconds=time['milliseconds'])
-                parts.append(temp)
-            else:
-                pass
-            prev = c[1] if c[1] is not None else -1
-    subs = pysrt.SubRipFile(items=parts)
-    subs.save(out_file)
+    return intervals.invert(commercials)
 
 
-def cut_args(invert_com, out_name):
+def kept_seconds(invert, total=None):
+    """
+    :param total: duration of the source, for a segment which runs to the end of the file
+    :return: total duration of the kept segments or None if it depends on an unknown total
+    """
+    kept = 0
+    for start, end in invert:
+        if end is None:
+            if not total:
+                return None
+            end = total
+        kept += max(0, end - start)
+    return kept
+
+
+def cut_args(invert_com, out_name, plan):
     # -ss 0 -t 10 -c:v libx264 -preset ultrafast -crf 18 -c:a aac -strict -2 0.mp4
     args = ['-ss', str(invert_com[0])]
     if invert_com[1]:
         args.extend(['-to', str(invert_com[1])])
-    args.extend(['-c:v', 'libx264', '-preset', FFMPEG_PRESET, '-crf', FFMPEG_CRF, '-c:a', 'aac', '-strict', '-2'])
+    args.extend(plan.map_args())
+    args.extend(plan.codec_args(_video_args()))
     args.append(out_name)
     return args
 
 
-def convert(in_file, out_file, commercials):
+def _video_args():
+    return ['-c:v', 'libx264', '-preset', FFMPEG_PRESET, '-crf', FFMPEG_CRF]
+
+
+def _subtitle_input_args(srt_file, input):
+    # The input & output args to mux srt_file as mov_text, input is its index among the ffmpeg inputs
+    if not srt_file:
+        return [], []
+    return ['-i', srt_file], ['-map', '{}:0'.format(input), '-c:s', 'mov_text', '-metadata:s:s:0', 'language=eng']
+
+
+def analyze(file):
+    """
+    Run ffprobe on a recording once and cache the streams it found
+    :return: see streams.parse_probe
+    """
+    name, size = os.path.basename(file), os.path.getsize(file)
+    analysis = wtvdb.get_stream_analysis(name, size)
+    if analysis is None:
+        # ffprobe -v quiet -show_streams -show_format -of json in.wtv
+        analysis = streams.parse_probe(_probe(['-show_streams', '-show_format', '-of', 'json', file]))
+        wtvdb.store_stream_analysis(name, size, analysis)
+    return analysis
+
+
+def stream_plan(file):
+    return streams.plan(analyze(file), video_codecs=COPY_VIDEO_CODECS, audio_codecs=COPY_AUDIO_CODECS,
+                        all_audio=AUDIO_TRACKS == 'all')
+
+
+def cut_filter(invert, plan):
+    """
+    Build a filter graph which trims each kept segment from the video & audio streams and concatenates them
+    """
+    n = len(invert)
+    video = '0:{}'.format(plan.video.stream['index'])
+    audio = ['0:{}'.format(a.stream['index']) for a in plan.audio]
+    filters = ['[{}]split={}{}'.format(video, n, ''.join('[vin{}]'.format(i) for i in range(n)))]
+    for j, a in enumerate(audio):
+        filters.append('[{}]asplit={}{}'.format(a, n, ''.join('[ain{}_{}]'.format(j, i) for i in range(n))))
+    for i, (start, end) in enumerate(invert):
+        trim = 'start={}'.format(start)
+        if end:
+            trim += ':end={}'.format(end)
+        filters.append('[vin{0}]trim={1},setpts=PTS-STARTPTS[v{0}]'.format(i, trim))
+        for j in range(len(audio)):
+            filters.append('[ain{0}_{1}]atrim={2},asetpts=PTS-STARTPTS[a{0}_{1}]'.format(j, i, trim))
+    inputs = ''.join('[v{0}]'.format(i) + ''.join('[a{}_{}]'.format(j, i) for j in range(len(audio))) for i in range(n))
+    outputs = '[outv]' + ''.join('[outa{}]'.format(j) for j in range(len(audio)))
+    filters.append('{}concat=n={}:v=1:a={}{}'.format(inputs, n, len(audio), outputs))
+    return ';'.join(filters)
+
+
+def _convert_filter(in_file, out_file, invert, plan, srt_file=None):
+    if plan.video is None:
+        logger.error('No video stream in {}'.format(in_file))
+        return False
+    if os.path.isfile(out_file):
+        os.remove(out_file)
+    srt_input, srt_output = _subtitle_input_args(srt_file, 1)
+    args = [FFMPEG_EXE, '-i', in_file] + srt_input + ['-filter_complex', cut_filter(invert, plan), '-map', '[outv]']
+    for j in range(len(plan.audio)):
+        args.extend(['-map', '[outa{}]'.format(j)])
+    # Filtered streams are always encoded
+    args.extend(plan.codec_args(_video_args(), copy_video=False, copy_audio=False))
+    args.extend(srt_output)
+    args.append(out_file)
+    ret = execute_ffmpeg(args, kept_seconds(invert, analyze(in_file)['duration']))
+    if ret != 0:
+        logger.error('Nonzero return code from ffmpeg: {}'.format(ret))
+    return ret == 0
+
+
+def _concat(file_list, out_file, plan, media_seconds, srt_file=None, from_ts=True):
+    # Join the pieces without encoding them again. MPEG-TS pieces (from_ts) have AAC audio which needs converting.
+    if os.path.isfile(out_file):
+        os.remove(out_file)
+    srt_input, srt_output = _subtitle_input_args(srt_file, 1)
+    # ffmpeg -f concat -i mylist.txt -c copy output
+    args = [FFMPEG_EXE, '-safe', '0', '-f', 'concat', '-i', file_list] + srt_input + ['-map', '0', '-c', 'copy']
+    if from_ts:
+        args.extend(plan.bitstream_args())
+    args.extend(srt_output)
+    args.append(out_file)
+    ret = execute_ffmpeg(args, media_seconds)
+    if ret != 0:
+        logger.error('Nonzero return code from ffmpeg: {}'.format(ret))
+    return ret == 0
+
+
+def _source_key(in_file):
+    # The spooled copy has the same name & size as the recording, so they share segments
+    identity = json.dumps([os.path.basename(in_file), os.path.getsize(in_file)])
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+
+def segment_file(work_dir, piece, settings, ext):
+    """
+    :param work_dir: the segment directory of the source, see _reserve
+    :param piece: (start, end, ...) of the segment
+    :param settings: everything besides the interval which changes the output, such as the ffmpeg arguments
+    :return: the content addressed path of the segment
+    """
+    key = hashlib.sha1(json.dumps([piece, settings]).encode('utf-8')).hexdigest()
+    # The concat list resolves relative paths from its own directory
+    return os.path.abspath(os.path.join(work_dir, key + ext))
+
+
+def remove_segments(in_file):
+    spool_manager.remove(_source_key(in_file), SEGMENT_DIR)
+
+
+def verify_duration(file, expected, tolerance):
+    """
+    :param expected: the expected duration in seconds or None if unknown
+    :return: True if file exists and its duration is within tolerance seconds of expected
+    """
+    if not os.path.isfile(file) or os.path.getsize(file) == 0:
+        return False
+    actual = duration(file)
+    if expected is None:
+        return actual > 0
+    if abs(actual - expected) > tolerance:
+        logger.warn('{} is {:.2f} seconds long instead of {:.2f}'.format(file, actual, expected))
+        return False
+    return True
+
+
+def verify_output(out_file, in_file, invert):
+    """
+    Check the output is as long as the kept segments of the source, before the source may be deleted
+    """
+    expected = kept_seconds(invert, analyze(in_file)['duration'])
+    return verify_duration(out_file, expected, SEGMENT_TOLERANCE * len(invert))
+
+
+def encode_segments(in_file, work_dir, pieces, settings, ext, encode, total=None):
+    """
+    Encode each piece into its own segment file, skipping the pieces with a valid segment from an earlier attempt.
+    Segments are written under a temporary name and only moved into place once their duration has been checked.
+    :param work_dir: the segment directory of in_file
+    :param pieces: list of (start, end, ...) where end is None for the end of the file
+    :param encode: function given a list of (piece, file) to encode, returning a list of their ffmpeg return codes
+                   with None for any which were not run
+    :param total: duration of in_file, to check segments which run to the end
+    :return: list of the segment files or None if any failed
+    """
+    files = [segment_file(work_dir, piece, settings, ext) for piece in pieces]
+    expected = []
+    for piece in pieces:
+        stop = piece[1] if piece[1] is not None else total
+        expected.append(stop - piece[0] if stop else None)
+    missing = []
+    for piece, file, length in zip(pieces, files, expected):
+        if os.path.isfile(file):
+            if verify_duration(file, length, SEGMENT_TOLERANCE):
+                continue
+            os.remove(file)
+        missing.append((piece, file, length))
+    if not missing:
+        logger.info('All {} segments of {} are already encoded'.format(len(pieces), in_file))
+        return files
+    if len(missing) < len(pieces):
+        logger.info('Resuming {}: {} of {} segments are already encoded'.format(in_file, len(pieces) - len(missing),
+                                                                               len(pieces)))
+    partial = []
+    for piece, file, length in missing:
+        root, ext = os.path.splitext(file)
+        part = root + '.part' + ext
+        if os.path.isfile(part):
+            os.remove(part)
+        partial.append((piece, part))
+    rets = encode(partial)
+    failed = sorted(set(ret for ret in rets if ret))
+    if failed:
+        logger.error('Nonzero return codes from ffmpeg: {}'.format(failed))
+    ok = not failed
+    for (piece, file, length), (_, part), ret in zip(missing, partial, rets):
+        # Segments which finished are kept even if another failed
+        if ret == 0 and verify_duration(part, length, SEGMENT_TOLERANCE):
+            os.replace(part, file)
+            continue
+        ok = False
+        if os.path.isfile(part):
+            os.remove(part)
+    return files if ok else None
+
+
+def _write_list(work_dir, files):
+    file_list = os.path.join(work_dir, 'concat.txt')
+    with open(file_list, 'w') as f:
+        for file in files:
+            f.write('file \'{}\'\n'.format(file))
+    return file_list
+
+
+def _copy_segment(in_file, start, end, out_file, plan):
+    # Seeking the input when copying starts the segment on the keyframe before start, so it decodes cleanly
+    args = [FFMPEG_EXE, '-ss', str(start), '-i', in_file]
+    if end is not None:
+        args.extend(['-t', str(end - start)])
+    args.extend(plan.map_args())
+    args.extend(plan.codec_args(_video_args()))
+    args.append(out_file)
+    return execute_ffmpeg(args, end - start if end is not None else None)
+
+
+def _convert_segments(in_file, out_file, invert, size, plan, srt_file=None):
+    reservation = _reserve(in_file, size)
+    if reservation is None:
+        return False
+    # Each recording gets its own working directory so concurrent workers never collide
+    with reservation as work_dir:
+        total = analyze(in_file)['duration']
+        kept = kept_seconds(invert, total)
+        settings = plan.map_args() + plan.codec_args(_video_args())
+        if plan.copy_video:
+            def encode(missing):
+                rets = []
+                for (start, end), file in missing:
+                    rets.append(_copy_segment(in_file, start, end, file, plan))
+                    if rets[-1] != 0:
+                        break
+                return rets + [None] * (len(missing) - len(rets))
+
+            files = encode_segments(in_file, work_dir, invert, ['copy'] + settings, '.mp4', encode, total)
+        else:
+            def encode(missing):
+                # Every missing segment is an output of a single ffmpeg, so the source is only decoded once
+                args = [FFMPEG_EXE, '-i', in_file]
+                for piece, file in missing:
+                    args.extend(cut_args(piece, file, plan))
+                return [execute_ffmpeg(args, kept_seconds([p for p, f in missing], total))] * len(missing)
+
+            files = encode_segments(in_file, work_dir, invert, ['segments'] + settings, '.mp4', encode, total)
+        if files is None:
+            return False
+        return _concat(_write_list(work_dir, files), out_file, plan, kept, srt_file, from_ts=False)
+
+
+def _convert_smartcut(in_file, out_file, invert, size, plan, srt_file=None):
+    if not plan.copy_video:
+        logger.debug('Cannot smart cut {} with video {}'.format(in_file, plan.video))
+        return False
+    keys = keyframes(in_file)
+    if not keys:
+        logger.debug('No keyframes found for {}'.format(in_file))
+        return False
+    reservation = _reserve(in_file, size)
+    if reservation is None:
+        return False
+    with reservation as work_dir:
+        return _smartcut(in_file, out_file, invert, keys, work_dir, plan, srt_file)
+
+
+def _smartcut(in_file, out_file, invert, keys, work_dir, plan, srt_file):
+    total = analyze(in_file)['duration']
+
+    def encode(missing):
+        rets = []
+        for (start, end, copy_video), file in missing:
+            # Seek slightly past a keyframe so rounding never lands on the previous GOP
+            args = [FFMPEG_EXE, '-ss', str(start + 0.001 if copy_video else start), '-i', in_file]
+            if end is not None:
+                args.extend(['-t', str(end - start)])
+            args.extend(plan.map_args())
+            args.extend(plan.codec_args(_video_args(), copy_video=copy_video))
+            args.append(file)
+            rets.append(execute_ffmpeg(args, end - start if end is not None else None))
+            if rets[-1] != 0:
+                break
+        return rets + [None] * (len(missing) - len(rets))
+
+    settings = ['smartcut'] + plan.map_args() + plan.codec_args(_video_args())
+    pieces = intervals.smart_cut_plan(invert, keys, SMART_CUT_MIN_PIECE)
+    files = encode_segments(in_file, work_dir, pieces, settings, '.ts', encode, total)
+    if files is None:
+        return False
+    return _concat(_write_list(work_dir, files), out_file, plan, kept_seconds(invert, total), srt_file)
+
+
+def _encode_chunk(in_file, start, end, out_file, plan, stage=None):
+    args = [FFMPEG_EXE, '-ss', str(start), '-i', in_file]
+    if end is not None:
+        args.extend(['-t', str(end - start)])
+    args.extend(plan.map_args())
+    args.extend(plan.codec_args(_video_args()))
+    if PARALLEL_THREADS:
+        args.extend(['-threads', str(PARALLEL_THREADS)])
+    args.append(out_file)
+    return execute_ffmpeg(args, end - start if end is not None else None, stage)
+
+
+def _convert_parallel(in_file, out_file, invert, size, plan, srt_file=None):
+    reservation = _reserve(in_file, size)
+    if reservation is None:
+        return False
+    with reservation as work_dir:
+        return _parallel(in_file, out_file, invert, work_dir, plan, srt_file)
+
+
+def _parallel(in_file, out_file, invert, work_dir, plan, srt_file):
+    total = analyze(in_file)['duration']
+    chunks = intervals.chunk_plan(invert, keyframes(in_file), PARALLEL_CHUNK_SECONDS, total)
+    logger.debug('Encoding {} in {} chunks with {} jobs'.format(in_file, len(chunks), PARALLEL_JOBS))
+    stage = metrics.current_stage()
+
+    def encode(missing):
+        with ThreadPoolExecutor(max_workers=PARALLEL_JOBS) as executor:
+            # Each chunk runs in a copy of the recording's context, for its metrics
+            futures = [executor.submit(contextvars.copy_context().run, _encode_chunk, in_file, piece[0], piece[1], file,
+                                       plan, stage) for piece, file in missing]
+            return [f.result() for f in futures]
+
+    settings = ['chunk'] + plan.map_args() + plan.codec_args(_video_args())
+    files = encode_segments(in_file, work_dir, chunks, settings, '.ts', encode, total)
+    if files is None:
+        return False
+    return _concat(_write_list(work_dir, files), out_file, plan, kept_seconds(invert, total), srt_file)
+
+
+def estimate_size(in_file, invert):
+    """
+    Estimate the bytes written when encoding the kept parts of in_file
+    """
+    size = os.path.getsize(in_file)
+    total = analyze(in_file)['duration']
+    kept = kept_seconds(invert, total)
+    if total and kept is not None:
+        size = size * min(1.0, kept / total)
+    return int(size * SPOOL_ESTIMATE_RATIO)
+
+
+def _reserve(in_file, size):
+    # The segment directory of in_file is kept when released, so a failed encode resumes from its segments
+    try:
+        return spool_manager.reserve(_source_key(in_file), size, directory=SEGMENT_DIR, persistent=True)
+    except SpoolFull as e:
+        logger.warn(str(e))
+        return None
+
+
+def _attempt(func, in_file, out_file, invert, *args):
+    """
+    Convert with func and check the output is complete
+    """
+    if not func(in_file, out_file, invert, *args):
+        return False
+    if verify_output(out_file, in_file, invert):
+        return True
+    logger.error('{} is not as long as the kept segments of {}'.format(out_file, in_file))
+    os.remove(out_file)
+    return False
+
+
+def _convert(in_file, out_file, invert, size, plan, srt_file):
+    if ENCODE_MODE == 'smartcut':
+        if _attempt(_convert_smartcut, in_file, out_file, invert, size, plan, srt_file):
+            return True
+        logger.warn('Smart cut not possible for {}, falling back to single pass'.format(in_file))
+    # A copy starts on the keyframe before its cut, so the video is only copied if every segment starts on a keyframe
+    if plan.copy_video and not intervals.on_keyframes(invert, keyframes(in_file)):
+        logger.debug('Cuts of {} are not on keyframes, transcoding the video'.format(in_file))
+        plan = plan.transcode_video()
+    if ENCODE_MODE == 'parallel':
+        if _attempt(_convert_parallel, in_file, out_file, invert, size, plan, srt_file):
+            return True
+        logger.warn('Parallel encode failed for {}, falling back to single pass'.format(in_file))
+    elif ENCODE_MODE == 'filter' and plan.copy_video:
+        # The filter graph must decode everything, so copy the segments instead
+        if _attempt(_convert_segments, in_file, out_file, invert, size, plan, srt_file):
+            return True
+        logger.warn('Stream copy failed for {}, falling back to single pass'.format(in_file))
+    if ENCODE_MODE in ('smartcut', 'parallel', 'filter'):
+        if _attempt(_convert_filter, in_file, out_file, invert, plan, srt_file):
+            return True
+        logger.warn('Single pass encode failed for {}, falling back to segments'.format(in_file))
+    return _attempt(_convert_segments, in_file, out_file, invert, size, plan, srt_file)
+
+
+def convert(in_file, out_file, commercials, srt_file=None):
+    """
+    :param srt_file: cut subtitles to mux into the output
+    """
     invert = invert_commercial(commercials)
-    temp_files = []
-    wo_ext = os.path.basename(in_file).replace('.wtv', '')
+    if not invert:
+        logger.error('Nothing is left of {} once the commercials are cut'.format(in_file))
+        return False
     try:
-        args = [FFMPEG_EXE, '-i', in_file]
-        for i in invert:
-            temp_file = os.path.join(TEMP_DIR, wo_ext + '.' + str(len(temp_files)) + '.mp4')
-            temp_files.append(temp_file)
-            if os.path.isfile(temp_file):
-                os.remove(temp_file)
-
-            args.extend(cut_args(i, temp_file))
-
-        file_list = os.path.join(TEMP_DIR, os.path.basename(in_file).replace('wtv', 'txt'))
-        with open(file_list, 'w') as f:
-            for file in temp_files:
-                f.writelines('file \'{}\'\n'.format(file))
-        ret = execute(args)
-        if ret != 0:
-            logger.error('Nonzero return code from ffmpeg: {}'.format(ret))
-        else:
-            if os.path.isfile(out_file):
-                os.remove(out_file)
-            # ffmpeg -f concat -i mylist.txt -c copy output
-            ret = execute(
-                [FFMPEG_EXE, '-safe', '0',
-                 '-f', 'concat', '-i', file_list,
-                 '-c:v', 'copy',
-                 '-c:a', 'copy',
-                 out_file])
-            if ret != 0:
-                logger.error('Nonzero return code from ffmpeg: {}'.format(ret))
-            # Cleanup temp files
-            if not DEBUG:
-                for f in temp_files:
-                    os.remove(f)
-                os.remove(file_list)
+        size = estimate_size(in_file, invert)
+        # Refuse (or wait) early rather than failing on a full disk after an hour of encoding
+        spool_manager.wait_for_space(os.path.dirname(os.path.abspath(out_file)), size)
+        plan = stream_plan(in_file)
+        logger.debug('Streams of {}: {}'.format(in_file, plan))
+        converted = _convert(in_file, out_file, invert, size, plan, srt_file)
+        if converted and not DEBUG:
+            # The output has been verified, so the segments are no longer needed to resume
+            remove_segments(in_file)
+        return converted
+    except SpoolFull as e:
+        logger.warn('Skipping {}: {}'.format(in_file, e))
+        return False
     except Exception as e:
         logger.exception('Exception')
         return False
-    return True
 
 
-def process_directory(wtv_dir, com_dir, srt_dir):
-    count = 0
-    files = glob.glob(os.path.join(WTV_IN_DIR, TV_PATTERN))
-    for wtv_file in sorted(files):
-        if os.path.isfile(wtv_file):
-            wtvdb.begin()
+def related_files(wtv_file, com_dir, srt_dir):
+    """
+    :return: (commercial file, srt file) for a recording
+    """
+    wtv = os.path.basename(wtv_file)
+    return os.path.join(com_dir, wtv.replace('wtv', 'xml')), os.path.join(srt_dir, wtv.replace('wtv', 'srt'))
+
+
+def process_file(wtv_file, com_dir, srt_dir, complete=False):
+    """
+    Process a single recording if it is ready
+    :param complete: the file is known to be completely written, otherwise it must be unmodified for 5 minutes
+    :return: True if the file was processed
+    """
+    processed = False
+    wtvdb.begin()
+    try:
+        wtv = os.path.basename(wtv_file)
+        time = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        stat = os.stat(wtv_file)
+        modified = datetime.datetime.fromtimestamp(stat.st_mtime)
+        # Only files which are no longer being written get a job
+        job = wtvdb.get_job(wtv, stat.st_size, stat.st_mtime_ns) if complete or modified < time else None
+        if job is not None and job.finalized:
+            logger.debug('Already processed {}'.format(wtv_file))
+        elif job is not None:
+            com_file, srt_file = related_files(wtv_file, com_dir, srt_dir)
+            logger.info('Processing {}'.format(wtv_file))
+            processed = process(wtv_file, com_file, srt_file, job)
+    except Exception:
+        logger.exception('Exception while handling {}'.format(wtv_file))
+    wtvdb.end()
+    return processed
+
+
+def _init_worker(log_queue, semaphores):
+    # Each worker gets its own database & TVDB client and sends log records back to the parent. The resource class
+    # slots are shared by all of the workers.
+    global wtvdb, tvdb
+    resources.share(semaphores)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    wtvdb = WtvDb(DB_FILE)
+    tvdb = create_tvdb(wtvdb)
+
+
+def _handle_recordings(index, tasks, results):
+    # Each recording gets its own database session & metrics labels, since it runs in the context of its thread
+    for args in iter(tasks.get, None):
+        processed = process_file(*args)
+        # The recordings of a worker overlap, so it reports its totals
+        results.put((index, os.getpid(), processed, args[0], tvdb.cache_hits, tvdb.cache_misses))
+
+
+def _start_threads(index, tasks, results):
+    threads = [threading.Thread(target=_handle_recordings, args=(index, tasks, results), daemon=True)
+               for _ in range(RECORDINGS)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _run_worker(index, tasks, results, log_queue, semaphores):
+    _init_worker(log_queue, semaphores)
+    for thread in _start_threads(index, tasks, results):
+        thread.join()
+
+
+# Seconds between checks that the worker processes are still alive while waiting for a result
+WORKER_CHECK_INTERVAL = 5
+
+
+class Workers():
+    """
+    Hands the recordings to the worker processes, or to this process if there is only one, each handling RECORDINGS
+    of them at once on their own threads
+    """
+
+    def __init__(self):
+        self.capacity = WORKERS * RECORDINGS
+        self._listener = None
+        self._processes = []
+        self._threads = []
+        # Submitted recordings not yet handed to a worker, in the order submitted
+        self._pending = deque()
+        # Recordings of workers which died, reported as not processed
+        self._lost = deque()
+        # pid => (cache hits, cache misses) of the worker processes
+        self._cache_counts = {}
+        if WORKERS > 1:
+            log_queue = multiprocessing.Queue()
+            self._tasks = [multiprocessing.Queue() for _ in range(WORKERS)]
+            self._results = multiprocessing.Queue()
+            self._processes = [multiprocessing.Process(target=_run_worker, daemon=True,
+                                                       args=(i, self._tasks[i], self._results, log_queue,
+                                                             resources.semaphores()))
+                               for i in range(WORKERS)]
+            for process in self._processes:
+                process.start()
+            # Forking while another thread holds a lock, such as the logging locks, could deadlock the worker, so the
+            # listener only starts once the workers have been forked
+            self._listener = QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+            self._listener.start()
+        else:
+            self._tasks, self._results = [queue.Queue()], queue.Queue()
+            self._threads = _start_threads(0, self._tasks[0], self._results)
+        # Index of each worker => its recordings, so those of a worker which dies can be reported
+        self._assigned = [set() for _ in self._tasks]
+
+    def _alive(self, index):
+        return not self._processes or self._processes[index] is not None
+
+    def _dispatch(self):
+        while self._pending:
+            free = [i for i in range(len(self._tasks)) if self._alive(i) and len(self._assigned[i]) < RECORDINGS]
+            if not free:
+                return
+            index = min(free, key=lambda i: len(self._assigned[i]))
+            args = self._pending.popleft()
+            self._assigned[index].add(args[0])
+            self._tasks[index].put(args)
+
+    def _check(self):
+        for i, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                logger.error('Worker {} exited with {}, failing {}'.format(process.pid, process.exitcode,
+                                                                          sorted(self._assigned[i]) or 'nothing'))
+                self._processes[i] = None
+                self._lost.extend(sorted(self._assigned[i]))
+                self._assigned[i] = set()
+        if self._processes and not any(self._processes):
+            # No worker is left to take the others
+            self._lost.extend(args[0] for args in self._pending)
+            self._pending.clear()
+        self._dispatch()
+
+    def submit(self, wtv_file, com_dir, srt_dir, complete=False):
+        self._pending.append((wtv_file, com_dir, srt_dir, complete))
+        self._dispatch()
+
+    def result(self, timeout=None):
+        # (True if it was processed, the recording) of the next one to finish, raises queue.Empty on a timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not self._lost:
+            wait = WORKER_CHECK_INTERVAL if deadline is None else max(0, min(WORKER_CHECK_INTERVAL,
+                                                                             deadline - time.monotonic()))
             try:
-                # wtv_file = os.path.join(wtv_dir, wtv)
-                wtv = os.path.basename(wtv_file)
-                time = datetime.datetime.now() - datetime.timedelta(minutes=5)
-                modified = datetime.datetime.fromtimestamp(os.path.getmtime(wtv_file))
-                if modified < time:
-                    com = wtv.replace('wtv', 'xml')
-                    srt = wtv.replace('wtv', 'srt')
-                    com_file = os.path.join(com_dir, com)
-                    srt_file = os.path.join(srt_dir, srt)
-                    if not os.path.isfile(com_file) and COMSKIP_RUN:
-                        logger.debug('No commercial file for {}. Running comskip'.format(wtv_file))
-                        run_comskip(wtv_file, com_dir)
-                    if not os.path.isfile(srt_file) and CCEXTRACTOR_RUN:
-                        logger.debug('No srt file for {}. Running ccextractor'.format(wtv_file))
-                        extract_subtitles(wtv_file, srt_file)
-                    if os.path.isfile(com_file) and os.path.isfile(srt_file):
-                        logger.info('Processing {}'.format(wtv_file))
-                        process(wtv_file, com_file, srt_file)
-                        count += 1
-                    else:
-                        logger.warn('No commercial or srt file for {}...skipping'.format(wtv_file))
-            except Exception:
-                logger.exception('Exception while handling {}'.format(wtv))
-            wtvdb.end()
+                index, pid, processed, wtv_file, hits, misses = self._results.get(timeout=wait)
+            except queue.Empty:
+                self._check()
+                if deadline is not None and time.monotonic() >= deadline and not self._lost:
+                    raise
+                continue
+            if pid != os.getpid():
+                self._cache_counts[pid] = (hits, misses)
+            self._assigned[index].discard(wtv_file)
+            self._dispatch()
+            return processed, wtv_file
+        return False, self._lost.popleft()
+
+    def stop(self):
+        # Wait for the submitted recordings to finish
+        for i, tasks in enumerate(self._tasks):
+            if self._alive(i):
+                for _ in range(RECORDINGS):
+                    tasks.put(None)
+        for worker in self._processes + self._threads:
+            if worker is not None:
+                worker.join()
+        self._finish()
+
+    def terminate(self):
+        for process in self._processes:
+            if process is not None:
+                process.terminate()
+                process.join()
+        self._finish()
+
+    def _finish(self):
+        tvdb.cache_hits += sum(hits for hits, misses in self._cache_counts.values())
+        tvdb.cache_misses += sum(misses for hits, misses in self._cache_counts.values())
+        self._cache_counts = {}
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
+
+
+def _process_parallel(backlog, com_dir, srt_dir):
+    workers = Workers()
+    remaining = list(backlog)
+    count = 0
+    try:
+        # Workers take the recordings in the scheduled order as they become free
+        for estimate in backlog:
+            workers.submit(estimate.wtv_file, com_dir, srt_dir)
+        for _ in backlog:
+            processed, wtv_file = workers.result()
+            if processed:
+                count += 1
+            remaining = [e for e in remaining if e.wtv_file != wtv_file]
+            log_backlog(remaining)
+    except BaseException:
+        workers.terminate()
+        raise
+    workers.stop()
+    return count
+
+
+def estimate_job(wtv_file, com_dir, srt_dir):
+    """
+    Gather what the scheduler needs to estimate the cost of a recording, reading only its header & commercial file if
+    possible
+    :return: JobEstimate
+    """
+    series = media = kept_fraction = None
+    try:
+        metadata = extract_metadata(wtv_file, keys={'Title', DURATION_KEY})
+        series = metadata.get('Title')
+        media = extract_duration(wtv_file, metadata)
+    except Exception:
+        logger.debug('No WTV header in {}'.format(wtv_file))
+    try:
+        if media is None:
+            media = analyze(wtv_file)['duration']
+        com_file = find_commercial_file(related_files(wtv_file, com_dir, srt_dir)[0])
+        if com_file and media:
+            kept_fraction = min(1.0, kept_seconds(invert_commercial(parse_commercial_file(com_file)), media) / media)
+    except Exception:
+        logger.exception('Cannot estimate {}'.format(wtv_file))
+    return JobEstimate(wtv_file, series, media, kept_fraction, os.path.getmtime(wtv_file))
+
+
+def log_backlog(backlog):
+    if not backlog:
+        return
+    work, remaining = scheduler.eta(backlog)
+    finish = datetime.datetime.now() + datetime.timedelta(seconds=remaining)
+    logger.info('Backlog: {} recordings, about {} of encoding, done in {} at {:%H:%M}'.format(
+        len(backlog), format_seconds(work), format_seconds(remaining), finish))
+
+
+def _unfinished(files):
+    finalized = set((j.filename, j.size, j.mtime) for j in wtvdb.get_jobs(include_finalized=True) if j.finalized)
+    unfinished = []
+    for f in files:
+        stat = os.stat(f)
+        if (os.path.basename(f), stat.st_size, stat.st_mtime_ns) not in finalized:
+            unfinished.append(f)
+    return unfinished
+
+
+def sweep_spool():
+    """
+    Remove working directories left behind by crashed runs, and segment directories of encodes never retried
+    """
+    removed = spool_manager.sweep(SPOOL_SWEEP_MAX_AGE, directories=(SPOOL_DIR, SEGMENT_DIR))
+    if removed:
+        logger.info('Removed {} orphaned working directories'.format(removed))
+
+
+def process_directory(wtv_dir, com_dir, srt_dir):
+    sweep_spool()
+    files = [f for f in glob.glob(os.path.join(WTV_IN_DIR, TV_PATTERN)) if os.path.isfile(f)]
+    backlog = scheduler.order(estimate_job(f, com_dir, srt_dir) for f in _unfinished(files))
+    logger.debug('Processing order ({}): {}'.format(scheduler.policy, [os.path.basename(e.wtv_file) for e in backlog]))
+    log_backlog(backlog)
+    if WORKERS * RECORDINGS > 1 and len(backlog) > 1:
+        logger.debug('Processing {} files with {} workers of {} recordings each'.format(len(backlog), WORKERS,
+                                                                                       RECORDINGS))
+        count = _process_parallel(backlog, com_dir, srt_dir)
+    else:
+        count = 0
+        for i, estimate in enumerate(backlog):
+            if process_file(estimate.wtv_file, com_dir, srt_dir):
+                count += 1
+            # The history now includes this recording, so the estimate of the rest improves
+            log_backlog(backlog[i + 1:])
     logger.info('Processed {} files'.format(count))
+    logger.info('TVDB episode cache: {} hits, {} misses'.format(tvdb.cache_hits, tvdb.cache_misses))
+
+
+def start_logged(args, work_dir, name, **kwargs):
+    """
+    Start a process in the background with its output written to a log file in work_dir
+    :param name: name of the log file, which is also the stage whose resource class the process runs with
+    :return: (process, log file)
+    """
+    log = open(os.path.join(work_dir, name + '.log'), 'wb')
+    p = subprocess.Popen(_command(args, name), stdout=log, stderr=subprocess.STDOUT, **kwargs)
+    return p, log
+
+
+def live_comskip_ini(work_dir):
+    """
+    Write a copy of comskip.ini with live_tv enabled, so comskip follows a growing file
+    """
+    ini = os.path.join(work_dir, 'comskip.ini')
+    with open(ini, 'w') as f:
+        if COMSKIP_INI:
+            with open(COMSKIP_INI) as base:
+                f.write(base.read())
+        f.write('\nlive_tv=1\nlive_tv_retries={}\n'.format(LIVE_IDLE))
+    return ini
+
+
+class SourceSpool():
+    """
+    Reads a recording from its source once.
+
+    The bytes are written to a local spool file. Comskip follows the growing spool file in live mode, while ccextractor
+    needs random access to the WTV directory tables so it reads the spool once it is complete, as does the encoder. The
+    source is only read once instead of by every tool.
+    """
+
+    def __init__(self, wtv_file, com_file, srt_file):
+        self.wtv_file = wtv_file
+        self.com_file = com_file
+        self.srt_file = srt_file
+        wo_ext = os.path.splitext(os.path.basename(wtv_file))[0]
+        self.reservation = spool_manager.reserve(wo_ext + '.spool', os.path.getsize(wtv_file), directory=SPOOL_DIR)
+        self.work_dir = self.reservation.path
+        # Keep the name so comskip names its output after the recording
+        self.path = os.path.join(self.work_dir, os.path.basename(wtv_file))
+        self.comskip = None
+        self.ccextractor = None
+
+    def run(self, run_comskip, run_ccextractor):
+        total = 0
+        with open(self.wtv_file, 'rb') as src, open(self.path, 'wb') as dst:
+            while True:
+                chunk = src.read(SPOOL_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                total += len(chunk)
+                if run_comskip and self.comskip is None:
+                    dst.flush()
+                    args = [COMSKIP_EXE, '--ini=' + live_comskip_ini(self.work_dir),
+                            '--output=' + os.path.dirname(self.com_file), self.path]
+                    self.comskip = start_logged(args, self.work_dir, 'comskip')
+        if run_ccextractor:
+            self.ccextractor = start_logged([CCEXTRACTOR_EXE, self.path, '-o', self.srt_file], self.work_dir,
+                                            'ccextractor')
+        logger.debug('Spooled {} bytes of {} to {}'.format(total, self.wtv_file, self.path))
+        return self
+
+    @staticmethod
+    def wait(running, stage=None):
+        if running:
+            p, log = running
+            metrics.wait(p, stage=stage)
+            log.close()
+
+    def cleanup(self):
+        for running in (self.comskip, self.ccextractor):
+            if running and running[0].poll() is None:
+                running[0].kill()
+            self.wait(running)
+        self.reservation.release()
+
+
+class _LiveRecording():
+    def __init__(self, reservation):
+        self.reservation = reservation
+        self.work_dir = reservation.path
+        # ((process, log file), partial output)
+        self.comskip = None
+        self.ccextractor = None
+
+
+class LiveIngest():
+    """
+    Runs comskip and ccextractor against recordings while they are still growing.
+
+    Comskip uses a copy of comskip.ini with live_tv enabled and ccextractor runs in stream mode, so both follow the
+    file as it is written and exit shortly after it stops growing. Their partial outputs are kept in a working
+    directory under TEMP_DIR and moved into commercial.in & srt.in once the recording is complete.
+    """
+
+    def __init__(self, com_dir, srt_dir):
+        self._com_dir = com_dir
+        self._srt_dir = srt_dir
+        self._lock = threading.Lock()
+        self._recordings = {}
+
+    def tracking(self, wtv_file):
+        with self._lock:
+            return wtv_file in self._recordings
+
+    def start(self, wtv_file):
+        com_file, srt_file = related_files(wtv_file, self._com_dir, self._srt_dir)
+        run_comskip = COMSKIP_RUN and find_commercial_file(com_file) is None
+        run_ccextractor = CCEXTRACTOR_RUN and not os.path.isfile(srt_file)
+        with self._lock:
+            if wtv_file in self._recordings or not (run_comskip or run_ccextractor):
+                return
+            wo_ext = os.path.splitext(os.path.basename(wtv_file))[0]
+            # Only logs and partial outputs are written, so nothing is reserved
+            live = _LiveRecording(spool_manager.reserve(wo_ext + '.live', 0, ram=False))
+            self._recordings[wtv_file] = live
+        logger.info('Starting live detection for {}'.format(wtv_file))
+        if run_comskip:
+            args = [COMSKIP_EXE, '--ini=' + live_comskip_ini(live.work_dir), '--output=' + live.work_dir, wtv_file]
+            live.comskip = (start_logged(args, live.work_dir, 'comskip'),
+                            os.path.join(live.work_dir, os.path.basename(com_file)))
+        if run_ccextractor:
+            partial_srt = os.path.join(live.work_dir, os.path.basename(srt_file))
+            args = [CCEXTRACTOR_EXE, wtv_file, '-s', str(LIVE_IDLE), '-o', partial_srt]
+            live.ccextractor = (start_logged(args, live.work_dir, 'ccextractor'), partial_srt)
+
+    def _finish_process(self, running, dest):
+        (p, log), output = running
+        try:
+            metrics.wait(p, stage='live', timeout=LIVE_TIMEOUT, recording=os.path.basename(dest))
+            finished = True
+        except subprocess.TimeoutExpired:
+            logger.warn('Live process did not finish, killing: {}'.format(p.args))
+            p.kill()
+            metrics.wait(p, stage='live', recording=os.path.basename(dest))
+            finished = False
+        log.close()
+        # comskip's return code only says whether commercials were found, so check for the output instead
+        if finished and os.path.isfile(output) and not os.path.isfile(dest):
+            shutil.move(output, dest)
+        elif not os.path.isfile(dest):
+            logger.warn('Live process did not produce {}, it will run again: {}'.format(output, p.args))
+
+    def finish(self, wtv_file):
+        """
+        Wait for the live processes of a complete recording and move their outputs into place
+        """
+        with self._lock:
+            live = self._recordings.pop(wtv_file, None)
+        if live is None:
+            return
+        com_file, srt_file = related_files(wtv_file, self._com_dir, self._srt_dir)
+        if live.comskip:
+            self._finish_process(live.comskip, com_file)
+        if live.ccextractor:
+            self._finish_process(live.ccextractor, srt_file)
+        logger.debug('Finished live detection for {}'.format(wtv_file))
+        live.reservation.release()
+
+
+def watch(wtv_dir, com_dir, srt_dir):
+    """
+    Run as a daemon which processes each recording as soon as it has been completely written. The TVDB client and
+    workers stay open between recordings.
+    """
+    wtv_dir, com_dir, srt_dir = os.path.abspath(wtv_dir), os.path.abspath(com_dir), os.path.abspath(srt_dir)
+    sweep_spool()
+    # (scheduler key, submission order, recording)
+    jobs = queue.PriorityQueue()
+    order = itertools.count()
+    workers = Workers()
+    # A recording is only taken from the queue once a worker is free, so the scheduler decides what runs next
+    slots = threading.BoundedSemaphore(workers.capacity)
+    lock = threading.Lock()
+    queued = set()
+    running = set()
+    # Recordings which completed again while being processed
+    deferred = set()
+    # Basename without extension => recording, to find the recording when its commercial or srt file completes
+    recordings = {}
+    live = LiveIngest(com_dir, srt_dir) if LIVE_ENABLED else None
+
+    def submit(wtv_file):
+        with lock:
+            if wtv_file in running:
+                deferred.add(wtv_file)
+                return
+            if wtv_file in queued:
+                return
+            queued.add(wtv_file)
+        jobs.put((scheduler.key(estimate_job(wtv_file, com_dir, srt_dir)), next(order), wtv_file))
+
+    def done(wtv_file):
+        slots.release()
+        with lock:
+            running.discard(wtv_file)
+            again = wtv_file in deferred
+            deferred.discard(wtv_file)
+        if again:
+            submit(wtv_file)
+
+    sidecars = COMMERCIAL_EXTENSIONS + ('.srt',)
+
+    def on_complete(path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        directory = os.path.dirname(path)
+        if directory in (com_dir, srt_dir) and os.path.splitext(path)[1] in sidecars:
+            if stem in recordings:
+                submit(recordings[stem])
+        else:
+            recordings[stem] = path
+            if live and live.tracking(path):
+                # Wait for the live tools without holding up the watcher
+                threading.Thread(target=lambda: (live.finish(path), submit(path)), daemon=True).start()
+            else:
+                submit(path)
+
+    def on_started(path):
+        if os.path.splitext(path)[1] not in sidecars or os.path.dirname(path) not in (com_dir, srt_dir):
+            live.start(path)
+
+    patterns = [(wtv_dir, TV_PATTERN), (srt_dir, '*.srt')] + [(com_dir, '*' + ext) for ext in COMMERCIAL_EXTENSIONS]
+    watcher = Watcher(patterns, settle_seconds=WATCH_SETTLE, debounce_seconds=WATCH_DEBOUNCE,
+                      poll_interval=WATCH_POLL_INTERVAL, method=WATCH_METHOD)
+    thread = threading.Thread(target=watcher.run, args=(on_complete, on_started if live else None), daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            # The recordings finished by the workers free their slots
+            try:
+                while True:
+                    done(workers.result(timeout=0)[1])
+            except queue.Empty:
+                pass
+            if not slots.acquire(timeout=1):
+                continue
+            try:
+                wtv_file = jobs.get(timeout=1)[2]
+            except queue.Empty:
+                slots.release()
+                continue
+            with lock:
+                queued.discard(wtv_file)
+                running.add(wtv_file)
+            workers.submit(wtv_file, com_dir, srt_dir, complete=True)
+    except KeyboardInterrupt:
+        logger.info('Stopping')
+    finally:
+        watcher.stop()
+        workers.terminate()
 
 
 def duration(file):
@@ -312,12 +1619,45 @@ def duration(file):
     p = subprocess.Popen(
         [FFPROBE_EXE, '-v', 'quiet', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1',
          file], stdout=subprocess.PIPE)
-    out, err = p.communicate()
+    out = p.stdout.read()
+    p.stdout.close()
+    metrics.wait(p)
     if len(out) == 0:
         return 0.0
     return float(out)
 
 
+def _probe(args):
+    p = subprocess.Popen([FFPROBE_EXE, '-v', 'quiet'] + args, stdout=subprocess.PIPE)
+    out = p.stdout.read()
+    p.stdout.close()
+    metrics.wait(p)
+    return out.decode('utf-8', errors='replace')
+
+
+def keyframes(file):
+    """
+    Find the keyframe times of the first video stream from the packet flags, which does not need to decode the video
+    :return: sorted list of keyframe times in seconds
+    """
+    stat = os.stat(file)
+    return list(_keyframes(file, stat.st_size, stat.st_mtime_ns))
+
+
+# Snapping the breaks and smart cut both need the keyframes, so only scan the packets once per file
+@functools.lru_cache(maxsize=8)
+def _keyframes(file, size, mtime):
+    # ffprobe -v quiet -select_streams v:0 -show_entries packet=pts_time,flags -of csv=p=0 in.wtv
+    out = _probe(['-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', file])
+    keys = []
+    for line in out.splitlines():
+        split = line.split(',')
+        if len(split) >= 2 and 'K' in split[1] and split[0] not in ('', 'N/A'):
+            keys.append(float(split[0]))
+    keys.sort()
+    return tuple(keys)
+
+
 def durations_to_invert(durations):
     ret = []
     pos = 0
@@ -344,4 +1684,7 @@ def create_filename(series, season, episode_num, episode_name, filename, extensi
 
 
 if __name__ == '__main__':
-    process_directory(WTV_IN_DIR, COM_IN_DIR, SRT_IN_DIR)
+    if '--watch' in sys.argv:
+        watch(WTV_IN_DIR, COM_IN_DIR, SRT_IN_DIR)
+    else:
+        process_directory(WTV_IN_DIR, COM_IN_DIR, SRT_IN_DIR)
@@ -0,0 +1,146 @@
+"""
+Resource classes limit how many stages of each kind run at once across every worker, and how their processes are
+scheduled by the OS.
+
+Each class has its own concurrency limit, CPU niceness, I/O scheduling class, CPU affinity and ffmpeg thread count.
+Stages are mapped to classes, so for example comskip (CPU bound), ccextractor (I/O bound), the TVDB lookups (network)
+and the encode (every core) each fill their own slots instead of all competing for the same workers.
+"""
+import asyncio
+import logging
+import multiprocessing
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+
+class ResourceClass():
+    def __init__(self, name, concurrency=0, nice=None, ionice_class=None, ionice_level=None, affinity=None,
+                 threads=0):
+        """
+        :param concurrency: stages of this class which may run at once across every worker, 0 for no limit
+        :param nice: CPU niceness of its processes
+        :param ionice_class: I/O scheduling class, realtime, best-effort, idle or its number
+        :param ionice_level: I/O priority within the class, 0 (highest) to 7
+        :param affinity: CPUs its processes may run on, in taskset's list format, eg 0-3,6
+        :param threads: ffmpeg threads, 0 lets ffmpeg decide
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.nice = nice
+        self.ionice_class = IONICE_CLASSES.get(ionice_class, ionice_class)
+        self.ionice_level = ionice_level
+        self.affinity = affinity
+        self.threads = threads
+        # Created before the worker pool so the workers share it
+        self.semaphore = multiprocessing.BoundedSemaphore(concurrency) if concurrency > 0 else None
+
+    def __repr__(self):
+        return 'ResourceClass[name={}, concurrency={}, nice={}, ionice={}/{}, affinity={}, threads={}]'.format(
+            self.name, self.concurrency, self.nice, self.ionice_class, self.ionice_level, self.affinity, self.threads)
+
+
+class Resources():
+    def __init__(self, classes=(), stages=None, nice_exe='nice', ionice_exe='ionice', taskset_exe='taskset',
+                 default_nice=False):
+        """
+        :param classes: ResourceClass list
+        :param stages: dict of stage name to class name
+        :param default_nice: run the processes of stages without a class with nice
+        """
+        self.classes = {c.name: c for c in classes}
+        self.stages = dict(stages or {})
+        for stage, name in self.stages.items():
+            if name not in self.classes:
+                raise ValueError('Stage {} uses the unknown resource class {}'.format(stage, name))
+        self._nice_exe = nice_exe
+        self._ionice_exe = ionice_exe
+        self._taskset_exe = taskset_exe
+        self._default_nice = default_nice
+
+    def for_stage(self, stage):
+        """
+        :return: the ResourceClass of a stage or None
+        """
+        name = self.stages.get(stage)
+        return self.classes.get(name) if name else None
+
+    def semaphores(self):
+        """
+        :return: the semaphores to pass to the pool workers, see share()
+        """
+        return {name: c.semaphore for name, c in self.classes.items()}
+
+    def share(self, semaphores):
+        """
+        Use the semaphores of the parent process in a worker
+        """
+        for name, semaphore in semaphores.items():
+            if name in self.classes:
+                self.classes[name].semaphore = semaphore
+
+    def command(self, args, stage=None):
+        """
+        :return: args prefixed with taskset, ionice and nice as configured for the stage's class
+        """
+        resource = self.for_stage(stage)
+        prefix = []
+        if resource is not None and resource.affinity:
+            prefix.extend([self._taskset_exe, '-c', str(resource.affinity)])
+        if resource is not None and resource.ionice_class is not None:
+            prefix.extend([self._ionice_exe, '-c', str(resource.ionice_class)])
+            if resource.ionice_level is not None:
+                prefix.extend(['-n', str(resource.ionice_level)])
+        if resource is not None and resource.nice is not None:
+            prefix.extend([self._nice_exe, '-n', str(resource.nice)])
+        elif self._default_nice:
+            prefix.append(self._nice_exe)
+        return prefix + list(args)
+
+    def threads(self, stage):
+        resource = self.for_stage(stage)
+        return resource.threads if resource is not None else 0
+
+    @contextmanager
+    def slot(self, stage):
+        """
+        Hold one of the stage's class slots, waiting for one if they are all taken
+        """
+        resource = self.for_stage(stage)
+        if resource is None or resource.semaphore is None:
+            yield
+            return
+        if not resource.semaphore.acquire(block=False):
+            logger.debug('Waiting for a {} slot for {}'.format(resource.name, stage))
+            resource.semaphore.acquire()
+        try:
+            yield
+        finally:
+            resource.semaphore.release()
+
+    def limit(self, name, func):
+        """
+        Wrap a stage function so it only runs while holding a slot of its class
+        """
+        if self.for_stage(name) is None:
+            return func
+        if asyncio.iscoroutinefunction(func):
+            async def run_async(**kwargs):
+                loop = asyncio.get_event_loop()
+                slot = self.slot(name)
+                # Acquiring blocks, so wait in the executor instead of stalling the other stages
+                await loop.run_in_executor(None, slot.__enter__)
+                try:
+                    return await func(**kwargs)
+                finally:
+                    slot.__exit__(None, None, None)
+
+            return run_async
+
+        def run(**kwargs):
+            with self.slot(name):
+                return func(**kwargs)
+
+        return run
@@ -0,0 +1,117 @@
+"""
+Orders the recordings waiting to be processed by their estimated cost and estimates when the backlog will be done.
+
+The cost of a recording is the part of it which is kept divided by how fast recordings of the same series have been
+encoded before, or how fast any recording has been encoded if the series is new. The estimates improve as every
+encode adds to the history.
+"""
+import heapq
+
+POLICIES = ('shortest', 'oldest', 'priority', 'name')
+
+# Assumed for a recording whose duration cannot be read
+DEFAULT_MEDIA_SECONDS = 3600
+
+
+class JobEstimate():
+    def __init__(self, wtv_file, series=None, media_seconds=None, kept_fraction=None, mtime=0):
+        """
+        :param media_seconds: duration of the recording or None if unknown
+        :param kept_fraction: fraction of the recording left once the commercials are cut, None if not detected yet
+        :param mtime: modification time, for the oldest first policy
+        """
+        self.wtv_file = wtv_file
+        self.series = series
+        self.media_seconds = media_seconds
+        self.kept_fraction = kept_fraction
+        self.mtime = mtime
+
+    def __repr__(self):
+        return 'JobEstimate[file={}, series={}, media_seconds={}, kept_fraction={}]'.format(
+            self.wtv_file, self.series, self.media_seconds, self.kept_fraction)
+
+
+def format_seconds(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '{}h{:02d}m'.format(seconds // 3600, seconds // 60 % 60)
+    return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+
+
+class Scheduler():
+    def __init__(self, policy='shortest', priorities=(), workers=1, history=None, default_speed=1.0,
+                 default_kept_fraction=0.75):
+        """
+        :param policy: 'shortest' (least estimated cost first), 'oldest' (oldest recording first), 'priority'
+                       (series in the order of priorities first, then shortest first) or 'name' (filename order)
+        :param priorities: series names, most important first
+        :param workers: number of recordings processed at once
+        :param history: function given a series, or None for all of them, which returns the media seconds encoded per
+                        wall second or None if there is no history
+        :param default_speed: media seconds encoded per wall second without any history
+        :param default_kept_fraction: fraction kept of a recording whose commercials are not known yet
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown scheduling policy {}, expected one of {}'.format(policy, POLICIES))
+        self.policy = policy
+        self._priorities = {series: i for i, series in enumerate(priorities)}
+        self.workers = max(1, workers)
+        self._history = history
+        self._default_speed = default_speed
+        self._default_kept_fraction = default_kept_fraction
+
+    def _speeds(self, estimates):
+        # Look the history up once per series
+        overall = self._history(None) if self._history else None
+        default = overall or self._default_speed
+        speeds = {}
+        for e in estimates:
+            if e.series not in speeds:
+                speeds[e.series] = (self._history(e.series) if self._history and e.series else None) or default
+        return speeds
+
+    def costs(self, estimates):
+        """
+        :return: the estimated wall seconds of each recording
+        """
+        speeds = self._speeds(estimates)
+        costs = []
+        for e in estimates:
+            media = e.media_seconds or DEFAULT_MEDIA_SECONDS
+            kept = e.kept_fraction if e.kept_fraction is not None else self._default_kept_fraction
+            costs.append(media * kept / speeds[e.series])
+        return costs
+
+    def key(self, estimate, cost=None):
+        """
+        :param cost: the estimated cost if already known
+        :return: the sort key of a recording, lowest first
+        """
+        if cost is None and self.policy in ('shortest', 'priority'):
+            cost = self.costs([estimate])[0]
+        if self.policy == 'shortest':
+            return cost, estimate.wtv_file
+        elif self.policy == 'oldest':
+            return estimate.mtime, estimate.wtv_file
+        elif self.policy == 'priority':
+            return self._priorities.get(estimate.series, len(self._priorities)), cost, estimate.wtv_file
+        return (estimate.wtv_file,)
+
+    def order(self, estimates):
+        """
+        :return: the estimates in the order they should be processed
+        """
+        estimates = list(estimates)
+        keys = [self.key(e, cost) for e, cost in zip(estimates, self.costs(estimates))]
+        return [e for k, e in sorted(zip(keys, estimates), key=lambda pair: pair[0])]
+
+    def eta(self, estimates):
+        """
+        Simulate processing the estimates in order, each starting on the first worker to become free
+        :return: (total wall seconds of work, seconds until the last one finishes)
+        """
+        costs = self.costs(estimates)
+        workers = [0.0] * self.workers
+        for cost in costs:
+            heapq.heapreplace(workers, workers[0] + cost)
+        return sum(costs), max(workers)
@@ -0,0 +1,251 @@
+"""
+Budgets the temporary space used by jobs.
+
+Every working directory is reserved for an estimated size. A reservation goes on the RAM disk if one is configured and
+the job fits, otherwise on disk. If neither volume has room once the outstanding reservations of every process are
+counted, the job waits for space or is refused. Each working directory holds an owner file, so directories left behind
+by crashed runs can be found and removed.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+OWNER_FILE = '.owner.json'
+LOCK_FILE = '.spool.lock'
+
+
+class SpoolFull(Exception):
+    pass
+
+
+def _free_bytes(directory):
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+
+def _used_bytes(directory):
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_owner(work_dir):
+    try:
+        with open(os.path.join(work_dir, OWNER_FILE)) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+class Reservation():
+    """
+    A working directory with a reserved size. Used as a context manager, the directory is removed on exit whether the
+    job succeeded or not.
+    """
+
+    def __init__(self, path, size, keep=False):
+        self.path = path
+        self.size = size
+        self._keep = keep
+
+    def release(self):
+        if not os.path.isdir(self.path):
+            return
+        if self._keep:
+            # Kept for debugging, so it no longer counts against the budget and is only swept once old
+            owner = _read_owner(self.path) or {}
+            owner['released'] = True
+            with open(os.path.join(self.path, OWNER_FILE), 'w') as f:
+                json.dump(owner, f)
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self.path
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class SpoolManager():
+    def __init__(self, disk_dir, ram_dir=None, ram_max=0, min_free=0, wait=True, wait_timeout=3600,
+                 poll_interval=30, keep=False):
+        """
+        :param disk_dir: default directory for working directories
+        :param ram_dir: optional directory on a tmpfs, used for reservations which fit
+        :param ram_max: maximum bytes reserved on the RAM disk at once, 0 for no limit besides its free space
+        :param min_free: bytes which must stay free on every volume
+        :param wait: wait up to wait_timeout seconds for space instead of refusing the job immediately
+        :param keep: keep the working directories after they are released (debug mode)
+        """
+        self._disk_dir = disk_dir
+        self._ram_dir = ram_dir
+        self._ram_max = ram_max
+        self._min_free = min_free
+        self._wait = wait
+        self._wait_timeout = wait_timeout
+        self._poll_interval = poll_interval
+        self._keep = keep
+        self._host = socket.gethostname()
+
+    def _lock(self, directory):
+        lock = open(os.path.join(directory, LOCK_FILE), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _owned(self, directory):
+        # (working directory, owner) of each in directory
+        owned = []
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return owned
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                owner = _read_owner(path)
+                if owner is not None:
+                    owned.append((path, owner))
+        return owned
+
+    def _orphaned(self, owner):
+        return owner.get('host') == self._host and not _pid_alive(owner.get('pid', 0))
+
+    def outstanding(self, directory):
+        """
+        :return: bytes reserved in directory by live jobs but not written yet
+        """
+        total = 0
+        for path, owner in self._owned(directory):
+            if not owner.get('released') and not self._orphaned(owner):
+                total += max(0, owner.get('size', 0) - _used_bytes(path))
+        return total
+
+    def available(self, directory, ram=False):
+        available = _free_bytes(directory) - self.outstanding(directory) - self._min_free
+        if ram and self._ram_max:
+            reserved = sum(owner.get('size', 0) for path, owner in self._owned(directory)
+                           if not owner.get('released') and not self._orphaned(owner))
+            available = min(available, self._ram_max - reserved)
+        return available
+
+    def _try_reserve(self, name, size, directories, persistent):
+        for directory, ram in directories:
+            os.makedirs(directory, exist_ok=True)
+            lock = self._lock(directory)
+            try:
+                path = os.path.join(directory, name) if persistent else None
+                # The files already written by an earlier reservation of a persistent directory are part of the size
+                needed = size - _used_bytes(path) if path and os.path.isdir(path) else size
+                if needed <= 0 or self.available(directory, ram) >= needed:
+                    if persistent:
+                        os.makedirs(path, exist_ok=True)
+                    else:
+                        path = tempfile.mkdtemp(prefix=name + '.', dir=directory)
+                    with open(os.path.join(path, OWNER_FILE), 'w') as f:
+                        json.dump({'pid': os.getpid(), 'host': self._host, 'size': size, 'created': time.time(),
+                                   'persistent': persistent}, f)
+                    logger.debug('Reserved {} bytes at {}'.format(size, path))
+                    return Reservation(path, size, self._keep or persistent)
+            finally:
+                lock.close()
+        return None
+
+    def reserve(self, name, size, directory=None, ram=True, persistent=False):
+        """
+        Reserve a working directory, waiting for space if needed
+        :param size: estimated bytes the job will write
+        :param directory: use this directory instead of the default disk directory
+        :param ram: whether the RAM disk may be used
+        :param persistent: name the directory name and keep it when released, so a later reservation of the same name
+                           continues with its files. It is removed by remove() or by sweep() once old.
+        :raises SpoolFull: if there is not enough space
+        """
+        directories = []
+        if ram and self._ram_dir:
+            directories.append((self._ram_dir, True))
+        directories.append((directory or self._disk_dir, False))
+        if persistent:
+            # Continue wherever the files already are
+            existing = [(d, r) for d, r in directories if os.path.isdir(os.path.join(d, name))]
+            directories = existing or directories
+        deadline = time.monotonic() + self._wait_timeout
+        waiting = False
+        while True:
+            reservation = self._try_reserve(name, size, directories, persistent)
+            if reservation is not None:
+                if waiting:
+                    logger.info('Space available for {}'.format(name))
+                return reservation
+            if not self._wait or time.monotonic() >= deadline:
+                raise SpoolFull('Not enough space for {} bytes in {}'.format(size, [d for d, r in directories]))
+            if not waiting:
+                logger.info('Waiting for {} bytes of space for {}'.format(size, name))
+                waiting = True
+            time.sleep(self._poll_interval)
+
+    def wait_for_space(self, directory, size):
+        """
+        Wait until a directory which is not managed, such as the output directory, has room for size bytes
+        :raises SpoolFull: if there is not enough space
+        """
+        deadline = time.monotonic() + self._wait_timeout
+        while _free_bytes(directory) - self._min_free < size:
+            if not self._wait or time.monotonic() >= deadline:
+                raise SpoolFull('Not enough space for {} bytes in {}'.format(size, directory))
+            logger.info('Waiting for {} bytes of space in {}'.format(size, directory))
+            time.sleep(self._poll_interval)
+
+    def remove(self, name, directory=None):
+        """
+        Remove a persistent working directory from wherever it was reserved
+        """
+        for d in (self._ram_dir, directory or self._disk_dir):
+            path = os.path.join(d, name) if d else None
+            if path and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def sweep(self, max_age=None, directories=()):
+        """
+        Remove working directories whose process has died, except persistent ones, and any older than max_age seconds
+        :param directories: other directories used with reserve()
+        :return: number of directories removed
+        """
+        removed = 0
+        for directory in set(d for d in (self._disk_dir, self._ram_dir) + tuple(directories) if d):
+            if not os.path.isdir(directory):
+                continue
+            lock = self._lock(directory)
+            try:
+                for path, owner in self._owned(directory):
+                    old = max_age is not None and time.time() - owner.get('created', 0) > max_age
+                    orphaned = self._orphaned(owner) and not owner.get('released') and not owner.get('persistent')
+                    if old or orphaned:
+                        logger.info('Removing orphaned working directory {}'.format(path))
+                        shutil.rmtree(path, ignore_errors=True)
+                        removed += 1
+            finally:
+                lock.close()
+        return removed
@@ -0,0 +1,92 @@
+import asyncio
+import contextvars
+import functools
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class Stage():
+    def __init__(self, name, func, depends=(), blocking=False):
+        self.name = name
+        self.func = func
+        self.depends = tuple(depends)
+        self.blocking = blocking
+
+    def __repr__(self):
+        return 'Stage[name={}, depends={}, blocking={}]'.format(self.name, self.depends, self.blocking)
+
+
+async def in_executor(func, *args):
+    """
+    Run a blocking function in the event loop's default executor, in the context of the caller
+    """
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.get_event_loop().run_in_executor(None, call)
+
+
+class StageGraph():
+    """
+    A small dependency graph of the work done for a single file.
+
+    Every stage starts as soon as all of its dependencies have finished. Coroutine stages run on the event loop and
+    blocking stages run in the loop's default executor, both in the context of the caller of run(). A stage is called
+    with the results of its dependencies as keyword arguments named after the dependency. If a stage fails, the stages
+    depending on it fail too, but unrelated stages still run to completion.
+    """
+
+    def __init__(self, wrapper=None):
+        """
+        :param wrapper: optional, called with (name, func) for every stage and returns the function to run instead,
+                        such as to time the stages
+        """
+        self._stages = OrderedDict()
+        self._wrapper = wrapper
+
+    def add(self, name, func, depends=(), blocking=False):
+        if name in self._stages:
+            raise Exception('Duplicate stage: {}'.format(name))
+        for d in depends:
+            if d not in self._stages:
+                raise Exception('Unknown dependency {} for stage {}'.format(d, name))
+        if self._wrapper:
+            func = self._wrapper(name, func)
+        self._stages[name] = Stage(name, func, depends, blocking)
+
+    async def _run_stage(self, stage, tasks):
+        kwargs = {}
+        for d in stage.depends:
+            kwargs[d] = await tasks[d]
+        logger.debug('Starting stage {}'.format(stage.name))
+        if stage.blocking:
+            result = await in_executor(lambda: stage.func(**kwargs))
+        else:
+            result = await stage.func(**kwargs)
+        logger.debug('Finished stage {}'.format(stage.name))
+        return result
+
+    async def run_async(self):
+        tasks = OrderedDict()
+        # Stages are added after their dependencies, so every dependency already has a task
+        for stage in self._stages.values():
+            tasks[stage.name] = asyncio.ensure_future(self._run_stage(stage, tasks))
+        await asyncio.wait(list(tasks.values()))
+        # Retrieve every exception so none are reported as unhandled, then raise the first
+        failures = [task.exception() for task in tasks.values() if task.exception() is not None]
+        if failures:
+            raise failures[0]
+        return OrderedDict((name, task.result()) for name, task in tasks.items())
+
+    def run(self):
+        """
+        Run all of the stages on a new event loop
+        :return: dict of stage name to result
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            return loop.run_until_complete(self.run_async())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
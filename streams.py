@@ -0,0 +1,144 @@
+"""
+Decides which streams of a recording are copied into the output and which are transcoded.
+
+A recording is analysed once with ffprobe. Its video is copied if the codec can be carried in the output container,
+as is each audio track, so only the incompatible streams are encoded. Many tuners already broadcast H.264 with AAC or
+AC-3 audio, in which case nothing is encoded at all.
+"""
+import json
+
+# Codecs which can be copied into an mp4
+MP4_VIDEO_CODECS = ('h264',)
+MP4_AUDIO_CODECS = ('aac', 'ac3')
+
+# Codec the transcoded audio is encoded with, which needs aac_adtstoasc when copied from MPEG-TS into mp4
+AUDIO_ENCODER = 'aac'
+
+
+def parse_probe(output):
+    """
+    :param output: output of ffprobe -show_streams -show_format -of json
+    :return: dict of the duration and the streams, which is what is cached
+    """
+    data = json.loads(output) if output and output.strip() else {}
+    streams = []
+    for s in data.get('streams', []):
+        disposition = s.get('disposition', {})
+        streams.append({
+            'index': s['index'],
+            'type': s.get('codec_type'),
+            'codec': s.get('codec_name'),
+            'channels': s.get('channels'),
+            'language': s.get('tags', {}).get('language'),
+            'default': bool(disposition.get('default')),
+            # Cover art, such as the thumbnail in a WTV, is reported as a video stream
+            'attached_pic': bool(disposition.get('attached_pic')),
+        })
+    try:
+        duration = float(data.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        duration = None
+    return {'duration': duration, 'streams': streams}
+
+
+class _Output():
+    def __init__(self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+
+    @property
+    def codec(self):
+        return self.stream['codec'] if self.copy else None
+
+    def __repr__(self):
+        return '{}:{} {}'.format(self.stream['index'], self.stream['codec'], 'copy' if self.copy else 'transcode')
+
+
+class StreamPlan():
+    """
+    The input streams of the output, in order, and whether each is copied or transcoded
+    """
+
+    def __init__(self, video, audio):
+        """
+        :param video: _Output for the video or None
+        :param audio: list of _Output
+        """
+        self.video = video
+        self.audio = audio
+
+    @property
+    def copy_video(self):
+        return self.video is not None and self.video.copy
+
+    @property
+    def copy_all(self):
+        return self.copy_video and all(a.copy for a in self.audio)
+
+    def transcode_video(self):
+        """
+        :return: the same plan with the video transcoded instead of copied
+        """
+        return StreamPlan(_Output(self.video.stream, False) if self.video else None, self.audio)
+
+    def map_args(self, input=0):
+        args = []
+        for output in ([self.video] if self.video else []) + self.audio:
+            args.extend(['-map', '{}:{}'.format(input, output.stream['index'])])
+        return args
+
+    def codec_args(self, video_args, copy_video=True, copy_audio=True):
+        """
+        :param video_args: encoder options for video which is transcoded
+        :param copy_video: whether compatible video may be copied, eg not for pieces which must be re-encoded
+        :param copy_audio: whether compatible audio may be copied, eg not when it is filtered
+        """
+        args = []
+        if self.video:
+            if self.video.copy and copy_video:
+                args.extend(['-c:v', 'copy'])
+            else:
+                args.extend(video_args)
+        transcoded = False
+        for i, output in enumerate(self.audio):
+            if output.copy and copy_audio:
+                args.extend(['-c:a:{}'.format(i), 'copy'])
+            else:
+                args.extend(['-c:a:{}'.format(i), AUDIO_ENCODER])
+                transcoded = True
+        if transcoded:
+            args.extend(['-strict', '-2'])
+        return args
+
+    def bitstream_args(self, copy_audio=True):
+        """
+        :return: the bitstream filters needed to copy the audio of MPEG-TS pieces into an mp4
+        """
+        args = []
+        for i, output in enumerate(self.audio):
+            codec = output.codec if output.copy and copy_audio else AUDIO_ENCODER
+            if codec == 'aac':
+                args.extend(['-bsf:a:{}'.format(i), 'aac_adtstoasc'])
+        return args
+
+    def __repr__(self):
+        return 'StreamPlan[video={}, audio={}]'.format(self.video, self.audio)
+
+
+def plan(analysis, video_codecs=MP4_VIDEO_CODECS, audio_codecs=MP4_AUDIO_CODECS, all_audio=True):
+    """
+    :param analysis: result of parse_probe
+    :param video_codecs: video codecs which are copied
+    :param audio_codecs: audio codecs which are copied
+    :param all_audio: keep every audio track instead of only the first
+    """
+    video = None
+    audio = []
+    for s in analysis['streams']:
+        if s['type'] == 'video' and video is None and not s['attached_pic']:
+            video = _Output(s, s['codec'] in video_codecs)
+        elif s['type'] == 'audio' and (all_audio or not audio):
+            # Tracks which ffprobe could not identify, or without any channels, cannot be muxed either way
+            if s['codec'] and s['channels'] != 0:
+                audio.append(_Output(s, s['codec'] in audio_codecs))
+    return StreamPlan(video, audio)
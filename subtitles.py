@@ -0,0 +1,129 @@
+import bisect
+import codecs
+import re
+
+import chardet
+
+TIME_PATTERN = re.compile(r'(\d+):(\d+):(\d+)[,.](\d+)\s*-->\s*(\d+):(\d+):(\d+)[,.](\d+)')
+
+# Number of bytes used to guess the encoding of a subtitle file
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+
+def to_millis(seconds):
+    return int(round(float(seconds) * 1000))
+
+
+def format_time(millis):
+    millis = max(0, millis)
+    hours, millis = divmod(millis, 60 * 60 * 1000)
+    minutes, millis = divmod(millis, 60 * 1000)
+    seconds, millis = divmod(millis, 1000)
+    return '{:02d}:{:02d}:{:02d},{:03d}'.format(hours, minutes, seconds, millis)
+
+
+def detect_encoding(srt_file):
+    with open(srt_file, 'rb') as f:
+        sample = f.read(ENCODING_SAMPLE_SIZE)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    encoding = chardet.detect(sample)['encoding']
+    if encoding is None or encoding.lower() in ('ascii', 'utf-8'):
+        # ascii is a subset, but later cues may not be
+        return 'utf-8-sig'
+    return encoding
+
+
+def read_cues(srt_file, encoding=None):
+    """
+    Parse a SRT file as a stream
+    :return: generator of (start, end, text) with times in milliseconds and text lines joined by newlines
+    """
+    if encoding is None:
+        encoding = detect_encoding(srt_file)
+    with open(srt_file, 'r', encoding=encoding, errors='replace') as f:
+        start = None
+        end = None
+        text = []
+        for line in f:
+            line = line.rstrip('\r\n')
+            if start is None:
+                match = TIME_PATTERN.search(line)
+                if match:
+                    g = [int(x) for x in match.groups()]
+                    start = ((g[0] * 60 + g[1]) * 60 + g[2]) * 1000 + g[3]
+                    end = ((g[4] * 60 + g[5]) * 60 + g[6]) * 1000 + g[7]
+                # Otherwise it is the cue index or a stray line
+            elif line.strip() == '':
+                yield start, end, '\n'.join(text)
+                start = None
+                text = []
+            else:
+                text.append(line)
+        if start is not None:
+            yield start, end, '\n'.join(text)
+
+
+class SubtitleCutter():
+    """
+    Cuts subtitle tracks down to the kept segments of a video and shifts the cues to match the cut video.
+
+    The kept segments are converted once, so several tracks can be cut with the same instance. Cues are merged against
+    the segments in a single pass, so sorted input is linear in the number of cues and segments. A cue is kept if it
+    starts inside a kept segment and its end is clipped to the end of that segment.
+    """
+
+    def __init__(self, invert):
+        """
+        :param invert: sorted list of kept (start, end) in seconds, where the last end may be None for the end of file
+        """
+        self._starts = []
+        self._segments = []
+        position = 0
+        for start, end in invert:
+            start = to_millis(start)
+            end = to_millis(end) if end is not None else None
+            # offset moves a cue from the source position to the position in the cut video
+            self._starts.append(start)
+            self._segments.append((start, end, position - start))
+            if end is not None:
+                position += end - start
+
+    def _shifted(self, cues):
+        segments = self._segments
+        i = 0
+        for start, end, text in cues:
+            if i > 0 and start < segments[i - 1][1]:
+                # Out of order cue, so find the segment again
+                i = max(0, bisect.bisect_right(self._starts, start) - 1)
+            while i < len(segments) and segments[i][1] is not None and start >= segments[i][1]:
+                i += 1
+            if i == len(segments):
+                continue
+            seg_start, seg_end, offset = segments[i]
+            if start >= seg_start:
+                if seg_end is not None:
+                    end = min(end, seg_end)
+                yield start + offset, end + offset, text
+
+    def cut(self, srt_file, out_file, encoding=None):
+        """
+        :return: the number of cues written
+        """
+        count = 0
+        with open(out_file, 'w', encoding='utf-8') as out:
+            for start, end, text in self._shifted(read_cues(srt_file, encoding)):
+                count += 1
+                out.write('{}\n{} --> {}\n{}\n\n'.format(count, format_time(start), format_time(end), text))
+        return count
+
+    def cut_all(self, tracks):
+        """
+        :param tracks: iterable of (srt_file, out_file)
+        :return: list of the number of cues written per track
+        """
+        return [self.cut(srt_file, out_file) for srt_file, out_file in tracks]
+
+
+def split_subtitles(srt_file, invert_commercials, out_file):
+    return SubtitleCutter(invert_commercials).cut(srt_file, out_file)
@@ -0,0 +1,34 @@
+from episode_index import EpisodeIndex
+
+EPISODES = [{'id': 1, 'episodeName': 'Pilot', 'firstAired': '2010-01-15'},
+            {'id': 2, 'episodeName': 'The Storm (1)', 'firstAired': '2010-01-22'},
+            {'id': 3, 'episodeName': 'The Storm (2)', 'firstAired': '2010-01-29'}]
+
+
+def test_match_rejects_neighbouring_date_with_other_title():
+    found, candidates = EpisodeIndex(EPISODES).match('Something', '2010-01-16')
+    assert found is None
+    assert [e['id'] for e in candidates] == [1]
+
+
+def test_match_accepts_neighbouring_date_with_same_title():
+    found, candidates = EpisodeIndex(EPISODES).match('Pilot!', '2010-01-16')
+    assert found['id'] == 1
+
+
+def test_match_accepts_neighbouring_date_without_title():
+    found, candidates = EpisodeIndex(EPISODES).match(None, '2010-01-16')
+    assert found['id'] == 1
+
+
+def test_match_title_with_part_suffix():
+    found, candidates = EpisodeIndex(EPISODES).match('the storm, part two', None)
+    assert found['id'] == 3
+
+
+def test_match_malformed_air_date():
+    found, candidates = EpisodeIndex(EPISODES).match('Something', '2010-13-45')
+    assert found is None
+    assert candidates == []
+    found, candidates = EpisodeIndex(EPISODES).match(None, 'Show_Channel_x')
+    assert found is None
@@ -0,0 +1,87 @@
+import pytest
+
+import intervals
+
+
+def test_smart_cut_plan_drops_short_head():
+    # A copy seeking to 20.0 would start on the keyframe at 10, so the copy has to start on the one at 20.05
+    pieces = intervals.smart_cut_plan([(20.0, 35.0)], [0, 10, 20.05, 30, 40], min_piece=0.1)
+    assert pieces == [(20.05, 30, True), (30, 35.0, False)]
+
+
+def test_smart_cut_plan_encodes_long_head():
+    pieces = intervals.smart_cut_plan([(15.0, 35.0)], [0, 10, 20, 30, 40], min_piece=0.1)
+    assert pieces == [(15.0, 20, False), (20, 30, True), (30, 35.0, False)]
+
+
+def test_smart_cut_plan_copies_short_tail():
+    pieces = intervals.smart_cut_plan([(10.0, 30.05)], [0, 10, 20, 30, 40], min_piece=0.1)
+    assert pieces == [(10, 30.05, True)]
+
+
+def test_on_keyframes():
+    keyframes = [0, 10, 20, 30]
+    assert intervals.on_keyframes([(0, 12.5), (20, None)], keyframes)
+    assert not intervals.on_keyframes([(0, 12.5), (21.5, None)], keyframes)
+
+
+@pytest.mark.parametrize('breaks, total, min_keep, min_break, expected', [
+    # Sorted and merged
+    ([(50, 60), (10, 20), (15, 30)], None, 0, 0, [(10, 30), (50, 60)]),
+    # Clamped to the recording, a break running past the end runs to the end
+    ([(-1, 5), (90, 120), (130, 140)], 100, 0, 0, [(0, 5), (90, None)]),
+    # A short kept segment between breaks is cut along with them
+    ([(10, 20), (21, 30)], None, 2, 0, [(10, 30)]),
+    # Short kept segments at the start & end are cut too
+    ([(1, 20), (90, 99)], 100, 2, 0, [(0, 20), (90, None)]),
+    # Short breaks are kept
+    ([(10, 10.5), (20, 40)], None, 0, 1, [(20, 40)]),
+    ([], 100, 2, 1, []),
+])
+def test_normalize(breaks, total, min_keep, min_break, expected):
+    assert intervals.normalize(breaks, total, min_keep, min_break) == expected
+
+
+def test_invert():
+    assert intervals.invert([(0, 10), (20, 30)]) == [(10, 20), (30, None)]
+    assert intervals.invert([(10, None)]) == [(0, 10)]
+    assert intervals.invert([]) == [(0, None)]
+
+
+def test_read_breaks(tmp_path):
+    xml = tmp_path / 'a.xml'
+    xml.write_text('<root><commercial start="1.5" end="3" /><other /><commercial start="10" end="20" /></root>')
+    edl = tmp_path / 'a.edl'
+    edl.write_text('# comment\n1.5 3 0\n5 6 1\n10 20 3\n30 40\n')
+    txt = tmp_path / 'a.txt'
+    txt.write_text('FILE PROCESSING COMPLETE  53999 FRAMES AT  2500\n-------------\n25 50\n250 500\n')
+    assert list(intervals.read_breaks(str(xml))) == [(1.5, 3), (10, 20)]
+    # Mutes and scene markers are not cut
+    assert list(intervals.read_breaks(str(edl))) == [(1.5, 3), (10, 20), (30, 40)]
+    assert list(intervals.read_breaks(str(txt))) == [(1, 2), (10, 20)]
+    with pytest.raises(ValueError):
+        intervals.read_breaks(str(tmp_path / 'a.vdr'))
+
+
+def test_read_frame_list_without_header(tmp_path):
+    txt = tmp_path / 'a.txt'
+    txt.write_text('2997 5994\n')
+    assert list(intervals.read_frame_list(str(txt), fps=29.97)) == [(100, 200)]
+    assert list(intervals.read_frame_list(str(txt))) == [(100, 200)]
+
+
+@pytest.mark.parametrize('invert, keyframes, total, expected', [
+    # Cuts on the keyframe closest to every 30 seconds
+    ([(0, 100)], [0, 9, 21, 29.5, 41, 50, 61, 70, 79, 91, 100], None, [(0, 29.5), (29.5, 61), (61, 100)]),
+    # Without keyframes the cuts are on the targets
+    ([(0, 100)], [], None, [(0, 30), (30, 60), (60, 100)]),
+    # A keyframe past the end of the segment is not used
+    ([(0, 50)], [0, 52], None, [(0, 30), (30, 50)]),
+    # Segments up to one and a half chunks are not split
+    ([(0, 40)], [0, 10, 20, 30], None, [(0, 40)]),
+    # A segment to the end of the file uses the total duration, or is kept whole without it
+    ([(40, None)], [], 100, [(40, 70), (70, None)]),
+    ([(10, None)], [20, 40, 60], None, [(10, None)]),
+])
+def test_chunk_plan(invert, keyframes, total, expected):
+    assert intervals.chunk_plan(invert, keyframes, 30, total) == expected
@@ -0,0 +1,27 @@
+import json
+import os
+import threading
+
+from metrics import Metrics
+
+
+def test_labels_per_context(tmp_path):
+    jsonl = os.path.join(str(tmp_path), 'metrics.jsonl')
+    metrics = Metrics(jsonl)
+    barrier = threading.Barrier(2)
+
+    def recording(name):
+        metrics.begin(recording=name)
+        barrier.wait()
+        metrics.label(series=name.upper())
+        metrics.timed('encode', lambda: barrier.wait())()
+
+    threads = [threading.Thread(target=recording, args=(name,)) for name in ('a.wtv', 'b.wtv')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(jsonl) as f:
+        records = [json.loads(line) for line in f]
+    assert sorted((r['stage'], r['recording'], r['series']) for r in records) == [('encode', 'a.wtv', 'A.WTV'),
+                                                                                  ('encode', 'b.wtv', 'B.WTV')]
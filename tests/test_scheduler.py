@@ -0,0 +1,51 @@
+import pytest
+
+from scheduler import JobEstimate, Scheduler, format_seconds
+
+# Speeds in media seconds per wall second, None for all series
+SPEEDS = {None: 2.0, 'Fast': 4.0}
+
+ESTIMATES = [JobEstimate('a.wtv', 'Slow', 3600, 0.5, mtime=3),
+             JobEstimate('b.wtv', 'Fast', 3600, 1.0, mtime=1),
+             JobEstimate('c.wtv', 'Slow', 1800, None, mtime=2),
+             JobEstimate('d.wtv', None, None, 0.5, mtime=4)]
+
+
+def _scheduler(policy, workers=1, priorities=()):
+    return Scheduler(policy, priorities, workers, history=SPEEDS.get, default_kept_fraction=0.75)
+
+
+def test_costs():
+    # Slow has no history of its own so it uses the overall speed, a file without a duration is assumed an hour long
+    assert _scheduler('shortest').costs(ESTIMATES) == [900, 900, 675, 900]
+
+
+@pytest.mark.parametrize('policy, priorities, expected', [
+    ('shortest', (), ['c.wtv', 'a.wtv', 'b.wtv', 'd.wtv']),
+    ('oldest', (), ['b.wtv', 'c.wtv', 'a.wtv', 'd.wtv']),
+    ('priority', ('Fast',), ['b.wtv', 'c.wtv', 'a.wtv', 'd.wtv']),
+    ('name', (), ['a.wtv', 'b.wtv', 'c.wtv', 'd.wtv']),
+])
+def test_order(policy, priorities, expected):
+    ordered = _scheduler(policy, priorities=priorities).order(ESTIMATES)
+    assert [e.wtv_file for e in ordered] == expected
+
+
+@pytest.mark.parametrize('workers, expected', [
+    (1, (3375, 3375)),
+    # Each recording starts on the first worker to become free
+    (2, (3375, 1800)),
+    (4, (3375, 900)),
+])
+def test_eta(workers, expected):
+    assert _scheduler('shortest', workers).eta(ESTIMATES) == expected
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Scheduler('random')
+
+
+def test_format_seconds():
+    assert format_seconds(75) == '1m15s'
+    assert format_seconds(3725) == '1h02m'
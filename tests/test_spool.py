@@ -0,0 +1,91 @@
+import json
+import os
+
+import pytest
+
+from spool import SpoolManager, SpoolFull, OWNER_FILE
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    return str(tmp_path / 'disk'), str(tmp_path / 'ram')
+
+
+def test_ram_used_while_within_ram_max(dirs):
+    disk, ram = dirs
+    spool = SpoolManager(disk, ram_dir=ram, ram_max=1000, wait=False)
+    first = spool.reserve('a', 600)
+    assert os.path.dirname(first.path) == ram
+    # Only 400 bytes of the RAM budget are left
+    second = spool.reserve('b', 600)
+    assert os.path.dirname(second.path) == disk
+    first.release()
+    assert not os.path.exists(first.path)
+    third = spool.reserve('c', 600)
+    assert os.path.dirname(third.path) == ram
+
+
+def test_ram_skipped_when_not_allowed(dirs):
+    disk, ram = dirs
+    spool = SpoolManager(disk, ram_dir=ram, ram_max=1000, wait=False)
+    with spool.reserve('a', 10, ram=False) as path:
+        assert os.path.dirname(path) == disk
+    assert not os.path.exists(path)
+
+
+def test_full_without_waiting(dirs):
+    disk, ram = dirs
+    spool = SpoolManager(disk, min_free=2 ** 62, wait=False)
+    with pytest.raises(SpoolFull):
+        spool.reserve('a', 1)
+
+
+def test_outstanding_counts_unwritten_bytes(dirs):
+    disk, ram = dirs
+    spool = SpoolManager(disk, wait=False)
+    reservation = spool.reserve('a', 1000)
+    with open(os.path.join(reservation.path, 'out'), 'wb') as f:
+        f.write(b'x' * 300)
+    # The owner file itself counts as written
+    written = os.path.getsize(os.path.join(reservation.path, OWNER_FILE)) + 300
+    assert spool.outstanding(disk) == 1000 - written
+    reservation.release()
+    assert spool.outstanding(disk) == 0
+
+
+def test_persistent_continues_with_written_files(dirs):
+    disk, ram = dirs
+    spool = SpoolManager(disk, wait=False)
+    reservation = spool.reserve('job', 100, persistent=True)
+    assert reservation.path == os.path.join(disk, 'job')
+    with open(os.path.join(reservation.path, 'part'), 'wb') as f:
+        f.write(b'x' * 100)
+    reservation.release()
+    assert os.path.isdir(reservation.path)
+    with open(os.path.join(reservation.path, OWNER_FILE)) as f:
+        assert json.load(f)['released']
+    # Everything is already written, so it is reserved again even with no free space left
+    full = SpoolManager(disk, min_free=2 ** 62, wait=False)
+    again = full.reserve('job', 100, persistent=True)
+    assert again.path == reservation.path
+    assert os.path.exists(os.path.join(again.path, 'part'))
+    full.remove('job')
+    assert not os.path.exists(again.path)
+
+
+def test_sweep_removes_dead_and_old(dirs):
+    disk, ram = dirs
+    spool = SpoolManager(disk, wait=False)
+    live = spool.reserve('live', 10)
+    dead = spool.reserve('dead', 10)
+    with open(os.path.join(dead.path, OWNER_FILE)) as f:
+        owner = json.load(f)
+    # A pid which cannot exist
+    owner['pid'] = 2 ** 22 + 1
+    with open(os.path.join(dead.path, OWNER_FILE), 'w') as f:
+        json.dump(owner, f)
+    assert spool.sweep() == 1
+    assert os.path.isdir(live.path)
+    assert not os.path.exists(dead.path)
+    assert spool.sweep(max_age=-1) == 1
+    assert not os.path.exists(live.path)
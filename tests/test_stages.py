@@ -0,0 +1,17 @@
+import contextvars
+
+from stages import StageGraph
+
+recording = contextvars.ContextVar('recording')
+
+
+def test_stages_run_in_context_of_caller():
+    recording.set('a.wtv')
+    graph = StageGraph()
+
+    async def detect():
+        return recording.get(None)
+
+    graph.add('detect', detect)
+    graph.add('encode', lambda detect: (detect, recording.get(None)), depends=('detect',), blocking=True)
+    assert graph.run()['encode'] == ('a.wtv', 'a.wtv')
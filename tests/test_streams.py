@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+import streams
+
+
+def _stream(index, type, codec, channels=None, attached_pic=False):
+    return {'index': index, 'type': type, 'codec': codec, 'channels': channels, 'language': None, 'default': False,
+            'attached_pic': attached_pic}
+
+
+def test_parse_probe():
+    output = json.dumps({'streams': [{'index': 0, 'codec_type': 'video', 'codec_name': 'mpeg2video'},
+                                     {'index': 1, 'codec_type': 'audio', 'codec_name': 'ac3', 'channels': 6,
+                                      'tags': {'language': 'eng'}, 'disposition': {'default': 1}},
+                                     {'index': 2, 'codec_type': 'video', 'codec_name': 'mjpeg',
+                                      'disposition': {'attached_pic': 1}}],
+                         'format': {'duration': '1800.5'}})
+    analysis = streams.parse_probe(output)
+    assert analysis['duration'] == 1800.5
+    assert analysis['streams'][1] == {'index': 1, 'type': 'audio', 'codec': 'ac3', 'channels': 6, 'language': 'eng',
+                                      'default': True, 'attached_pic': False}
+    assert analysis['streams'][2]['attached_pic']
+
+
+def test_parse_probe_empty():
+    assert streams.parse_probe('') == {'duration': None, 'streams': []}
+    assert streams.parse_probe('{"format": {"duration": "N/A"}}')['duration'] is None
+
+
+@pytest.mark.parametrize('video, audio, expected', [
+    # Broadcast H.264 with AC-3 is copied as is
+    ('h264', [('ac3', 6)], ['0:h264 copy', '1:ac3 copy']),
+    # MPEG-2 video is transcoded, compatible audio is still copied
+    ('mpeg2video', [('aac', 2)], ['0:mpeg2video transcode', '1:aac copy']),
+    # Each audio track is decided on its own
+    ('h264', [('mp2', 2), ('ac3', 6)], ['0:h264 copy', '1:mp2 transcode', '2:ac3 copy']),
+    # Tracks without a codec or without channels are dropped
+    ('h264', [(None, 2), ('aac', 0), ('aac', 2)], ['0:h264 copy', '3:aac copy']),
+])
+def test_plan(video, audio, expected):
+    analysis = {'streams': [_stream(0, 'video', video)] + [_stream(i + 1, 'audio', codec, channels)
+                                                            for i, (codec, channels) in enumerate(audio)]}
+    plan = streams.plan(analysis)
+    assert [repr(o) for o in [plan.video] + plan.audio] == expected
+
+
+def test_plan_skips_cover_art_and_extra_audio():
+    analysis = {'streams': [_stream(0, 'video', 'mjpeg', attached_pic=True), _stream(1, 'video', 'h264'),
+                            _stream(2, 'audio', 'aac', 2), _stream(3, 'audio', 'ac3', 6)]}
+    plan = streams.plan(analysis, all_audio=False)
+    assert plan.video.stream['index'] == 1
+    assert [a.stream['index'] for a in plan.audio] == [2]
+    assert plan.copy_all
+    assert plan.map_args() == ['-map', '0:1', '-map', '0:2']
+
+
+def test_codec_args():
+    analysis = {'streams': [_stream(0, 'video', 'h264'), _stream(1, 'audio', 'mp2', 2)]}
+    plan = streams.plan(analysis)
+    video_args = ['-c:v', 'libx264']
+    assert plan.codec_args(video_args) == ['-c:v', 'copy', '-c:a:0', 'aac', '-strict', '-2']
+    assert plan.codec_args(video_args, copy_video=False)[:2] == video_args
+    assert not plan.transcode_video().copy_video
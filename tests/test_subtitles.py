@@ -0,0 +1,61 @@
+import codecs
+
+import subtitles
+from subtitles import SubtitleCutter
+
+SRT = ('1\n00:00:01,000 --> 00:00:02,500\nBefore the break\n\n'
+       '2\n00:00:09,000 --> 00:00:11,000\nStraddles the start of the break\n\n'
+       '3\n00:00:20,500 --> 00:00:22,000\nAfter the break\nSecond line\n\n'
+       '4\n00:00:29,000 --> 00:00:31,000\nRuns past the end\n')
+
+
+def _write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def _cut(tmp_path, data, invert):
+    out_file = str(tmp_path / 'out.srt')
+    count = SubtitleCutter(invert).cut(_write(tmp_path, 'in.srt', data), out_file)
+    with open(out_file, encoding='utf-8') as f:
+        return count, f.read()
+
+
+def test_format_time():
+    assert subtitles.format_time(3723004) == '01:02:03,004'
+    assert subtitles.format_time(-5) == '00:00:00,000'
+
+
+def test_read_cues_crlf_bom(tmp_path):
+    data = codecs.BOM_UTF8 + SRT.replace('\n', '\r\n').encode('utf-8')
+    cues = list(subtitles.read_cues(_write(tmp_path, 'in.srt', data)))
+    assert cues[0] == (1000, 2500, 'Before the break')
+    assert cues[2] == (20500, 22000, 'After the break\nSecond line')
+    # The last cue has no blank line after it
+    assert cues[3] == (29000, 31000, 'Runs past the end')
+
+
+def test_cut_shifts_clips_and_renumbers(tmp_path):
+    # The break from 10 to 20 seconds is cut and the video ends at 30 seconds
+    count, out = _cut(tmp_path, SRT.encode('utf-8'), [(0, 10), (20, 30)])
+    assert count == 4
+    assert out == ('1\n00:00:01,000 --> 00:00:02,500\nBefore the break\n\n'
+                   '2\n00:00:09,000 --> 00:00:10,000\nStraddles the start of the break\n\n'
+                   '3\n00:00:10,500 --> 00:00:12,000\nAfter the break\nSecond line\n\n'
+                   '4\n00:00:19,000 --> 00:00:20,000\nRuns past the end\n\n')
+
+
+def test_cut_drops_cue_starting_in_break(tmp_path):
+    count, out = _cut(tmp_path, SRT.encode('utf-8'), [(0, 5), (10, None)])
+    # The cue at 9s starts inside the break, the others are shifted back by the 5 seconds cut
+    assert count == 3
+    assert '00:00:04,000 --> 00:00:05,500' not in out
+    assert out.splitlines()[4:6] == ['2', '00:00:15,500 --> 00:00:17,000']
+    assert out.splitlines()[-3:-1] == ['00:00:24,000 --> 00:00:26,000', 'Runs past the end']
+
+
+def test_cut_all(tmp_path):
+    srt_file = _write(tmp_path, 'in.srt', SRT.encode('utf-8'))
+    tracks = [(srt_file, str(tmp_path / 'a.srt')), (srt_file, str(tmp_path / 'b.srt'))]
+    assert SubtitleCutter([(20, None)]).cut_all(tracks) == [2, 2]
@@ -0,0 +1,17 @@
+import struct
+
+import wtv
+
+
+def _entry(name, value):
+    data = value.encode('utf-16LE') + b'\x00\x00'
+    return wtv.HEADER_BYTES + struct.pack('<II', 1, len(data)) + name.encode('utf-16LE') + b'\x00\x00' + data
+
+
+def test_extract_metadata_grows_window_for_split_header(tmp_path, monkeypatch):
+    first = _entry('Title', 'Series')
+    # The second header starts 8 bytes before the end of the window
+    monkeypatch.setattr(wtv, 'METADATA_WINDOW', len(first) + 8)
+    path = tmp_path / 'recording.wtv'
+    path.write_bytes(b'\x00' * wtv.METADATA_OFFSET + first + _entry('WM/SubTitle', 'Pilot') + b'\x00' * 64)
+    assert wtv.extract_metadata(str(path)) == {'Title': 'Series', 'WM/SubTitle': 'Pilot'}
@@ -0,0 +1,111 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from wtv_db import WtvDb
+
+
+def _in_thread(func, *args):
+    errors = []
+
+    def run():
+        try:
+            func(*args)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert errors == []
+
+
+def _store(db, token):
+    db.store_token('user', token, datetime.utcnow(), datetime.utcnow() + timedelta(hours=24))
+
+
+def _stored(db_file):
+    db = WtvDb(db_file)
+    db.begin()
+    try:
+        token = db.get_token('user')
+        return token.token if token else None
+    finally:
+        db.end()
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    return os.path.join(str(tmp_path), 'db.sqlite')
+
+
+def test_session_per_context(db_file):
+    db = WtvDb(db_file)
+    db.begin()
+    main_session = db._session
+
+    def other():
+        assert db._session is None
+        db.begin()
+        assert db._session is not main_session
+        db.end()
+
+    _in_thread(other)
+    # Ending the other context's session leaves this one open
+    assert db._session is main_session
+    db.end()
+
+
+def test_batch_per_context(db_file):
+    db = WtvDb(db_file)
+    db.begin()
+
+    def other():
+        db.begin()
+        try:
+            _store(db, 'other')
+        finally:
+            db.end()
+
+    with db.batch():
+        # The other context is not part of this batch, so its write is committed right away
+        _in_thread(other)
+        assert _stored(db_file) == 'other'
+    db.end()
+
+
+def test_batch_rollback_per_context(db_file):
+    db = WtvDb(db_file)
+    db.begin()
+    with pytest.raises(ValueError):
+        with db.batch():
+            _store(db, 'rolled back')
+            raise ValueError()
+    assert _stored(db_file) is None
+    db.end()
+
+
+def test_concurrent_store_token(db_file):
+    dbs = [WtvDb(db_file) for _ in range(2)]
+    barrier = threading.Barrier(len(dbs))
+    errors = []
+
+    def store(db, token):
+        db.begin()
+        try:
+            barrier.wait()
+            _store(db, token)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.end()
+
+    threads = [threading.Thread(target=store, args=(db, 'token{}'.format(i))) for i, db in enumerate(dbs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert _stored(db_file) in ('token0', 'token1')
@@ -1,47 +1,211 @@
 import requests
+import base64
 import json
 import sys
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
+from episode_index import EpisodeIndex
 from wtv_db import CandidateEpisode, Series, SelectedEpisode, WtvFile, WtvDb
 
 BASE_URL = 'https://api.thetvdb.com'
 
+logger = logging.getLogger(__name__)
+
+# How long a token is valid if it does not include an expiry
+TOKEN_LIFETIME = timedelta(hours=24)
+# Tokens are refreshed when they are this close to expiring
+TOKEN_REFRESH_MARGIN = timedelta(hours=1)
+
+# HTTP statuses which are retried with a backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
 SERIES = {}
 
 
+class RateLimiter():
+    """
+    Token bucket limiting the rate of requests across all threads sharing it
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: requests per second, 0 or less is unlimited
+        :param burst: maximum number of requests allowed at once
+        """
+        self._rate = rate
+        self._capacity = burst if burst else max(1.0, rate)
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+def _retry(methods, **kwargs):
+    # urllib3 1.26 renamed method_whitelist to allowed_methods and 2.0 removed it, but the urllib3 vendored by older
+    # versions of requests only has method_whitelist
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        return Retry(method_whitelist=methods, **kwargs)
+
+
 class TVDB():
-    def __init__(self, api_key, username, user_key, wtvdb):
+    def __init__(self, api_key, username, user_key, wtvdb, cache_ttl=timedelta(hours=24), base_url=BASE_URL,
+                 pool_size=8, rate_limit=10, retries=5, backoff=0.5, timeout=30, offline=False):
+        """
+        :param offline: never contact TVDB, only answer lookups from the database
+        :param pool_size: number of pooled connections & concurrent page downloads
+        :param rate_limit: maximum requests per second
+        :param retries: number of retries for connection errors & 429/5xx responses
+        :param backoff: exponential backoff factor in seconds between retries
+        """
         self._api_key = api_key
         self._username = username
         self._user_key = user_key
         self._jwt = None
+        self._jwt_issued = None
+        self._jwt_expires = None
+        self._token_lock = threading.RLock()
+        self._offline = offline
         self._wtvdb = wtvdb
+        self._cache_ttl = cache_ttl
+        self._base_url = base_url
+        self._timeout = timeout
+        self._rate_limiter = RateLimiter(rate_limit)
+        self._session = requests.Session()
+        retry = _retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                       methods=frozenset(['GET', 'POST']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        # series id => (EpisodeIndex, when it was built, whether it was built from the database cache)
+        self._indexes = {}
+        # Several recordings may look up episodes at once
+        self._count_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _count(self, hit):
+        with self._count_lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def _request(self, method, path, **kwargs):
+        self._rate_limiter.acquire()
+        return self._session.request(method, self._base_url + path, timeout=self._timeout, **kwargs)
+
+    def _get(self, path, **kwargs):
+        return self._request('GET', path, **kwargs)
+
+    def close(self):
+        self._executor.shutdown()
+        self._session.close()
 
     def _get_jwt(self):
         payload = {'apikey': self._api_key, 'username': self._username, 'userkey': self._user_key}
-        res = requests.post(BASE_URL + '/login', json=payload)
+        res = self._request('POST', '/login', json=payload)
         res.raise_for_status()
         return res.json()['token']
 
+    @staticmethod
+    def _token_expiry(token, issued):
+        # The token is a JWT, so use its exp claim if there is one
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            exp = json.loads(base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8'))['exp']
+            return datetime.utcfromtimestamp(int(exp))
+        except (IndexError, KeyError, TypeError, ValueError):
+            return issued + TOKEN_LIFETIME
+
+    def _set_token(self, token):
+        self._jwt = token
+        self._jwt_issued = datetime.utcnow()
+        self._jwt_expires = self._token_expiry(token, self._jwt_issued)
+        try:
+            self._wtvdb.store_token(self._username, self._jwt, self._jwt_issued, self._jwt_expires)
+        except Exception:
+            # The token is still used by this worker, the others log in themselves
+            logger.exception('Unable to store the TVDB token')
+
+    def _token_valid(self):
+        return self._jwt is not None and datetime.utcnow() < self._jwt_expires - TOKEN_REFRESH_MARGIN
+
     def refresh(self):
-        if self._jwt is None:
-            self._jwt = self._get_jwt()
-        else:
-            headers = {'Authorization': 'Bearer ' + self._jwt}
-            res = requests.get(BASE_URL + '/refresh_token', headers=headers)
-            if res.status_code == requests.codes.ok:
-                self._jwt = res.json()['token']
+        with self._token_lock:
+            if self._jwt is None or datetime.utcnow() >= self._jwt_expires:
+                token = self._get_jwt()
             else:
-                self._jwt = self._get_jwt()
+                headers = {'Authorization': 'Bearer ' + self._jwt}
+                res = self._get('/refresh_token', headers=headers)
+                if res.status_code == requests.codes.ok:
+                    token = res.json()['token']
+                else:
+                    token = self._get_jwt()
+            self._set_token(token)
+
+    def _headers(self):
+        """
+        Get the authorization headers, only logging in or refreshing if the token is missing or about to expire
+        """
+        if self._offline:
+            raise Exception('TVDB is in offline mode')
+        with self._token_lock:
+            if self._jwt is None:
+                # Another worker may have already logged in
+                stored = self._wtvdb.get_token(self._username)
+                if stored is not None:
+                    self._jwt, self._jwt_issued, self._jwt_expires = stored.token, stored.issued, stored.expires
+            if not self._token_valid():
+                logger.debug('Refreshing TVDB token')
+                self.refresh()
+            return {'Authorization': 'Bearer ' + self._jwt}
+
+    def _auth_get(self, path, headers=None, **kwargs):
+        """
+        GET with authorization, logging in again once if the token is rejected
+        """
+        token = self._jwt
+        all_headers = self._headers()
+        if headers:
+            all_headers.update(headers)
+        res = self._get(path, headers=all_headers, **kwargs)
+        if res.status_code == requests.codes.unauthorized:
+            with self._token_lock:
+                if self._jwt == token or token is None:
+                    self._jwt = None
+                    self.refresh()
+                all_headers.update(self._headers())
+            res = self._get(path, headers=all_headers, **kwargs)
+        return res
 
     def search_series(self, name):
-        if self._jwt is None:
-            self.refresh()
         series = self._wtvdb.find_series(name)
-        if series is None:
-            headers = {'Authorization': 'Bearer ' + self._jwt}
+        if series is None and not self._offline:
             params = {'name': name}
-            res = requests.get(BASE_URL + '/search/series', params=params, headers=headers)
+            res = self._auth_get('/search/series', params=params)
             if res.status_code == requests.codes.ok:
                 res = res.json()
                 for s in res['data']:
@@ -50,64 +214,117 @@ class TVDB():
                         series = self._wtvdb.get_or_create_series(id, name)
         return series
 
-    def get_episodes(self, series_id):
-        if self._jwt is None:
-            self.refresh()
-        headers = {'Authorization': 'Bearer ' + self._jwt}
-        page = 1
-        episodes = []
-        while page is not None:
-            res = requests.get(BASE_URL + '/series/{}/episodes'.format(series_id), headers=headers,
-                               params={'page': page})
-            res = res.json()
-            episodes.extend(res['data'])
-            page = res['links']['next']
-        return episodes
+    def _download_episodes(self, series_id, last_modified=None):
+        # Once the first page gives the number of pages, the rest are downloaded concurrently. The episodes are
+        # None if not modified since last_modified.
+        path = '/series/{}/episodes'.format(series_id)
+        first_headers = {}
+        if last_modified:
+            first_headers['If-Modified-Since'] = last_modified
+        res = self._auth_get(path, headers=first_headers, params={'page': 1})
+        # The token was just validated, so the other pages reuse it
+        headers = self._headers()
+        if res.status_code == requests.codes.not_modified:
+            return None, last_modified
+        res.raise_for_status()
+        last_modified = res.headers.get('Last-Modified')
+        res = res.json()
+        episodes = list(res['data'])
+        last = res['links'].get('last')
+        if last and last > 1:
+            def fetch(page):
+                r = self._get(path, headers=headers, params={'page': page})
+                r.raise_for_status()
+                return r.json()['data']
+
+            for data in self._executor.map(fetch, range(2, last + 1)):
+                episodes.extend(data)
+        else:
+            page = res['links'].get('next')
+            while page is not None:
+                r = self._get(path, headers=headers, params={'page': page})
+                r.raise_for_status()
+                r = r.json()
+                episodes.extend(r['data'])
+                page = r['links']['next']
+        return episodes, last_modified
+
+    def _episodes(self, series_id, refresh=False):
+        # (episodes, whether they came from the cache)
+        cache = self._wtvdb.get_episode_cache(series_id)
+        if self._offline:
+            self._count(True)
+            return (self._wtvdb.get_cached_episodes(series_id) if cache else []), False
+        if cache is not None and not refresh and datetime.utcnow() - cache.updated < self._cache_ttl:
+            self._count(True)
+            return self._wtvdb.get_cached_episodes(series_id), True
+        self._count(False)
+        episodes, last_modified = self._download_episodes(series_id, cache.last_modified if cache else None)
+        if episodes is None:
+            logger.debug('Episodes for series {} not modified'.format(series_id))
+            self._wtvdb.touch_episode_cache(series_id)
+            return self._wtvdb.get_cached_episodes(series_id), False
+        self._wtvdb.store_episodes(series_id, episodes, last_modified)
+        return episodes, False
+
+    def get_episodes(self, series_id, refresh=False):
+        """
+        Get all of the episodes of a series, from the database if they were cached within the TTL
+        """
+        return self._episodes(series_id, refresh)[0]
 
     @staticmethod
     def season_number(e):
         return (e['airedSeason'], e['airedEpisodeNumber'])
 
+    def episode_index(self, series_id, refresh=False):
+        """
+        Get the index of the episodes of a series, which is kept in memory for the cache TTL
+        :return: (EpisodeIndex, whether it came from a cache)
+        """
+        entry = self._indexes.get(series_id)
+        if entry is not None and not refresh and datetime.utcnow() - entry[1] < self._cache_ttl:
+            self._count(True)
+            return entry[0], True
+        episodes, cached = self._episodes(series_id, refresh)
+        index = EpisodeIndex(episodes)
+        self._indexes[series_id] = (index, datetime.utcnow(), cached)
+        return index, cached
+
     def find_episode(self, series, episode=None, air_date=None):
+        """
+        Find an episode by its title and/or air date
+        :return: (the matching episode or None, candidates if there is no single match)
+        """
         if episode is None and air_date is None:
             raise Exception('Both episode and air_date cannot be null')
         series = self.search_series(series)
-        if series:
-            if episode:
-                episodes = self.get_episodes(series.id)
-                for e in episodes:
-                    if e['episodeName'] == episode:
-                        return [e]
-            if air_date:
-                if self._jwt is None:
-                    self.refresh()
-                headers = {'Authorization': 'Bearer ' + self._jwt}
-                params = {'firstAired': air_date}
-                res = requests.get(BASE_URL + '/series/{}/episodes/query'.format(id),
-                                   headers=headers,
-                                   params=params)
-                res = res.json()
-                if 'data' in res:
-                    return res['data']
-
-        return []
+        if not series:
+            return None, []
+        index, cached = self.episode_index(series.id)
+        found, candidates = index.match(episode, air_date)
+        if found is None and cached and not self._offline:
+            # The episode may be newer than the cache
+            index, cached = self.episode_index(series.id, refresh=True)
+            found, candidates = index.match(episode, air_date)
+        if found is None and not candidates and air_date and not self._offline:
+            res = self._auth_get('/series/{}/episodes/query'.format(series.id), params={'firstAired': air_date})
+            if res.status_code == requests.codes.ok:
+                candidates = res.json().get('data', [])
+                if len(candidates) == 1:
+                    found, candidates = candidates[0], []
+        return found, candidates
 
     def test(self):
         # /series/{id}/episodes/query
-        if self._jwt is None:
-            self.refresh()
-        headers = {'Authorization': 'Bearer ' + self._jwt}
         series_id = self.search_series('Parking Wars').id
-        res = requests.get(BASE_URL + '/series/{}/episodes/query/params'.format(series_id), headers=headers)
+        res = self._auth_get('/series/{}/episodes/query/params'.format(series_id))
         return res.json()
 
     def query(self, series_name, firstAired):
-        if self._jwt is None:
-            self.refresh()
-        headers = {'Authorization': 'Bearer ' + self._jwt}
         series_id = self.search_series(series_name).id
         params = {'firstAired': firstAired}
-        res = requests.get(BASE_URL + '/series/{}/episodes/query'.format(series_id), headers=headers, params=params)
+        res = self._auth_get('/series/{}/episodes/query'.format(series_id), params=params)
         return res.json()
 
     def _write_data(self):
@@ -147,14 +364,14 @@ def main(args):
 
     print('Title: {}'.format(series))
     print('SubTitle: {}'.format(name))
-    episodes = tvdb.find_episode(series, episode=name, air_date=air_date)
-    if len(episodes) == 1:
-        season, episode_num = TVDB.season_number(episodes[0])
+    found, candidates = tvdb.find_episode(series, episode=name, air_date=air_date)
+    if found is not None:
+        season, episode_num = TVDB.season_number(found)
         print('Season: {}'.format(season))
         print('Episode: {}'.format(episode_num))
     else:
-        print('Found {} episodes'.format(len(episodes)))
-        for e in episodes:
+        print('Found {} episodes'.format(len(candidates)))
+        for e in candidates:
             season, episode_num = TVDB.season_number(e)
             print('{}:'.format(e['episodeName']))
             print('  Season: {}'.format(season))
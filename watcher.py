@@ -0,0 +1,225 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import logging
+import os
+import select
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+# inotify does not see changes made by other hosts on these filesystems
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'fuse.sshfs', '9p')
+
+# struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify():
+    """
+    Minimal inotify binding using ctypes
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'inotify_init1: {}'.format(os.strerror(errno)))
+        self._watches = {}
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'inotify_add_watch {}: {}'.format(path, os.strerror(errno)))
+        self._watches[wd] = path
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds for events
+        :return: list of (path, mask)
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        i = 0
+        while i + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, i)
+            name = os.fsdecode(data[i + _EVENT.size:i + _EVENT.size + length].rstrip(b'\0'))
+            i += _EVENT.size + length
+            if wd in self._watches and name:
+                events.append((os.path.join(self._watches[wd], name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def filesystem_type(path):
+    """
+    :return: the filesystem type of the mount containing path from /proc/mounts or None if unknown
+    """
+    path = os.path.realpath(path)
+    best = None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                split = line.split()
+                if len(split) < 3:
+                    continue
+                mount = split[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and \
+                        (best is None or len(mount) > len(best[0])):
+                    best = (mount, split[2])
+    except (OSError, IOError):
+        return None
+    return best[1] if best else None
+
+
+class _Pending():
+    def __init__(self, size, now):
+        self.size = size
+        self.changed = now
+        self.closed = False
+
+
+class Watcher():
+    """
+    Watches directories for files which have finished being written.
+
+    A file is complete once it has been closed after writing and then not changed for the debounce time, or when its
+    size has not changed for the settle time (for writers which never close the file or mounts without inotify
+    events). inotify is used when available, otherwise the directories are polled.
+    """
+
+    def __init__(self, directories, settle_seconds=60, debounce_seconds=5, poll_interval=30, method='auto'):
+        """
+        :param directories: list of (directory, glob pattern)
+        :param method: 'inotify', 'poll' or 'auto'
+        """
+        self._directories = [(os.path.abspath(d), p) for d, p in directories]
+        self._settle = settle_seconds
+        self._debounce = debounce_seconds
+        self._poll_interval = poll_interval
+        self._method = method
+        self._pending = {}
+        # path => (size, mtime) of files already reported as complete
+        self._complete = {}
+        self._running = False
+        self._started = None
+
+    def _matches(self, path):
+        directory, name = os.path.split(path)
+        return any(directory == d and fnmatch.fnmatch(name, p) for d, p in self._directories)
+
+    def _scan(self, now):
+        for directory, pattern in self._directories:
+            for path in glob.glob(os.path.join(directory, pattern), recursive=True):
+                self._touch(os.path.abspath(path), now)
+
+    def _touch(self, path, now, closed=None):
+        # closed is None when found by a scan, otherwise whether the event was a close/move or a write
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._pending.pop(path, None)
+            return
+        if self._complete.get(path) == (stat.st_size, stat.st_mtime):
+            return
+        pending = self._pending.get(path)
+        if pending is None:
+            # Files which have not been modified for a while are already settled
+            age = max(0, time.time() - stat.st_mtime)
+            pending = self._pending[path] = _Pending(stat.st_size, now - age)
+            if self._started and age < self._settle:
+                self._started(path)
+        if closed is not None:
+            pending.size = stat.st_size
+            pending.changed = now
+            pending.closed = closed
+
+    def _check(self, now, callback):
+        for path, pending in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if stat.st_size != pending.size:
+                pending.size = stat.st_size
+                pending.changed = now
+                pending.closed = False
+                continue
+            quiet = now - pending.changed
+            if (pending.closed and quiet >= self._debounce) or quiet >= self._settle:
+                del self._pending[path]
+                self._complete[path] = (stat.st_size, stat.st_mtime)
+                logger.debug('Complete: {}'.format(path))
+                callback(path)
+
+    def _use_inotify(self):
+        if self._method == 'poll':
+            return False
+        # inotify only watches the top level of a directory
+        if any(os.sep in p or '**' in p for d, p in self._directories):
+            if self._method == 'inotify':
+                raise Exception('inotify cannot watch recursive patterns')
+            return False
+        if self._method == 'auto' and any(filesystem_type(d) in NETWORK_FILESYSTEMS for d, p in self._directories):
+            return False
+        return True
+
+    def stop(self):
+        self._running = False
+
+    def run(self, callback, started=None):
+        """
+        Watch until stop() is called, calling callback(path) from this thread for every complete file
+        :param started: optional, called with the path of every file which is found while it is still being written
+        """
+        self._running = True
+        self._started = started
+        inotify = None
+        if self._use_inotify():
+            try:
+                inotify = Inotify()
+                for directory, pattern in self._directories:
+                    inotify.add_watch(directory, IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            except (OSError, AttributeError) as e:
+                if self._method == 'inotify':
+                    raise
+                logger.warn('inotify not available, polling instead: {}'.format(e))
+                if inotify is not None:
+                    inotify.close()
+                inotify = None
+        logger.info('Watching {} using {}'.format(self._directories, 'inotify' if inotify else 'polling'))
+        try:
+            self._scan(time.monotonic())
+            last_scan = time.monotonic()
+            while self._running:
+                if inotify:
+                    for path, mask in inotify.read(1):
+                        if self._matches(path):
+                            self._touch(path, time.monotonic(), closed=bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)))
+                else:
+                    time.sleep(min(1, self._poll_interval))
+                    if time.monotonic() - last_scan >= self._poll_interval:
+                        self._scan(time.monotonic())
+                        last_scan = time.monotonic()
+                self._check(time.monotonic(), callback)
+        finally:
+            if inotify:
+                inotify.close()
@@ -5,16 +5,43 @@ import os
 HEADER_BYTES = bytes([0x5A, 0xFE, 0xD7, 0x6D, 0xC8, 0x1D, 0x8F, 0x4A, 0x99, 0x22, 0xFA, 0xB1, 0x1C, 0x38, 0x14, 0x53])
 
 ORIGINAL_BROADCAST_DATE_KEY = 'WM/MediaOriginalBroadcastDateTime'
+# Length of the recording in 100 nanosecond units
+DURATION_KEY = 'Duration'
 
+# Offset of the metadata region
+METADATA_OFFSET = 0x12000
+# Initial size of the mapped metadata region, it grows if an entry does not fit
+METADATA_WINDOW = 1024 * 1024
 
-def _check_header(mm):
-    header = mm.read(len(HEADER_BYTES))
-    return header == HEADER_BYTES
+# Size of the entry header: 16 byte GUID, 4 byte type, 4 byte length
+_ENTRY_HEADER = len(HEADER_BYTES) + 8
+
+
+class LazyValue():
+    """
+    A large binary value (such as a thumbnail) which is only read from the file when needed
+    """
+
+    def __init__(self, wtv_file, offset, length):
+        self.wtv_file = wtv_file
+        self.offset = offset
+        self.length = length
+
+    def read(self):
+        with open(self.wtv_file, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return 'LazyValue[offset={}, length={}]'.format(self.offset, self.length)
 
 
 def extract_original_air_date(wtv_file, parse_from_filename=True, metadata=None):
     if metadata is None:
-        metadata = extract_metadata(wtv_file)
+        metadata = extract_metadata(wtv_file, keys={ORIGINAL_BROADCAST_DATE_KEY})
     # WM/MediaOriginalBroadcastDateTime=2012-10-13T04:00:00Z
     air_date = None
     if ORIGINAL_BROADCAST_DATE_KEY in metadata:
@@ -31,54 +58,121 @@ def extract_original_air_date(wtv_file, parse_from_filename=True, metadata=None)
     return air_date
 
 
-def extract_metadata(wtv_file):
+def extract_duration(wtv_file, metadata=None):
+    """
+    :return: the duration of the recording in seconds from its header or None if it is not known
+    """
+    if metadata is None:
+        metadata = extract_metadata(wtv_file, keys={DURATION_KEY})
+    duration = metadata.get(DURATION_KEY)
+    if not isinstance(duration, int) or duration <= 0:
+        return None
+    return duration / 10000000
+
+
+def _decode_value(wtv_file, type, data, offset):
+    if type == 0:
+        # integer
+        return struct.unpack_from('<i', data)[0]
+    elif type == 1:
+        # string
+        return str(data[0:len(data) - 2], 'utf-16LE')
+    elif type == 2:
+        # image
+        return LazyValue(wtv_file, offset, len(data))
+    elif type == 3:
+        # boolean
+        return bytes([0x00, 0x00, 0x00, 0x00]) != data
+    elif type == 4:
+        # long
+        return struct.unpack_from('<q', data)[0]
+    elif type == 6:
+        return data.hex()
+    else:
+        # unknown
+        return bytes(data)
+
+
+def _find_name_end(mm, start):
+    # The name is UTF-16 terminated by 0x0000 on a two byte boundary
+    pos = start
+    while True:
+        end = mm.find(b'\x00\x00', pos)
+        if end < 0 or (end - start) % 2 == 0:
+            return end
+        pos = end + 1
+
+
+def _map(file, offset, length):
+    # mmap offsets must be a multiple of the allocation granularity
+    aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+    length = min(length + offset - aligned, os.fstat(file.fileno()).st_size - aligned)
+    if length <= 0:
+        return None, aligned
+    return mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ, offset=aligned), aligned
+
+
+def extract_metadata(wtv_file, keys=None):
+    """
+    Read the metadata of a WTV file without modifying it.
+
+    Only the metadata region is mapped and images are returned as LazyValue instead of being copied.
+    :param keys: optional set of keys, if given parsing stops as soon as all of them have been found
+    :return: dict of metadata
+    """
     meta = {}
-    with open(wtv_file, 'r+b') as file:
-        mm = mmap.mmap(file.fileno(), 0)
-        index = 0x12000
-        mm.seek(index)
-        while (_check_header(mm)):
-            type = struct.unpack('<I', mm.read(4))[0]
-            length = struct.unpack('<I', mm.read(4))[0]
-            name = bytearray()
-            while (True):
-                b = mm.read(2)
-                if b == bytes([0x00, 0x00]):
-                    break
-                name.append(b[0])
-                name.append(b[1])
-            name = name.decode('utf-16LE')
-            if length > 0:
-                data = mm.read(length)
-                if type == 0:
-                    # integer
-                    meta[name] = struct.unpack('<i', data)[0]
-                elif type == 1:
-                    # string
-                    meta[name] = data[0:len(data) - 2].decode('utf-16LE')
-                elif type == 2:
-                    # image
-                    # TODO
-                    meta[name] = data
-                elif type == 3:
-                    # boolean
-                    meta[name] = bytes([0x00, 0x00, 0x00, 0x00]) != data
-                elif type == 4:
-                    # long
-                    meta[name] = struct.unpack('<q', data)[0]
-                elif type == 6:
-                    meta[name] = data.hex()
-                else:
-                    # unknown
-                    meta[name] = data
-            else:
-                meta[name] = None
-    return meta
+    remaining = set(keys) if keys else None
+    window = METADATA_WINDOW
+    with open(wtv_file, 'rb') as file:
+        while True:
+            mm, base = _map(file, METADATA_OFFSET, window)
+            if mm is None:
+                return meta
+            pos = METADATA_OFFSET - base
+            view = memoryview(mm)
+            truncated = False
+            try:
+                while True:
+                    # Check the bounds first, a header cut off by the end of the window would not match
+                    if pos + _ENTRY_HEADER > len(view):
+                        truncated = True
+                        break
+                    if view[pos:pos + len(HEADER_BYTES)] != HEADER_BYTES:
+                        break
+                    type, length = struct.unpack_from('<II', view, pos + len(HEADER_BYTES))
+                    name_start = pos + _ENTRY_HEADER
+                    name_end = _find_name_end(mm, name_start)
+                    if name_end < 0 or name_end + 2 + length > len(view):
+                        truncated = True
+                        break
+                    name = str(view[name_start:name_end], 'utf-16LE')
+                    data_start = name_end + 2
+                    if length > 0:
+                        data = view[data_start:data_start + length]
+                        meta[name] = _decode_value(wtv_file, type, data, base + data_start)
+                        data.release()
+                    else:
+                        meta[name] = None
+                    pos = data_start + length
+                    if remaining is not None:
+                        remaining.discard(name)
+                        if not remaining:
+                            return meta
+            finally:
+                view.release()
+                mm.close()
+            if not truncated or METADATA_OFFSET + window >= os.fstat(file.fileno()).st_size:
+                return meta
+            # An entry did not fit, so map a larger region and parse again
+            window *= 4
+            meta = {}
+            remaining = set(keys) if keys else None
+
 
 if __name__ == '__main__':
     import sys, json
     if len(sys.argv) > 1:
         meta = extract_metadata(sys.argv[1])
-        print(json.dumps(meta))
+        print(json.dumps(meta, default=repr))
     else:
-        print('Too few args')
\ No newline at end of file
+        print('Too few args')
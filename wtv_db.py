@@ -2,10 +2,16 @@ import logging
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
-from sqlalchemy import create_engine
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, Boolean, Text
+from sqlalchemy import create_engine, event, exc, select, func
+from sqlalchemy import Column, Integer, BigInteger, Float, String, Date, DateTime, ForeignKey, Boolean, Text, \
+    UniqueConstraint
 from sqlalchemy.orm import sessionmaker, relationship
+from contextlib import contextmanager
+import contextvars
+import json
 import os
+import threading
+import time
 from datetime import date, datetime
 import sys
 
@@ -55,6 +61,127 @@ class CandidateEpisode(Base):
                                                                                            self.episode_num)
 
 
+class Episode(Base):
+    __tablename__ = 'episode'
+
+    id = Column(Integer, primary_key=True)
+    series_id = Column(Integer, ForeignKey('series.id'), nullable=False)
+    name = Column(String(256))
+    overview = Column(Text)
+    first_aired = Column(String(16))
+    season = Column(Integer)
+    episode_num = Column(Integer)
+
+    def to_tvdb(self):
+        # The same shape as an episode returned from the TVDB API
+        return {'id': self.id,
+                'episodeName': self.name,
+                'overview': self.overview,
+                'firstAired': self.first_aired,
+                'airedSeason': self.season,
+                'airedEpisodeNumber': self.episode_num}
+
+    def __repr__(self):
+        return 'Episode[id={}, series_id={}, name={}, season={}, num={}]'.format(self.id, self.series_id, self.name,
+                                                                               self.season, self.episode_num)
+
+
+class EpisodeCache(Base):
+    __tablename__ = 'episode_cache'
+
+    series_id = Column(Integer, ForeignKey('series.id'), primary_key=True)
+    updated = Column(DateTime, nullable=False)
+    # Last-Modified header from TVDB used for conditional refreshes
+    last_modified = Column(String(64))
+
+
+class TvdbToken(Base):
+    __tablename__ = 'tvdb_token'
+
+    username = Column(String(128), primary_key=True)
+    token = Column(Text, nullable=False)
+    issued = Column(DateTime, nullable=False)
+    expires = Column(DateTime, nullable=False)
+
+
+class StreamAnalysis(Base):
+    """
+    The ffprobe stream analysis of a recording, identified by its filename & size so a spooled copy shares it
+    """
+    __tablename__ = 'stream_analysis'
+
+    filename = Column(String(256), primary_key=True)
+    size = Column(BigInteger, primary_key=True)
+    # JSON from streams.parse_probe
+    data = Column(Text, nullable=False)
+    updated = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class EncodeHistory(Base):
+    """
+    How long an encode took, to estimate how long the next recording of a series will take
+    """
+    __tablename__ = 'encode_history'
+
+    id = Column(Integer, primary_key=True)
+    series = Column(String(128))
+    # Seconds of the recording which were kept
+    media_seconds = Column(Float, nullable=False)
+    wall_seconds = Column(Float, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+# The stages of a job in the order they complete
+JOB_STAGES = ('detected', 'subtitles_extracted', 'metadata_resolved', 'encoded', 'subtitles_cut', 'finalized')
+
+
+class Job(Base):
+    """
+    The progress of processing one version of a recording, identified by its filename, size and modification time
+    """
+    __tablename__ = 'job'
+    __table_args__ = (UniqueConstraint('filename', 'size', 'mtime'),)
+
+    id = Column(Integer, primary_key=True)
+    filename = Column(String(256), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    # Modification time in nanoseconds
+    mtime = Column(BigInteger, nullable=False)
+
+    detected = Column(Boolean, nullable=False, default=False)
+    subtitles_extracted = Column(Boolean, nullable=False, default=False)
+    metadata_resolved = Column(Boolean, nullable=False, default=False)
+    encoded = Column(Boolean, nullable=False, default=False)
+    subtitles_cut = Column(Boolean, nullable=False, default=False)
+    finalized = Column(Boolean, nullable=False, default=False)
+
+    series = Column(String(128))
+    episode_name = Column(String(256))
+    season = Column(Integer)
+    episode_num = Column(Integer)
+    out_video = Column(Text)
+    out_srt = Column(Text)
+
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def episode_info(self):
+        return self.series, self.episode_name, self.season, self.episode_num
+
+    def stage(self):
+        """
+        :return: the last completed stage in order or None
+        """
+        completed = None
+        for stage in JOB_STAGES:
+            if getattr(self, stage):
+                completed = stage
+        return completed
+
+    def __repr__(self):
+        return 'Job[id={}, filename={}, stage={}]'.format(self.id, self.filename, self.stage())
+
+
 class WtvFile(Base):
     __tablename__ = 'wtv_file'
 
@@ -75,68 +202,340 @@ class SelectedEpisode(Base):
     wtv_file = relationship('WtvFile', uselist=False, back_populates='selected_episode')
 
 
+# Milliseconds a connection waits for another process' write lock before failing
+BUSY_TIMEOUT = 30000
+
+# Indexes for the lookups which are not covered by a primary key or unique constraint. They are created with IF NOT
+# EXISTS so databases created before they were added get them too.
+SECONDARY_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS ix_candidate_episode_wtv_file_id ON candidate_episode (wtv_file_id)',
+    'CREATE INDEX IF NOT EXISTS ix_candidate_episode_series_id ON candidate_episode (series_id)',
+    'CREATE INDEX IF NOT EXISTS ix_selected_episode_episode_id ON selected_episode (episode_id)',
+    'CREATE INDEX IF NOT EXISTS ix_episode_series_id ON episode (series_id)',
+    'CREATE INDEX IF NOT EXISTS ix_job_finalized ON job (finalized)',
+    'CREATE INDEX IF NOT EXISTS ix_encode_history_series ON encode_history (series, id)',
+)
+
+
+def _on_connect(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers continue while another worker writes and NORMAL only syncs at checkpoints, which is still safe
+    # from corruption in WAL mode
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout={}'.format(BUSY_TIMEOUT))
+    cursor.close()
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    # A connection inherited from the parent process by a forked worker must never be used by the worker
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid {}, attempting to check out in pid {}'.format(
+                connection_record.info['pid'], pid))
+
+
+class _SessionState():
+    # The main session of a context and the batch open on it
+    def __init__(self, session):
+        self.session = session
+        self.batch = 0
+        self.batch_thread = None
+
+
 class WtvDb():
+    """
+    The main session belongs to the context begin() was called in, so several recordings may be handled at once, each
+    with its own session
+    """
+
     def __init__(self, db_file):
         if ':memory:' == db_file:
             self._engine = create_engine('sqlite:///:memory:', echo=False)
         else:
             path = os.path.abspath(db_file)
-            self._engine = create_engine('sqlite:///' + path, echo=False)
-        Base.metadata.create_all(self._engine)
+            # A session may be used from the stage executor threads, though never from two at once
+            self._engine = create_engine('sqlite:///' + path, echo=False,
+                                         connect_args={'check_same_thread': False, 'timeout': BUSY_TIMEOUT / 1000})
+            event.listen(self._engine, 'connect', _on_connect)
+            event.listen(self._engine, 'checkout', _on_checkout)
+        self._create_schema()
         self._Session = sessionmaker(bind=self._engine)
-        self._session = None
+        # Job updates use their own short sessions since stages update them concurrently
+        self._JobSession = sessionmaker(bind=self._engine, expire_on_commit=False)
+        self._state = contextvars.ContextVar('wtvdb')
+
+    def _create_schema(self, attempts=5):
+        # Workers starting at the same time may race to create the same table
+        for attempt in range(attempts):
+            try:
+                Base.metadata.create_all(self._engine)
+                with self._engine.begin() as connection:
+                    for ddl in SECONDARY_INDEXES:
+                        connection.execute(ddl)
+                return
+            except exc.OperationalError as e:
+                if attempt == attempts - 1 or 'already exists' not in str(e):
+                    raise
+                time.sleep(0.1)
+
+    @contextmanager
+    def batch(self):
+        """
+        Group the writes of several calls into one transaction, which is committed when the outermost batch exits or
+        rolled back if it raises. Job & encode history writes made on the same thread join the batch too. SQLite has a
+        single writer, so do not hold a batch open across network calls.
+        """
+        self._check_session()
+        state = self._state.get()
+        if state.batch == 0:
+            state.batch_thread = threading.get_ident()
+        state.batch += 1
+        try:
+            yield self
+            state.batch -= 1
+            if state.batch == 0:
+                state.session.commit()
+        except BaseException:
+            state.batch -= 1
+            if state.batch == 0:
+                state.session.rollback()
+            raise
+
+    def _commit(self):
+        if self._state.get().batch == 0:
+            self._session.commit()
+
+    @contextmanager
+    def _job_session(self):
+        """
+        A short session of its own, since stages update jobs concurrently, or the batch open on this thread
+        """
+        state = self._state.get(None)
+        if state is not None and state.batch and state.batch_thread == threading.get_ident():
+            yield state.session
+            return
+        session = self._JobSession()
+        try:
+            yield session
+            session.commit()
+        finally:
+            session.close()
+
+    @property
+    def _session(self):
+        state = self._state.get(None)
+        return state.session if state is not None else None
 
     def begin(self):
         if self._session:
             self._session.close()
-        self._session = self._Session()
+        self._state.set(_SessionState(self._Session()))
 
     def end(self):
         self._session.close()
-        self._session = None
+        self._state.set(None)
 
     def _check_session(self):
         if self._session is None:
             raise Exception('Session is None. Call begin()')
 
     def store_candidates(self, tvdb, wtv_filename, meta, episodes):
+        """
+        Replace the candidate episodes of a file in a single transaction
+        """
         self._check_session()
         series_name = meta['Title']
         series = tvdb.search_series(series_name)
-        candidates = [self.from_tvdb(series, e) for e in episodes]
-        wtv_file = WtvFile(filename=wtv_filename, description=meta['WM/SubTitleDescription'])
-        wtv_file = self._session.merge(wtv_file)
-        wtv_file.candidate_episodes = candidates
-        self._session.commit()
-
-    def from_tvdb(self, series, e):
-        self._check_session()
-        return self._session.merge(CandidateEpisode(id=int(e['id']),
-                                             name=e['episodeName'],
-                                             description=e['overview'],
-                                             air_date=datetime.strptime(e['firstAired'], '%Y-%m-%d').date(),
-                                             season=int(e['airedSeason']),
-                                             episode_num=int(e['airedEpisodeNumber']),
-                                             series=series))
+        rows = [self._candidate_row(series, e, wtv_filename) for e in episodes]
+        with self.batch():
+            wtv_file = self._session.merge(WtvFile(filename=wtv_filename,
+                                                   description=meta.get('WM/SubTitleDescription')))
+            self._session.flush()
+            table = CandidateEpisode.__table__
+            stale = table.delete().where(table.c.wtv_file_id == wtv_filename)
+            if rows:
+                stale = stale.where(~table.c.id.in_([r['id'] for r in rows]))
+            self._session.execute(stale)
+            if rows:
+                # The same episode may be a candidate of another file, in which case it moves to this one
+                self._session.execute(table.insert().prefix_with('OR REPLACE'), rows)
+            self._session.expire(wtv_file, ['candidate_episodes'])
+
+    @staticmethod
+    def _candidate_row(series, e, wtv_filename):
+        return {'id': int(e['id']),
+                'name': e['episodeName'],
+                'description': e.get('overview'),
+                'air_date': datetime.strptime(e['firstAired'], '%Y-%m-%d').date() if e.get('firstAired') else None,
+                'season': int(e['airedSeason']) if e.get('airedSeason') is not None else None,
+                'episode_num': int(e['airedEpisodeNumber']) if e.get('airedEpisodeNumber') is not None else None,
+                'series_id': series.id if series else None,
+                'wtv_file_id': wtv_filename}
 
     def get_or_create_series(self, id, series_name):
         self._check_session()
-        series = self._session.query(Series).get(id)
-        if not series:
-            series = Series(id=id, name=series_name)
-            self.save(series)
-        return series
+        # Another worker may be storing the same series
+        self._session.execute(Series.__table__.insert().prefix_with('OR IGNORE'), {'id': id, 'name': series_name})
+        self._commit()
+        return self._session.query(Series).get(id)
 
     def save(self, obj):
         self._check_session()
         self._session.add(obj)
-        self._session.commit()
+        self._commit()
 
     def find_series(self, series_name):
         self._check_session()
         query = self._session.query(Series).filter(Series.name == series_name)
         return query.one_or_none()
 
+    def get_episode_cache(self, series_id):
+        self._check_session()
+        return self._session.query(EpisodeCache).get(series_id)
+
+    def get_cached_episodes(self, series_id):
+        self._check_session()
+        # Plain rows, since loading thousands of ORM objects only to convert them is slow
+        table = Episode.__table__
+        query = select([table.c.id, table.c.name, table.c.overview, table.c.first_aired, table.c.season,
+                        table.c.episode_num]).where(table.c.series_id == series_id).order_by(table.c.id)
+        return [{'id': row[0],
+                 'episodeName': row[1],
+                 'overview': row[2],
+                 'firstAired': row[3],
+                 'airedSeason': row[4],
+                 'airedEpisodeNumber': row[5]} for row in self._session.execute(query)]
+
+    def store_episodes(self, series_id, episodes, last_modified=None):
+        """
+        Replace the cached episodes of a series
+        :param episodes: episodes as returned by the TVDB API
+        """
+        self._check_session()
+        table = Episode.__table__
+        with self.batch():
+            self._session.execute(table.delete().where(table.c.series_id == series_id))
+            rows = [{'id': int(e['id']),
+                     'series_id': series_id,
+                     'name': e.get('episodeName'),
+                     'overview': e.get('overview'),
+                     'first_aired': e.get('firstAired'),
+                     'season': e.get('airedSeason'),
+                     'episode_num': e.get('airedEpisodeNumber')} for e in episodes]
+            if rows:
+                self._session.execute(table.insert().prefix_with('OR REPLACE'), rows)
+            self._session.merge(EpisodeCache(series_id=series_id, updated=datetime.utcnow(),
+                                             last_modified=last_modified))
+
+    def touch_episode_cache(self, series_id):
+        self._check_session()
+        cache = self.get_episode_cache(series_id)
+        cache.updated = datetime.utcnow()
+        self._commit()
+
+    def get_token(self, username):
+        self._check_session()
+        return self._session.query(TvdbToken).get(username)
+
+    def store_token(self, username, token, issued, expires):
+        self._check_session()
+        # Workers may log in at the same time, so replace any token stored meanwhile instead of selecting first
+        row = {'username': username, 'token': token, 'issued': issued, 'expires': expires}
+        try:
+            self._session.execute(TvdbToken.__table__.insert().prefix_with('OR REPLACE'), row)
+            self._commit()
+        except exc.SQLAlchemyError:
+            if self._state.get().batch == 0:
+                self._session.rollback()
+            raise
+
+    def get_job(self, filename, size, mtime):
+        """
+        Get or create the job for this version of a file. The returned job is detached, use update_job to change it.
+        """
+        session = self._JobSession()
+        try:
+            job = session.query(Job).filter(Job.filename == filename, Job.size == size,
+                                            Job.mtime == mtime).one_or_none()
+            if job is None:
+                job = Job(filename=filename, size=size, mtime=mtime)
+                session.add(job)
+                session.commit()
+            return job
+        finally:
+            session.close()
+
+    def update_job(self, job, **values):
+        """
+        Update the columns of a job, such as marking a stage as completed
+        """
+        with self._job_session() as session:
+            session.query(Job).filter(Job.id == job.id).update(values)
+        for key, value in values.items():
+            setattr(job, key, value)
+
+    def get_jobs(self, include_finalized=False):
+        session = self._JobSession()
+        try:
+            query = session.query(Job)
+            if not include_finalized:
+                query = query.filter(Job.finalized == False)
+            return query.order_by(Job.filename, Job.created).all()
+        finally:
+            session.close()
+
+    def get_stream_analysis(self, filename, size):
+        """
+        :return: the cached analysis or None
+        """
+        session = self._JobSession()
+        try:
+            analysis = session.query(StreamAnalysis).get((filename, size))
+            return json.loads(analysis.data) if analysis is not None else None
+        finally:
+            session.close()
+
+    def store_stream_analysis(self, filename, size, data):
+        session = self._JobSession()
+        try:
+            session.merge(StreamAnalysis(filename=filename, size=size, data=json.dumps(data),
+                                         updated=datetime.utcnow()))
+            session.commit()
+        finally:
+            session.close()
+
+    def record_encode(self, series, media_seconds, wall_seconds):
+        with self._job_session() as session:
+            session.add(EncodeHistory(series=series, media_seconds=media_seconds, wall_seconds=wall_seconds))
+
+    def encode_speed(self, series=None, limit=20):
+        """
+        :param series: the series or None for every series
+        :param limit: only the most recent encodes count, so the speed follows changes to the settings or hardware
+        :return: media seconds encoded per wall second or None if there is no history
+        """
+        session = self._JobSession()
+        try:
+            recent = session.query(EncodeHistory.media_seconds, EncodeHistory.wall_seconds)
+            if series is not None:
+                recent = recent.filter(EncodeHistory.series == series)
+            recent = recent.order_by(EncodeHistory.id.desc()).limit(limit).subquery()
+            media, wall = session.query(func.sum(recent.c.media_seconds), func.sum(recent.c.wall_seconds)).one()
+            return media / wall if wall else None
+        finally:
+            session.close()
+
+    def print_status(self, include_finalized=False):
+        jobs = self.get_jobs(include_finalized)
+        for job in jobs:
+            stages = ' '.join(stage if getattr(job, stage) else '-' * len(stage) for stage in JOB_STAGES)
+            print('{:60} {}'.format(job.filename, stages))
+        print('{} jobs'.format(len(jobs)))
+
     def get_selected_episode(self, wtv_filename):
         self._check_session()
         query = self._session.query(WtvFile).filter(WtvFile.filename == wtv_filename)
@@ -155,7 +554,7 @@ class WtvDb():
         wtv_file = self.get_wtv(filename)
         if wtv_file:
             self._session.delete(wtv_file)
-            self._session.commit()
+            self._commit()
         else:
             raise Exception('File not found: {}'.format(filename))
 
@@ -203,7 +602,9 @@ class WtvDb():
 
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2 and sys.argv[2] == 'status':
+        WtvDb(sys.argv[1]).print_status(include_finalized='--all' in sys.argv)
+    elif len(sys.argv) > 1:
         wtvdb = WtvDb(sys.argv[1])
         wtvdb.begin()
         wtvdb.resolve_all()